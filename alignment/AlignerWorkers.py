@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# AlignerWorkers.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import sys, os, time, threading, atexit, tempfile, select
+from collections import OrderedDict
+from subprocess import Popen, PIPE
+
+from barleymapcore.utils.process_utils import has_error_output
+
+# Queries added after the queries of each request, to know where its output ends
+SENTINEL_PREFIX = "m2p_worker_sentinel_"
+SENTINEL_SEQUENCE = "GATCGTACGGTCATGCAAGTCCTAGCATGACTTGCAGTCAGGTACCGATGCTTACGAGTCA"
+WRITE_BLOCK_SIZE = 65536 # bytes of the query fasta written at once to the worker
+READ_BLOCK_SIZE = 65536 # bytes of output read at once from the worker
+REAPER_INTERVAL = 30 # seconds between checks of idle workers
+MAX_ERR_OUTPUT = 4096 # bytes of stderr reported if a worker fails
+
+### A long-lived aligner process (e.g. GMAP in batch mode) which keeps the index
+### of a DB loaded in memory, and reads the queries of successive requests from stdin.
+### The aligner is expected to write to stdout a block of lines for each query,
+### starting with its header (">query_id"), in the same order than the input
+### and without buffering the output (see m2p_gmap).
+### After the queries of each request two sentinel queries are written:
+### the aligner only processes a query once it has read the header of the next one,
+### so the output of a request is complete once the header of the first sentinel
+### is found. The output of the sentinels is skipped at the start of the next request.
+### The aligner must report a header also for the queries without alignments
+### (GMAP does, unless --nofails is used). If no output is read for read_timeout
+### seconds (e.g. the aligner did not report the sentinel) the worker is killed
+### and the request fails, so that it can be run with a new aligner process.
+### A request also fails if the aligner reported errors in stderr while running it.
+class AlignerWorker(object):
+    
+    _key = None
+    _cmd = ""
+    _process = None
+    _err_file = None
+    _read_timeout = 0
+    _out_buffer = ""
+    _num_requests = 0
+    _num_completed = 0
+    _timed_out = False
+    _last_used = 0
+    _in_use = False
+    
+    def __init__(self, key, cmd, read_timeout):
+        self._key = key
+        self._cmd = cmd
+        self._read_timeout = read_timeout
+        self._out_buffer = ""
+        self._num_requests = 0
+        self._num_completed = 0
+        self._timed_out = False
+        self._last_used = time.time()
+        self._in_use = False
+        
+        self._err_file = tempfile.TemporaryFile()
+        self._process = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=self._err_file, close_fds=True)
+    
+    def get_key(self):
+        return self._key
+    
+    def get_cmd(self):
+        return self._cmd
+    
+    def get_num_requests(self):
+        return self._num_requests
+    
+    # Requests whose output was completely read
+    def get_num_completed(self):
+        return self._num_completed
+    
+    # Whether a request failed because the worker did not write any output for read_timeout seconds
+    def is_timed_out(self):
+        return self._timed_out
+    
+    def get_last_used(self):
+        return self._last_used
+    
+    def is_in_use(self):
+        return self._in_use
+    
+    def set_in_use(self, in_use):
+        self._in_use = in_use
+        self._last_used = time.time()
+    
+    def is_alive(self):
+        return self._process.poll() == None
+    
+    # Yields the output lines (without trailing new line) of the queries
+    # in query_fasta_path. The lines have to be read until the end,
+    # otherwise the worker has to be terminated.
+    def request_lines(self, query_fasta_path):
+        self._num_requests += 1
+        end_sentinel = SENTINEL_PREFIX+str(self._num_requests)
+        
+        self._err_file.seek(0, 2)
+        err_offset = self._err_file.tell()
+        
+        writer_errors = []
+        writer = threading.Thread(target=self._write_queries, args=(query_fasta_path, end_sentinel, writer_errors))
+        writer.daemon = True
+        writer.start()
+        
+        skipping = True # output of the sentinels of the previous request
+        for line in self._read_lines():
+            if line.startswith(">"):
+                header_data = line[1:].split(None, 1)
+                header = header_data[0] if len(header_data) > 0 else ""
+                if header == end_sentinel:
+                    writer.join()
+                    if len(writer_errors) > 0:
+                        raise Exception("AlignerWorker: error sending queries. "+str(writer_errors[0]))
+                    
+                    # the same check as for a new aligner process (StreamedProcess.check)
+                    err_output = self._get_err_output_from(err_offset)
+                    if has_error_output(err_output):
+                        raise Exception("AlignerWorker: error in worker output. "+self._cmd+"\nError: "+err_output+"\n")
+                    
+                    self._num_completed += 1
+                    return
+                
+                skipping = header.startswith(SENTINEL_PREFIX)
+            
+            if not skipping:
+                yield line
+        
+        writer.join()
+        raise Exception("AlignerWorker: worker exited. "+self._cmd+"\nError: "+self.get_err_output()+"\n")
+    
+    # Yields the lines (without trailing new line) of stdout until the worker exits.
+    # The worker is killed, and an Exception raised, if no output
+    # is read for read_timeout seconds.
+    def _read_lines(self):
+        stdout_fd = self._process.stdout.fileno()
+        
+        while True:
+            lines = self._out_buffer.split("\n")
+            self._out_buffer = lines.pop()
+            for line in lines:
+                yield line
+            
+            (ready, _, _) = select.select([stdout_fd], [], [], self._read_timeout)
+            if len(ready) == 0:
+                self._timed_out = True
+                self.terminate()
+                raise Exception("AlignerWorker: no output from worker in "+str(self._read_timeout)+" s. "+self._cmd+" killed.\n")
+            
+            data = os.read(stdout_fd, READ_BLOCK_SIZE)
+            if data == "": return
+            
+            self._out_buffer += data
+        
+        return
+    
+    def _write_queries(self, query_fasta_path, end_sentinel, writer_errors):
+        stdin = self._process.stdin
+        try:
+            last_data = "\n"
+            with open(query_fasta_path, 'rb') as query_file:
+                for data in iter(lambda: query_file.read(WRITE_BLOCK_SIZE), ""):
+                    stdin.write(data)
+                    last_data = data
+            
+            if not last_data.endswith("\n"): stdin.write("\n")
+            
+            stdin.write(">"+end_sentinel+"\n"+SENTINEL_SEQUENCE+"\n")
+            stdin.write(">"+end_sentinel+"_next\n"+SENTINEL_SEQUENCE+"\n")
+            stdin.flush()
+        
+        except Exception as e:
+            writer_errors.append(e)
+        
+        return
+    
+    # Last bytes written by the worker to stderr
+    def get_err_output(self):
+        try:
+            self._err_file.seek(0, 2)
+            err_size = self._err_file.tell()
+            err_output = self._get_err_output_from(max(0, err_size - MAX_ERR_OUTPUT))
+        except Exception:
+            err_output = ""
+        
+        return err_output
+    
+    # Output written by the worker to stderr from err_offset
+    def _get_err_output_from(self, err_offset):
+        self._err_file.seek(err_offset)
+        return self._err_file.read()
+    
+    def terminate(self):
+        if self._process.poll() == None:
+            self._process.kill()
+        
+        for pipe in [self._process.stdin, self._process.stdout]:
+            try:
+                pipe.close()
+            except Exception:
+                pass
+        
+        self._process.wait()
+        self._err_file.close()
+        
+        return
+
+### Pool of AlignerWorkers, one for each (aligner, DB, parameters) key,
+### shared by all the requests of the process (see get_pool).
+### At most max_workers workers (references loaded in memory) are kept:
+### the least recently used idle worker is terminated to start a new one,
+### and workers idle for more than idle_timeout seconds are terminated.
+### If a worker can not be used (busy, or all the workers busy)
+### the request is run with a new aligner process instead (cold).
+### If the first request of a worker times out (see AlignerWorker) its output
+### can not be followed, and no more workers are started for its key.
+class AlignerWorkersPool(object):
+    
+    _workers = None # key --> AlignerWorker, least recently used first
+    _disabled_keys = None
+    _max_workers = 0
+    _idle_timeout = 0
+    _read_timeout = 0
+    _verbose = False
+    _lock = None
+    _reaper = None
+    _stats = None
+    
+    # Pool shared within the process
+    _pool = None
+    _pool_lock = threading.Lock()
+    
+    STAT_COLD_REQUESTS = "cold_requests"
+    STAT_COLD_TIME = "cold_time"
+    STAT_COLD_MAX = "cold_max_time"
+    STAT_WARM_REQUESTS = "warm_requests"
+    STAT_WARM_TIME = "warm_time"
+    STAT_WARM_MAX = "warm_max_time"
+    STAT_STARTED = "started_workers"
+    STAT_EVICTED = "evicted_workers"
+    STAT_EXPIRED = "expired_workers"
+    STAT_FAILED = "failed_workers"
+    STAT_DISABLED = "disabled_keys"
+    
+    def __init__(self, max_workers, idle_timeout, read_timeout, verbose = False):
+        self._workers = OrderedDict()
+        self._disabled_keys = set()
+        self._max_workers = max_workers
+        self._idle_timeout = idle_timeout
+        self._read_timeout = read_timeout
+        self._verbose = verbose
+        self._lock = threading.Lock()
+        self._reaper = None
+        self._stats = dict([(stat, 0) for stat in [self.STAT_COLD_REQUESTS, self.STAT_COLD_TIME, self.STAT_COLD_MAX,
+                                                   self.STAT_WARM_REQUESTS, self.STAT_WARM_TIME, self.STAT_WARM_MAX,
+                                                   self.STAT_STARTED, self.STAT_EVICTED, self.STAT_EXPIRED,
+                                                   self.STAT_FAILED, self.STAT_DISABLED]])
+    
+    @staticmethod
+    def get_pool(max_workers, idle_timeout, read_timeout, verbose = False):
+        with AlignerWorkersPool._pool_lock:
+            if AlignerWorkersPool._pool == None:
+                AlignerWorkersPool._pool = AlignerWorkersPool(max_workers, idle_timeout, read_timeout, verbose)
+                atexit.register(AlignerWorkersPool._pool.terminate_all)
+            else:
+                AlignerWorkersPool._pool.set_limits(max_workers, idle_timeout, read_timeout)
+            
+            return AlignerWorkersPool._pool
+    
+    def set_limits(self, max_workers, idle_timeout, read_timeout):
+        with self._lock:
+            self._max_workers = max_workers
+            self._idle_timeout = idle_timeout
+            self._read_timeout = read_timeout
+        
+        return
+    
+    def get_num_workers(self):
+        return len(self._workers)
+    
+    # Returns (worker, cold): the worker for key, which is started with cmd if needed
+    # (cold: the index has to be loaded), or (None, True) if no worker can be used
+    def acquire_worker(self, key, cmd):
+        with self._lock:
+            self._reap_idle()
+            
+            if key in self._disabled_keys: return (None, True)
+            
+            worker = self._workers.pop(key, None)
+            if worker != None:
+                self._workers[key] = worker # most recently used
+                
+                if worker.is_alive():
+                    if worker.is_in_use(): return (None, True)
+                    worker.set_in_use(True)
+                    return (worker, False)
+                
+                self._remove_worker(worker, self.STAT_FAILED)
+            
+            while len(self._workers) >= self._max_workers:
+                idle_workers = [idle_worker for idle_worker in self._workers.values() if not idle_worker.is_in_use()]
+                if len(idle_workers) == 0: return (None, True)
+                self._remove_worker(idle_workers[0], self.STAT_EVICTED)
+            
+            if self._verbose: sys.stderr.write("AlignerWorkersPool: starting worker '"+cmd+"'\n")
+            
+            worker = AlignerWorker(key, cmd, self._read_timeout)
+            worker.set_in_use(True)
+            self._workers[key] = worker
+            self._stats[self.STAT_STARTED] += 1
+            
+            self._start_reaper()
+            
+            return (worker, True)
+    
+    # failed: the worker is terminated (e.g. its output was not completely read)
+    def release_worker(self, worker, failed = False):
+        with self._lock:
+            worker.set_in_use(False)
+            if failed or not worker.is_alive():
+                self._remove_worker(worker, self.STAT_FAILED)
+                
+                if worker.is_timed_out() and worker.get_num_completed() == 0:
+                    self._disabled_keys.add(worker.get_key())
+                    self._stats[self.STAT_DISABLED] += 1
+                    sys.stderr.write("AlignerWorkersPool: no output from new worker. Workers disabled for '"+worker.get_cmd()+"'\n")
+        
+        return
+    
+    def record_request(self, cold, elapsed_time):
+        with self._lock:
+            if cold:
+                (requests_stat, time_stat, max_stat) = (self.STAT_COLD_REQUESTS, self.STAT_COLD_TIME, self.STAT_COLD_MAX)
+            else:
+                (requests_stat, time_stat, max_stat) = (self.STAT_WARM_REQUESTS, self.STAT_WARM_TIME, self.STAT_WARM_MAX)
+            
+            self._stats[requests_stat] += 1
+            self._stats[time_stat] += elapsed_time
+            self._stats[max_stat] = max(self._stats[max_stat], elapsed_time)
+        
+        if self._verbose:
+            sys.stderr.write("AlignerWorkersPool: "+("cold" if cold else "warm")+" request in "+"%.3f" % elapsed_time+" s\n")
+            sys.stderr.write("AlignerWorkersPool: "+self.get_latency_report()+"\n")
+        
+        return
+    
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+    
+    # Average and max latency of cold (new aligner process) and warm (loaded worker) requests
+    def get_latency_report(self):
+        stats = self.get_stats()
+        
+        report = []
+        for (name, requests_stat, time_stat, max_stat) in [("cold", self.STAT_COLD_REQUESTS, self.STAT_COLD_TIME, self.STAT_COLD_MAX),
+                                                          ("warm", self.STAT_WARM_REQUESTS, self.STAT_WARM_TIME, self.STAT_WARM_MAX)]:
+            num_requests = stats[requests_stat]
+            avg_time = stats[time_stat] / num_requests if num_requests > 0 else 0.0
+            report.append(name+" requests "+str(num_requests)+" (avg "+"%.3f" % avg_time+" s, max "+"%.3f" % stats[max_stat]+" s)")
+        
+        report.append("workers "+str(len(self._workers))+"/"+str(self._max_workers))
+        
+        return ", ".join(report)
+    
+    def terminate_all(self):
+        with self._lock:
+            for worker in self._workers.values():
+                worker.terminate()
+            self._workers.clear()
+        
+        return
+    
+    # Requires the lock
+    def _remove_worker(self, worker, reason_stat):
+        if self._workers.get(worker.get_key()) is worker:
+            del self._workers[worker.get_key()]
+        
+        worker.terminate()
+        self._stats[reason_stat] += 1
+        
+        if self._verbose: sys.stderr.write("AlignerWorkersPool: worker removed ("+reason_stat+") '"+worker.get_cmd()+"'\n")
+        
+        return
+    
+    # Requires the lock
+    def _reap_idle(self):
+        if self._idle_timeout <= 0: return
+        
+        now = time.time()
+        for worker in self._workers.values():
+            if not worker.is_in_use() and now - worker.get_last_used() > self._idle_timeout:
+                self._remove_worker(worker, self.STAT_EXPIRED)
+        
+        return
+    
+    # Requires the lock
+    def _start_reaper(self):
+        if self._reaper != None and self._reaper.is_alive(): return
+        
+        self._reaper = threading.Thread(target=self._reaper_loop)
+        self._reaper.daemon = True
+        self._reaper.start()
+        
+        return
+    
+    # Terminates idle workers also while there are no requests
+    def _reaper_loop(self):
+        while True:
+            time.sleep(min(REAPER_INTERVAL, max(1, self._idle_timeout)) if self._idle_timeout > 0 else REAPER_INTERVAL)
+            with self._lock:
+                self._reap_idle()
+                if len(self._workers) == 0:
+                    self._reaper = None
+                    return
+
+## END
@@ -6,16 +6,29 @@
 # Copyright (C)  2016-2017  Carlos P Cantalapiedra.
 # (terms of use can be found within the distributed LICENSE file).
 
-import os, sys
+import os, sys, copy
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
 
-import m2p_split_blast, m2p_gmap, m2p_hsblastn
-import barleymapcore.utils.alignment_utils as alignment_utils
+import m2p_split_blast, m2p_gmap, m2p_hsblastn, m2p_minimap2
+import ExactMatchIndex
+from AlignmentResult import AlignmentResult
+from AlignmentCache import AlignmentCache
+from AlignerWorkers import AlignerWorkersPool
 from barleymapcore.m2p_exception import m2pException
+from barleymapcore.utils.process_utils import ProcessGroup
 from barleymapcore.db.DatabasesConfig import REF_TYPE_STD, REF_TYPE_BIG, DatabasesConfig
 
 ALIGNER_BLASTN = "blastn"
 ALIGNER_GMAP = "gmap"
 ALIGNER_HSBLASTN = "hsblastn"
+ALIGNER_MINIMAP2 = "minimap2" # in-process, through mappy (see Minimap2Aligner)
+
+# Routing of queries among the aligners of a list (aligner_routing in paths config)
+ALIGNER_ROUTING_NONE = "none" # every aligner aligns the queries not aligned by the previous one
+ALIGNER_ROUTING_LENGTH = "length" # see RoutedListAligner
+# Max fraction of ambiguous (non ACGT) bases of a query routed to GMAP
+ROUTING_MAX_AMBIGUOUS = 0.05
 
 class AlignersFactory(object):
     
@@ -23,9 +36,9 @@ class AlignersFactory(object):
     def get_aligner_blastn(paths_config, n_threads, verbose):
         blastn_app_path = paths_config.get_blastn_app_path()
         blastn_dbs_path = paths_config.get_blastn_dbs_path()
-        split_blast_path = paths_config.get_split_blast_path()
+        tmp_files_dir = paths_config.get_tmp_files_path()
         
-        aligner = SplitBlastnAligner(blastn_app_path, n_threads, blastn_dbs_path, split_blast_path, verbose)
+        aligner = SplitBlastnAligner(blastn_app_path, n_threads, blastn_dbs_path, tmp_files_dir, verbose)
         
         return aligner
     
@@ -45,11 +58,31 @@ class AlignersFactory(object):
         gmap_app_path = paths_config.get_gmap_app_path()
         gmap_dbs_path = paths_config.get_gmap_dbs_path()
         
+        # Workers which keep the DBs loaded between requests, if configured
+        workers_pool = None
+        if paths_config.get_aligner_workers() > 0:
+            workers_pool = AlignerWorkersPool.get_pool(paths_config.get_aligner_workers(),
+                                                       paths_config.get_aligner_workers_idle_timeout(),
+                                                       paths_config.get_aligner_workers_read_timeout(), verbose)
+        
         # Which GMAP (gmap or gmapl) to use will be resolved later
         # once that ref_type of each given DB is obtained
         # or through ref_type_param when using DBs not configured (--databases-ids)
         
-        aligner = GMAPAligner(gmap_app_path, gmapl_app_path, n_threads, gmap_dbs_path, verbose)
+        aligner = GMAPAligner(gmap_app_path, gmapl_app_path, n_threads, gmap_dbs_path, verbose, workers_pool)
+        
+        return aligner
+    
+    @staticmethod
+    def get_aligner_minimap2(paths_config, n_threads, verbose):
+        
+        if not m2p_minimap2.is_available():
+            raise m2pException("mappy is not installed. It is required by the "+ALIGNER_MINIMAP2+" aligner.")
+        
+        minimap2_dbs_path = paths_config.get_minimap2_dbs_path()
+        minimap2_preset = paths_config.get_minimap2_preset()
+        
+        aligner = Minimap2Aligner(minimap2_dbs_path, minimap2_preset, n_threads, verbose)
         
         return aligner
     
@@ -63,18 +96,27 @@ class AlignersFactory(object):
         
         if len(aligner_list) > 1:
             aligners = []
+            aligners_names = []
             
             for aligner_name in aligner_list:
                 
                 try:
                     aligner = AlignersFactory.get_aligner([aligner_name], n_threads, paths_config, verbose)
                     aligners.append(aligner)
-                    
+                    aligners_names.append(aligner_name)
+                
                 except m2pException:
                     sys.stderr.write("WARNING: exception obtaining "+aligner_name+".\nSkipping to next aligner.\n")
-                
-            aligner = ListAligner(aligners, tmp_files_dir)
             
+            aligner_routing = paths_config.get_aligner_routing()
+            if aligner_routing == ALIGNER_ROUTING_LENGTH:
+                aligner = RoutedListAligner(aligners, aligners_names, tmp_files_dir,
+                                            paths_config.get_aligner_routing_length(), verbose)
+            else:
+                if aligner_routing != ALIGNER_ROUTING_NONE:
+                    sys.stderr.write("WARNING: unrecognized aligner_routing "+str(aligner_routing)+". Aligners will not be routed.\n")
+                aligner = ListAligner(aligners, tmp_files_dir)
+        
         else:
             aligner_name = aligner_list[0]
             if aligner_name == ALIGNER_BLASTN:
@@ -88,7 +130,11 @@ class AlignersFactory(object):
             elif aligner_name == ALIGNER_HSBLASTN:
                 
                 aligner = AlignersFactory.get_aligner_hsblastn(paths_config, n_threads, verbose)
+            
+            elif aligner_name == ALIGNER_MINIMAP2:
                 
+                aligner = AlignersFactory.get_aligner_minimap2(paths_config, n_threads, verbose)
+            
             else:
                 raise m2pException("Unknown aligner type "+str(aligner_name)+" when requesting aligner.")
         
@@ -101,6 +147,7 @@ class BaseAligner(object):
     _dbs_path = ""
     _results_hits = []
     _results_unaligned = []
+    _results_errors = False
     _verbose = False
     
     def __init__(self, app_path, n_threads, dbs_path, verbose = False):
@@ -109,7 +156,7 @@ class BaseAligner(object):
         self._dbs_path = dbs_path
         self._verbose = verbose
     
-    def align(self, fasta_path, db, ref_type, threshold_id, threshold_cov):
+    def align(self, query_fasta, db, ref_type, threshold_id, threshold_cov):
         raise m2pException("BaseAligner is an abstract class. 'align' has to be implemented in child class.")
     
     def get_hits(self):
@@ -118,32 +165,59 @@ class BaseAligner(object):
     def get_unaligned(self):
         return self._results_unaligned
     
+    def get_n_threads(self):
+        return self._n_threads
+    
+    def set_n_threads(self, n_threads):
+        self._n_threads = n_threads
+    
+    # Whether the aligner reported errors in the last call to align,
+    # so that its hits (or lack of them) could be incomplete
+    def has_errors(self):
+        return self._results_errors
+    
+    # Identifies the binary of the aligner (path, size and modification time)
+    # so that cached alignments are not reused after upgrading the aligner
+    def _get_app_version(self, app_path):
+        app_version = str(app_path)
+        
+        app_file = find_executable(app_path)
+        if app_file:
+            app_stat = os.stat(app_file)
+            app_version = ":".join([app_file, str(app_stat.st_size), str(long(app_stat.st_mtime))])
+        
+        return app_version
+    
+    def get_version(self):
+        return self._get_app_version(self._app_path)
+    
 class SplitBlastnAligner(BaseAligner):
-    _split_blast_path = ""
+    _tmp_files_dir = ""
     
-    def __init__(self, app_path, n_threads, dbs_path, split_blast_path, verbose = False):
+    def __init__(self, app_path, n_threads, dbs_path, tmp_files_dir, verbose = False):
         BaseAligner.__init__(self, app_path, n_threads, dbs_path, verbose)
-        self._split_blast_path = split_blast_path
+        self._tmp_files_dir = tmp_files_dir
     
-    def align(self, fasta_path, db, ref_type, threshold_id, threshold_cov):
+    def align(self, query_fasta, db, ref_type, threshold_id, threshold_cov):
         
         sys.stderr.write("\n")
         
-        fasta_headers = alignment_utils.get_fasta_headers(fasta_path)
-        
         sys.stderr.write("SplitBlastnAligner: DB --> "+str(db)+"\n")
-        sys.stderr.write("SplitBlastnAligner: to align "+str(len(fasta_headers))+"\n")
+        sys.stderr.write("SplitBlastnAligner: to align "+str(query_fasta.get_num_queries())+"\n")
         
         # get_best_score_hits from m2p_split_blast.py
-        self._results_hits = m2p_split_blast.get_best_score_hits(self._split_blast_path, self._app_path, self._n_threads, \
-                                                 fasta_path, self._dbs_path, db, threshold_id, threshold_cov, \
-                                                 self._verbose)
+        errors = []
+        self._results_hits = m2p_split_blast.get_best_score_hits(self._app_path, self._n_threads, \
+                                                 query_fasta.get_path(), self._dbs_path, db, threshold_id, threshold_cov, \
+                                                 self._tmp_files_dir, self._verbose, errors,
+                                                 query_fasta.get_subsets_in_memory())
+        self._results_errors = len(errors) > 0
         
         query_list = [a.get_query_id() for a in self._results_hits]
         
         sys.stderr.write("SplitBlastnAligner: aligned "+str(len(set([a.split(" ")[0] for a in query_list])))+"\n")
         
-        self._results_unaligned = alignment_utils.filter_list(fasta_headers, query_list)
+        self._results_unaligned = query_fasta.get_unaligned(query_list)
         
         sys.stderr.write("SplitBlastnAligner: no hits "+str(len(self._results_unaligned))+"\n")
         
@@ -152,20 +226,26 @@ class SplitBlastnAligner(BaseAligner):
 class GMAPAligner(BaseAligner):
     
     _gmapl_app_path = None
+    _workers_pool = None
     
-    def __init__(self, app_path, gmapl_app_path, n_threads, dbs_path, verbose = False):
+    def __init__(self, app_path, gmapl_app_path, n_threads, dbs_path, verbose = False, workers_pool = None):
         
         BaseAligner.__init__(self, app_path, n_threads, dbs_path, verbose)
         self._gmapl_app_path = gmapl_app_path
+        self._workers_pool = workers_pool
+    
+    def get_workers_pool(self):
+        return self._workers_pool
     
-    def align(self, fasta_path, db, ref_type, threshold_id, threshold_cov):
+    def get_version(self):
+        return ",".join([self._get_app_version(self._app_path), self._get_app_version(self._gmapl_app_path)])
+    
+    def align(self, query_fasta, db, ref_type, threshold_id, threshold_cov):
         
         sys.stderr.write("\n")
         
-        fasta_headers = alignment_utils.get_fasta_headers(fasta_path)
-        
         sys.stderr.write("GMAPAligner: DB --> "+str(db)+"\n")
-        sys.stderr.write("GMAPAligner: to align "+str(len(fasta_headers))+"\n")
+        sys.stderr.write("GMAPAligner: to align "+str(query_fasta.get_num_queries())+"\n")
         
         # use GMAP or GMAPL
         if ref_type == REF_TYPE_STD:
@@ -176,15 +256,17 @@ class GMAPAligner(BaseAligner):
             raise m2pException("GMAPAligner: Unrecognized ref type "+ref_type+".")
         
         # get_hits from m2p_gmap.py
-        self._results_hits = m2p_gmap.get_best_score_hits(app_path, self._n_threads, fasta_path, self._dbs_path, db,
+        errors = []
+        self._results_hits = m2p_gmap.get_best_score_hits(app_path, self._n_threads, query_fasta.get_path(), self._dbs_path, db,
                                       threshold_id, threshold_cov, \
-                                      self._verbose)
+                                      self._verbose, self._workers_pool, errors)
+        self._results_errors = len(errors) > 0
         
         query_list = [a.get_query_id() for a in self._results_hits]
         
         sys.stderr.write("GMAPAligner: aligned "+str(len(set([a.split(" ")[0] for a in query_list])))+"\n")
         
-        self._results_unaligned = alignment_utils.filter_list(fasta_headers, query_list)
+        self._results_unaligned = query_fasta.get_unaligned(query_list)
         
         sys.stderr.write("GMAPAligner: no hits "+str(len(self._results_unaligned))+"\n")
         
@@ -195,30 +277,66 @@ class HSBlastnAligner(BaseAligner):
     def __init__(self, app_path, n_threads, dbs_path, verbose = False):
         BaseAligner.__init__(self, app_path, n_threads, dbs_path, verbose)
     
-    def align(self, fasta_path, db, ref_type, threshold_id, threshold_cov):
+    def align(self, query_fasta, db, ref_type, threshold_id, threshold_cov):
         
         sys.stderr.write("\n")
         
-        fasta_headers = alignment_utils.get_fasta_headers(fasta_path)
-        
         sys.stderr.write("HSBlastnAligner: DB --> "+str(db)+"\n")
-        sys.stderr.write("HSBlastnAligner: to align "+str(len(fasta_headers))+"\n")
+        sys.stderr.write("HSBlastnAligner: to align "+str(query_fasta.get_num_queries())+"\n")
         
         # get_best_score_hits from m2p_hs_blast.py
-        self._results_hits = m2p_hsblastn.get_best_score_hits(self._app_path, self._n_threads, fasta_path, self._dbs_path, db, \
+        errors = []
+        self._results_hits = m2p_hsblastn.get_best_score_hits(self._app_path, self._n_threads, query_fasta.get_path(), self._dbs_path, db, \
                                                  threshold_id, threshold_cov, \
-                                                 self._verbose)
+                                                 self._verbose, query_fasta.get_lengths(), errors)
+        self._results_errors = len(errors) > 0
         
         query_list = [a.get_query_id() for a in self._results_hits]
         
         sys.stderr.write("HSBlastnAligner: aligned "+str(len(set([a.split(" ")[0] for a in query_list])))+"\n")
         
-        self._results_unaligned = alignment_utils.filter_list(fasta_headers, query_list)
+        self._results_unaligned = query_fasta.get_unaligned(query_list)
         
         sys.stderr.write("HSBlastnAligner: no hits "+str(len(self._results_unaligned))+"\n")
         
         return self.get_hits()
 
+### Aligns in-process with minimap2, through its Python binding (mappy),
+### without running an external process nor parsing its output.
+### The index of each DB (prebuilt with minimap2 -d) is loaded once
+### and reused by later alignments (see m2p_minimap2).
+class Minimap2Aligner(BaseAligner):
+    
+    _preset = ""
+    
+    def __init__(self, dbs_path, preset, n_threads, verbose = False):
+        BaseAligner.__init__(self, "", n_threads, dbs_path, verbose)
+        self._preset = preset
+    
+    def get_version(self):
+        return ",".join([m2p_minimap2.get_version(), self._preset])
+    
+    def align(self, query_fasta, db, ref_type, threshold_id, threshold_cov):
+        
+        sys.stderr.write("\n")
+        
+        sys.stderr.write("Minimap2Aligner: DB --> "+str(db)+"\n")
+        sys.stderr.write("Minimap2Aligner: to align "+str(query_fasta.get_num_queries())+"\n")
+        
+        # ref_type is not used: minimap2 indexes both standard and big genomes
+        self._results_hits = m2p_minimap2.get_best_score_hits(self._dbs_path, self._preset, self._n_threads, query_fasta, db,
+                                                              threshold_id, threshold_cov, self._verbose)
+        
+        query_list = [a.get_query_id() for a in self._results_hits]
+        
+        sys.stderr.write("Minimap2Aligner: aligned "+str(len(set(query_list)))+"\n")
+        
+        self._results_unaligned = query_fasta.get_unaligned(query_list)
+        
+        sys.stderr.write("Minimap2Aligner: no hits "+str(len(self._results_unaligned))+"\n")
+        
+        return self.get_hits()
+
 class ListAligner(BaseAligner):
     _aligner_list = []
     _blastn_hits = []
@@ -228,39 +346,417 @@ class ListAligner(BaseAligner):
     def __init__(self, aligner_list, tmp_files_dir):
         self._aligner_list = aligner_list
         self._tmp_files_dir = tmp_files_dir
+    
+    def get_version(self):
+        return ",".join([aligner.get_version() for aligner in self._aligner_list])
         
-    def align(self, fasta_path, db, ref_type, threshold_id, threshold_cov):
-        fasta_to_align = fasta_path
+    def align(self, query_fasta, db, ref_type, threshold_id, threshold_cov):
+        # reset hits from previous calls to align (e.g. other DBs)
+        self._results_hits = []
+        self._results_unaligned = []
+        self._results_errors = False
         
-        prev_aligner_to_align = fasta_to_align
-        fasta_created = False
+        (self._results_hits, self._results_unaligned,
+         self._results_errors) = self._align_sequentially(self._aligner_list, query_fasta,
+                                                          db, ref_type, threshold_id, threshold_cov)
+        
+        return self.get_hits()
+    
+    # Each aligner aligns the queries which were not aligned by the previous ones.
+    # Returns the hits, the queries not aligned by the last aligner,
+    # and whether any aligner failed or reported errors
+    def _align_sequentially(self, aligner_list, query_fasta, db, ref_type, threshold_id, threshold_cov):
+        hits = []
+        unaligned = []
+        errors = False
+        
+        query_to_align = query_fasta
+        subsets_list = []
         
         try:
-            for aligner in self._aligner_list:
+            for aligner in aligner_list:
                 if self._verbose: sys.stderr.write("ListAligner: "+str(aligner)+"\n")
                 
                 try:
-                    aligner.align(prev_aligner_to_align, db, ref_type, threshold_id, threshold_cov)
+                    aligner.align(query_to_align, db, ref_type, threshold_id, threshold_cov)
                 except m2pException as m2pe:
                     sys.stderr.write("\t"+m2pe.msg+"\n")
                     sys.stderr.write("\tContinuing with next aligner...\n")
+                    errors = True
                     continue
                 
-                prev_aligner_to_align = alignment_utils.extract_fasta_headers(fasta_path,
-                                                                              aligner.get_unaligned(), self._tmp_files_dir)
-                fasta_created = True
-                
                 sys.stderr.write("ListAligner: hits "+str(len(aligner.get_hits()))+"\n")
                 
-                self._results_hits = self._results_hits + aligner.get_hits()
-                self._results_unaligned = aligner.get_unaligned()
-                if len(self._results_unaligned) == 0: break # CPCantalapiedra 201701
+                if aligner.has_errors(): errors = True
+                
+                hits = hits + aligner.get_hits()
+                unaligned = aligner.get_unaligned()
+                if len(unaligned) == 0: break # CPCantalapiedra 201701
+                
+                query_to_align = query_fasta.subset(unaligned, self._tmp_files_dir)
+                subsets_list.append(query_to_align)
         
         except Exception:
             raise
         finally:
-            if fasta_created: os.remove(prev_aligner_to_align)
+            for query_subset in subsets_list: query_subset.remove()
+        
+        return (hits, unaligned, errors)
+
+### First-choice aligner of each query among a list of aligners (aligners_names),
+### for the aligner_routing of the paths config (see RoutedListAligner).
+### Without routing, every query goes first to the first aligner of the list.
+class AlignerRouting(object):
+    _aligners_names = []
+    _routing = ALIGNER_ROUTING_NONE
+    _short_length = 0
+    _probe_first = 0 # short or ambiguous queries
+    _long_first = 0 # the rest
+    
+    def __init__(self, aligners_names, routing, short_length):
+        self._aligners_names = aligners_names
+        self._routing = routing
+        self._short_length = short_length
+        
+        blast_first = None
+        gmap_first = None
+        for i, aligner_name in enumerate(aligners_names):
+            if aligner_name in [ALIGNER_BLASTN, ALIGNER_HSBLASTN] and blast_first == None: blast_first = i
+            if aligner_name in [ALIGNER_GMAP, ALIGNER_MINIMAP2] and gmap_first == None: gmap_first = i
+        
+        self._probe_first = blast_first if blast_first != None else 0
+        self._long_first = gmap_first if gmap_first != None else 0
+    
+    # Index in aligners_names of the first-choice aligner of a query sequence
+    def get_first(self, sequence):
+        
+        if self._routing != ALIGNER_ROUTING_LENGTH: return 0
+        
+        seq_len = len(sequence)
+        
+        if seq_len < self._short_length:
+            first = self._probe_first
+        else:
+            upper_sequence = sequence.upper()
+            ambiguous = seq_len - sum([upper_sequence.count(base) for base in "ACGT"])
+            if ambiguous > ROUTING_MAX_AMBIGUOUS * seq_len:
+                first = self._probe_first
+            else:
+                first = self._long_first
+        
+        return first
+    
+    def get_first_name(self, sequence):
+        return self._aligners_names[self.get_first(sequence)]
+    
+    # Name of the aligners and their routing (e.g. for the keys of AlignmentCache),
+    # since the routing changes which aligner reports the hits of a query
+    def get_name(self):
+        name = ",".join(self._aligners_names)
+        if self._routing != ALIGNER_ROUTING_NONE:
+            name += ";routing="+str(self._routing)+":"+str(self._short_length)
+        
+        return name
+
+### ListAligner which routes each query to a first-choice aligner
+### by its length and composition: short probes (e.g. SNP flanks)
+### and sequences with many ambiguous bases go to blastn or HS-Blastn,
+### and long sequences (e.g. transcripts) to GMAP or minimap2.
+### The batches of the different first-choice aligners are aligned concurrently,
+### each one with its own copy of the aligners, which share the threads of the aligners
+### (as the DBs aligned concurrently, see AlignmentEngine). As in ListAligner, the queries which
+### are not aligned by their first-choice aligner are aligned by the rest of aligners,
+### in the order of the list.
+class RoutedListAligner(ListAligner):
+    _aligners_names = []
+    _routing = None
+    
+    def __init__(self, aligner_list, aligners_names, tmp_files_dir, short_length, verbose = False):
+        ListAligner.__init__(self, aligner_list, tmp_files_dir)
+        self._aligners_names = aligners_names
+        self._routing = AlignerRouting(aligners_names, ALIGNER_ROUTING_LENGTH, short_length)
+        self._verbose = verbose
+    
+    def align(self, query_fasta, db, ref_type, threshold_id, threshold_cov):
+        # reset hits from previous calls to align (e.g. other DBs)
+        self._results_hits = []
+        self._results_unaligned = []
+        self._results_errors = False
+        
+        routes = self._route(query_fasta)
+        
+        # No queries to align
+        if len(routes) == 0: return self.get_hits()
+        
+        sys.stderr.write("RoutedListAligner: "+", ".join([self._aligners_names[first]+" "+str(len(routes[first]))
+                                                          for first in sorted(routes)])+" queries\n")
+        
+        if len(routes) == 1 and 0 in routes:
+            # Every query goes first to the first aligner of the list
+            return ListAligner.align(self, query_fasta, db, ref_type, threshold_id, threshold_cov)
+        
+        subsets_list = []
+        pool = None
+        try:
+            batches = []
+            for first in sorted(routes):
+                if len(routes) == 1:
+                    batch_query = query_fasta
+                else:
+                    batch_query = query_fasta.subset(routes[first], self._tmp_files_dir)
+                    subsets_list.append(batch_query)
+                
+                batch_aligners = [copy.copy(self._aligner_list[first])]
+                batch_aligners.extend([copy.copy(aligner) for i, aligner in enumerate(self._aligner_list) if i != first])
+                for batch_aligner in batch_aligners:
+                    batch_aligner.set_n_threads(max(1, batch_aligner.get_n_threads() / len(routes)))
+                
+                batches.append((batch_aligners, batch_query))
+            
+            align_batch = ProcessGroup.propagate(lambda batch: self._align_sequentially(batch[0], batch[1], db, ref_type,
+                                                                                        threshold_id, threshold_cov))
+            
+            pool = ThreadPool(len(batches))
+            batches_results = pool.map(align_batch, batches)
+            pool.close()
+        
+        finally:
+            if pool: pool.terminate()
+            for query_subset in subsets_list: query_subset.remove()
+        
+        unaligned = set()
+        for (batch_hits, batch_unaligned, batch_errors) in batches_results:
+            self._results_hits.extend(batch_hits)
+            unaligned.update(batch_unaligned)
+            if batch_errors: self._results_errors = True
+        
+        self._results_unaligned = [query_id for query_id in query_fasta.get_ids() if query_id in unaligned]
+        
+        return self.get_hits()
+    
+    # Returns a dict index of first-choice aligner --> list of query ids
+    def _route(self, query_fasta):
+        routes = {}
+        
+        for header, sequence in query_fasta.get_sequences():
+            query_id = header.split(" ")[0]
+            routes.setdefault(self._routing.get_first(sequence), []).append(query_id)
+        
+        return routes
+
+### Aligner which wraps another aligner, sending to it only those
+### queries which are not already in the AlignmentCache.
+### The results of an alignment with errors are not stored.
+class CachedAligner(BaseAligner):
+    _aligner = None
+    _aligner_name = ""
+    _alignment_cache = None
+    _tmp_files_dir = ""
+    
+    def __init__(self, aligner, aligner_name, alignment_cache, tmp_files_dir, verbose = False):
+        self._aligner = aligner
+        self._aligner_name = aligner_name
+        self._alignment_cache = alignment_cache
+        self._tmp_files_dir = tmp_files_dir
+        self._verbose = verbose
+    
+    def get_version(self):
+        return self._aligner.get_version()
+    
+    def get_alignment_cache(self):
+        return self._alignment_cache
+    
+    def align(self, query_fasta, db, ref_type, threshold_id, threshold_cov):
+        
+        self._results_hits = []
+        self._results_unaligned = []
+        self._results_errors = False
+        
+        aligner_version = self._aligner.get_version()
+        
+        # (query_id, cache key) of each query, in the order of the fasta file
+        queries_keys = []
+        for header, sequence in query_fasta.get_sequences():
+            query_id = header.split(" ")[0]
+            seq_hash = AlignmentCache.get_sequence_hash(sequence)
+            key = AlignmentCache.get_key(seq_hash, db, self._aligner_name, threshold_id, threshold_cov, aligner_version)
+            queries_keys.append((query_id, key))
+        
+        cached = self._alignment_cache.lookup([key for query_id, key in queries_keys])
+        
+        to_align = [query_id for query_id, key in queries_keys if key not in cached]
+        
+        sys.stderr.write("CachedAligner: DB --> "+str(db)+"\n")
+        sys.stderr.write("CachedAligner: cached "+str(len(queries_keys) - len(to_align))+", to align "+str(len(to_align))+"\n")
+        
+        # Align the queries which are not in the cache
+        if len(to_align) > 0:
             
+            if len(to_align) == len(queries_keys):
+                self._aligner.align(query_fasta, db, ref_type, threshold_id, threshold_cov)
+            else:
+                query_to_align = query_fasta.subset(to_align, self._tmp_files_dir)
+                try:
+                    self._aligner.align(query_to_align, db, ref_type, threshold_id, threshold_cov)
+                finally:
+                    query_to_align.remove()
+            
+            # Hits are stored in the cache without the query_id,
+            # since the same sequence could have a different id in other requests
+            aligned_hits = dict([(query_id, []) for query_id in to_align])
+            for hit in self._aligner.get_hits():
+                query_id = hit.get_query_id()
+                if query_id in aligned_hits:
+                    aligned_hits[query_id].append(self._get_hit_data(hit))
+            
+            to_align_set = set(to_align)
+            new_entries = dict([(key, aligned_hits[query_id])
+                                for query_id, key in queries_keys if query_id in to_align_set])
+            
+            # The hits of an alignment with errors are reported, but not stored
+            self._results_errors = self._aligner.has_errors()
+            if self._results_errors:
+                sys.stderr.write("CachedAligner: errors in alignment to "+str(db)+". Results will not be cached.\n")
+            else:
+                self._alignment_cache.store(new_entries)
+            
+            cached.update(new_entries)
+        
+        # Merge cached and new hits in the order of the fasta file
+        for query_id, key in queries_keys:
+            query_hits = cached[key]
+            if len(query_hits) == 0:
+                self._results_unaligned.append(query_id)
+            
+            for hit_data in query_hits:
+                self._results_hits.append(AlignmentResult(query_id, *hit_data))
+        
+        if self._verbose:
+            cache_stats = self._alignment_cache.get_stats()
+            sys.stderr.write("CachedAligner: cache stats "+\
+                             ", ".join([stat+" "+str(cache_stats[stat]) for stat in sorted(cache_stats)])+"\n")
+        
         return self.get_hits()
- 
-##
\ No newline at end of file
+    
+    def _get_hit_data(self, alignment_result):
+        return (alignment_result.get_subject_id(),
+                alignment_result.get_align_ident(), alignment_result.get_query_cov(),
+                alignment_result.get_align_score(), alignment_result.get_strand(),
+                alignment_result.get_qstart_pos(), alignment_result.get_qend_pos(),
+                alignment_result.get_local_position(), alignment_result.get_end_position(),
+                alignment_result.get_db_id(), alignment_result.get_algorithm())
+
+### Aligner which wraps another aligner, so that the queries which are
+### found as exact occurrences in the ExactMatchIndex of a DB are not aligned,
+### and their hits (algorithm "exact") are reported with the score that the
+### aligner reports for a perfect hit. The aligner of each query is the one
+### which would align it first (see AlignerRouting). The rest of queries,
+### and every query to a DB without index, are sent to the aligner.
+class ExactMatchAligner(BaseAligner):
+    _aligner = None
+    _aligner_routing = None
+    _exact_index_path = ""
+    _tmp_files_dir = ""
+    
+    def __init__(self, aligner, aligner_routing, exact_index_path, tmp_files_dir, verbose = False):
+        self._aligner = aligner
+        self._aligner_routing = aligner_routing
+        self._exact_index_path = exact_index_path
+        self._tmp_files_dir = tmp_files_dir
+        self._verbose = verbose
+    
+    def get_version(self):
+        return self._aligner.get_version()
+    
+    def align(self, query_fasta, db, ref_type, threshold_id, threshold_cov):
+        
+        self._results_hits = []
+        self._results_unaligned = []
+        self._results_errors = False
+        
+        index = ExactMatchIndex.ExactMatchIndexes.get_index(self._exact_index_path, db, self._verbose)
+        if index == None:
+            if self._verbose: sys.stderr.write("ExactMatchAligner: no exact match index for "+str(db)+"\n")
+            self._results_hits = self._aligner.align(query_fasta, db, ref_type, threshold_id, threshold_cov)
+            self._results_unaligned = self._aligner.get_unaligned()
+            self._results_errors = self._aligner.has_errors()
+            return self.get_hits()
+        
+        (exact_hits, to_align) = ExactMatchIndex.get_exact_hits(index, query_fasta, db, self._aligner_routing)
+        
+        sys.stderr.write("ExactMatchAligner: DB --> "+str(db)+"\n")
+        sys.stderr.write("ExactMatchAligner: exact "+str(query_fasta.get_num_queries() - len(to_align))+\
+                         ", to align "+str(len(to_align))+"\n")
+        
+        self._results_hits = exact_hits
+        
+        if len(to_align) > 0:
+            if len(to_align) == query_fasta.get_num_queries():
+                self._results_hits = self._aligner.align(query_fasta, db, ref_type, threshold_id, threshold_cov)
+            else:
+                query_to_align = query_fasta.subset(to_align, self._tmp_files_dir)
+                try:
+                    self._results_hits = exact_hits + self._aligner.align(query_to_align, db, ref_type, threshold_id, threshold_cov)
+                finally:
+                    query_to_align.remove()
+            
+            self._results_unaligned = self._aligner.get_unaligned()
+            self._results_errors = self._aligner.has_errors()
+        
+        return self.get_hits()
+
+### Aligner which wraps another aligner, so that each query is aligned
+### only to the DBs which share k-mers with it (see DBSketchFilter).
+### In audit mode, every query is aligned, and the filter reports
+### the queries with hits which would have been skipped.
+class SketchFilteredAligner(BaseAligner):
+    _aligner = None
+    _sketch_filter = None
+    _tmp_files_dir = ""
+    
+    def __init__(self, aligner, sketch_filter, tmp_files_dir, verbose = False):
+        self._aligner = aligner
+        self._sketch_filter = sketch_filter
+        self._tmp_files_dir = tmp_files_dir
+        self._verbose = verbose
+    
+    def get_version(self):
+        return self._aligner.get_version()
+    
+    def align(self, query_fasta, db, ref_type, threshold_id, threshold_cov):
+        
+        self._results_hits = []
+        self._results_unaligned = []
+        self._results_errors = False
+        
+        plausible = self._sketch_filter.get_plausible(query_fasta, db)
+        
+        if plausible == None or self._sketch_filter.is_audit() or len(plausible) == query_fasta.get_num_queries():
+            self._results_hits = self._aligner.align(query_fasta, db, ref_type, threshold_id, threshold_cov)
+            self._results_unaligned = self._aligner.get_unaligned()
+            self._results_errors = self._aligner.has_errors()
+            
+            if plausible != None and self._sketch_filter.is_audit():
+                self._sketch_filter.audit(db, plausible, self._results_hits)
+        
+        else:
+            if len(plausible) > 0:
+                query_to_align = query_fasta.subset(plausible, self._tmp_files_dir)
+                try:
+                    self._results_hits = self._aligner.align(query_to_align, db, ref_type, threshold_id, threshold_cov)
+                    unaligned = set(self._aligner.get_unaligned())
+                    self._results_errors = self._aligner.has_errors()
+                finally:
+                    query_to_align.remove()
+            else:
+                sys.stderr.write("SketchFilteredAligner: no query shares k-mers with "+str(db)+". Skipping DB.\n")
+                unaligned = set()
+            
+            # Skipped queries are reported as unaligned, in the order of the fasta
+            plausible = set(plausible)
+            self._results_unaligned = [query_id for query_id in query_fasta.get_ids()
+                                       if query_id not in plausible or query_id in unaligned]
+        
+        return self.get_hits()
+
+##
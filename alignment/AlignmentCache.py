@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# AlignmentCache.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import sys, time, hashlib, sqlite3
+import cPickle
+
+# Max number of keys in each SQL query
+SQL_BATCH_SIZE = 500
+# Time (seconds) to wait for other processes holding the cache lock
+LOCK_TIMEOUT = 60
+# When the max size is exceeded, entries are evicted down to this fraction of it
+EVICTION_TARGET = 0.9
+
+### On-disk cache of alignments.
+### Each entry stores the hits of a single query sequence to a DB,
+### and is keyed by the hash of the sequence, the DB, the aligner
+### (and its version) and the thresholds used. An entry with no hits
+### means that the query was not aligned.
+### Entries are stored in a SQLite file, so that it can be safely
+### shared by several worker processes, and least recently used
+### entries are evicted once the cache exceeds its max size (bytes).
+class AlignmentCache(object):
+    
+    _cache_path = ""
+    _max_size = 0
+    _verbose = False
+    
+    # Counters of this instance
+    _hits = 0
+    _misses = 0
+    _evictions = 0
+    
+    # Counters stored in the cache file (shared by all processes)
+    STAT_HITS = "hits"
+    STAT_MISSES = "misses"
+    STAT_EVICTIONS = "evictions"
+    
+    def __init__(self, cache_path, max_size, verbose = False):
+        self._cache_path = cache_path
+        self._max_size = max_size
+        self._verbose = verbose
+        
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        
+        conn = self._connect()
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS entries "+\
+                         "(key TEXT PRIMARY KEY, hits BLOB, size INTEGER, last_access REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_access ON entries (last_access)")
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+            for stat in [self.STAT_HITS, self.STAT_MISSES, self.STAT_EVICTIONS]:
+                conn.execute("INSERT OR IGNORE INTO stats VALUES (?, 0)", (stat,))
+        finally:
+            conn.close()
+    
+    def _connect(self):
+        # isolation_level None: transactions are explicitly opened with BEGIN IMMEDIATE
+        conn = sqlite3.connect(self._cache_path, timeout = LOCK_TIMEOUT, isolation_level = None)
+        conn.text_factory = str
+        return conn
+    
+    @staticmethod
+    def get_sequence_hash(sequence):
+        return hashlib.sha1(sequence.upper()).hexdigest()
+    
+    @staticmethod
+    def get_key(seq_hash, db, aligner, threshold_id, threshold_cov, aligner_version):
+        key_data = "\t".join([seq_hash, str(db), str(aligner),
+                              str(float(threshold_id)), str(float(threshold_cov)), str(aligner_version)])
+        return hashlib.sha1(key_data).hexdigest()
+    
+    # Returns a dict key --> list of hits,
+    # only for those keys which are in the cache
+    def lookup(self, keys):
+        found = {}
+        
+        keys = list(set(keys))
+        
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                for i in xrange(0, len(keys), SQL_BATCH_SIZE):
+                    batch = keys[i:i+SQL_BATCH_SIZE]
+                    placeholders = ",".join(["?"]*len(batch))
+                    cursor = conn.execute("SELECT key, hits FROM entries WHERE key IN ("+placeholders+")", batch)
+                    for key, hits in cursor:
+                        found[key] = cPickle.loads(str(hits))
+                    
+                    conn.execute("UPDATE entries SET last_access = ? WHERE key IN ("+placeholders+")", [now]+batch)
+                
+                self._update_stats(conn, {self.STAT_HITS:len(found), self.STAT_MISSES:len(keys)-len(found)})
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        
+        self._hits += len(found)
+        self._misses += len(keys) - len(found)
+        
+        return found
+    
+    # entries: dict key --> list of hits
+    def store(self, entries):
+        
+        if len(entries) == 0: return
+        
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                for key in entries:
+                    hits = cPickle.dumps(entries[key], cPickle.HIGHEST_PROTOCOL)
+                    conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                                 (key, sqlite3.Binary(hits), len(key)+len(hits), now))
+                
+                self._evict(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        
+        return
+    
+    # Removes least recently used entries if the cache is over its max size
+    def _evict(self, conn):
+        
+        if self._max_size <= 0: return # no size limit
+        
+        cache_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        
+        if cache_size <= self._max_size: return
+        
+        target_size = self._max_size * EVICTION_TARGET
+        
+        evicted = []
+        cursor = conn.execute("SELECT key, size FROM entries ORDER BY last_access")
+        for key, size in cursor:
+            if cache_size <= target_size: break
+            evicted.append(key)
+            cache_size -= size
+        
+        for i in xrange(0, len(evicted), SQL_BATCH_SIZE):
+            batch = evicted[i:i+SQL_BATCH_SIZE]
+            conn.execute("DELETE FROM entries WHERE key IN ("+",".join(["?"]*len(batch))+")", batch)
+        
+        self._update_stats(conn, {self.STAT_EVICTIONS:len(evicted)})
+        self._evictions += len(evicted)
+        
+        if self._verbose: sys.stderr.write("AlignmentCache: evicted "+str(len(evicted))+" entries.\n")
+        
+        return
+    
+    def _update_stats(self, conn, stats_increments):
+        for stat in stats_increments:
+            conn.execute("UPDATE stats SET value = value + ? WHERE name = ?", (stats_increments[stat], stat))
+        return
+    
+    # Counters of this instance
+    def get_stats(self):
+        return {self.STAT_HITS:self._hits, self.STAT_MISSES:self._misses, self.STAT_EVICTIONS:self._evictions}
+    
+    # Counters of all the processes which have used the cache file
+    def get_global_stats(self):
+        conn = self._connect()
+        try:
+            global_stats = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+        finally:
+            conn.close()
+        
+        return global_stats
+
+## END
@@ -5,32 +5,47 @@
 # Copyright (C)  2017  Carlos P Cantalapiedra.
 # (terms of use can be found within the distributed LICENSE file).
 
+import sys, time
+from multiprocessing.pool import ThreadPool
+
 from barleymapcore.m2p_exception import m2pException
 from barleymapcore.db.MapsConfig import MapsConfig
+from barleymapcore.utils.process_utils import ProcessGroup
 from Aligners import *
-from AlignmentResult import AlignmentResults
+import ExactMatchIndex
+from AlignmentResult import AlignmentResults, ColumnarAlignmentResults, ALIGNMENT_SORT_KEY
+from AlignmentCache import AlignmentCache
+from QueryFasta import load_query_fasta
+from QueryDuplicates import QueryDuplicates
+from DBOrderPlanner import DBOrderPlanner
+from DBSketches import DBSketchFilter
 
 ALIGNMENT_TYPE_GREEDY = "greedy"
 ALIGNMENT_TYPE_HIERARCHICAL = "hierarchical"
 ALIGNMENT_TYPE_BEST_SCORE = "best_score"
 
+# Min number of hits to use ColumnarAlignmentResults (if NumPy is available)
+COLUMNAR_MIN_RESULTS = 100000
+
 class AlignmentEnginesFactory(object):
     @staticmethod
-    def get_alignment_engine(search_type, aligner_list, paths_config, ref_type_param, n_threads, verbose):
+    def get_alignment_engine(search_type, aligner_list, paths_config, ref_type_param, n_threads, verbose, n_jobs = 1):
         
         alignment_engine = None
         
         if search_type == ALIGNMENT_TYPE_GREEDY:
             
-            alignment_engine = GreedyEngine(aligner_list, paths_config, ref_type_param, n_threads, verbose)
+            alignment_engine = GreedyEngine(aligner_list, paths_config, ref_type_param, n_threads, verbose, n_jobs)
             
         elif search_type == ALIGNMENT_TYPE_HIERARCHICAL:
             
+            # DBs are aligned one after another by definition,
+            # so n_jobs does not apply to this engine
             alignment_engine = HierarchicalEngine(aligner_list, paths_config, ref_type_param, n_threads, verbose)
             
         elif search_type == ALIGNMENT_TYPE_BEST_SCORE:
             
-            alignment_engine = BestScoreEngine(aligner_list, paths_config, ref_type_param, n_threads, verbose)
+            alignment_engine = BestScoreEngine(aligner_list, paths_config, ref_type_param, n_threads, verbose, n_jobs)
             
         else:
             raise m2pException("Unrecognized search type "+search_type+".")
@@ -44,30 +59,146 @@ class AlignmentEngine(object):
     _paths_config = None
     _ref_type_param = ""
     _n_threads = -1
+    _n_jobs = 1 # number of DBs aligned concurrently
     _verbose = False
     
+    _aligner_list = None
+    _aligner_routing = None
     _aligner = None
     
-    def __init__(self, aligner_list, paths_config, ref_type_param, n_threads, verbose):
+    _db_stats = None # DBStatsStore, if the DBs order planner is enabled
+    _sketch_filter = None # DBSketchFilter, if queries are filtered by the sketches of the DBs
+    
+    def __init__(self, aligner_list, paths_config, ref_type_param, n_threads, verbose, n_jobs = 1):
         self._paths_config = paths_config
         self._ref_type_param = ref_type_param
         self._n_threads = n_threads
+        self._n_jobs = n_jobs
         self._verbose = verbose
         
+        db_order_planner = DBOrderPlanner.from_paths_config(paths_config, verbose)
+        if db_order_planner != None:
+            self._db_stats = db_order_planner.get_stats_store()
+        
+        self._sketch_filter = DBSketchFilter.from_paths_config(paths_config, verbose)
+        
         self._load_aligner(aligner_list)
     
+    def _create_aligner(self, aligner_list, n_threads):
+        
+        aligner = AlignersFactory.get_aligner(aligner_list, n_threads, self._paths_config, self._verbose)
+        
+        # Persistent cache of alignments, if configured
+        cache_path = self._paths_config.get_alignment_cache_path()
+        if cache_path:
+            alignment_cache = AlignmentCache(cache_path, self._paths_config.get_alignment_cache_size(), self._verbose)
+            aligner = CachedAligner(aligner, self._aligner_routing.get_name(), alignment_cache,
+                                    self._paths_config.get_tmp_files_path(), self._verbose)
+        
+        # Queries found as exact occurrences in the DBs are not aligned, if configured.
+        # Outside the cache, so that the cached hits are always those of the aligners,
+        # whether an exact match index is configured or not.
+        exact_index_path = self._paths_config.get_exact_index_path()
+        if exact_index_path:
+            aligner = ExactMatchAligner(aligner, self._aligner_routing, exact_index_path,
+                                        self._paths_config.get_tmp_files_path(), self._verbose)
+        
+        # Queries not aligned to the DBs with which they share no k-mers, if configured
+        if self._sketch_filter != None:
+            aligner = SketchFilteredAligner(aligner, self._sketch_filter,
+                                            self._paths_config.get_tmp_files_path(), self._verbose)
+        
+        return aligner
+    
     def _load_aligner(self, aligner_list):
         self._aligner = None # reset aligner
+        self._aligner_list = aligner_list
+        self._aligner_routing = AlignerRouting(aligner_list, self._paths_config.get_aligner_routing(),
+                                               self._paths_config.get_aligner_routing_length())
         
-        aligner = AlignersFactory.get_aligner(aligner_list, self._n_threads, self._paths_config, self._verbose)
+        aligner = self._create_aligner(aligner_list, self._n_threads)
         
         self._aligner = aligner
         
         return
     
-    def perform_alignment(self, query_fasta_path, dbs_list, databases_config, threshold_id, threshold_cov):
+    # Aligns the queries (QueryFasta) to a single DB.
+    # Returns the hits, or None if the aligner failed for this DB
+    def _align_db(self, aligner, query_fasta, db, databases_config, threshold_id, threshold_cov):
+        
+        # Obtain ref_type of current database
+        ref_type = self.get_reftype(db, databases_config)
+        
+        try:
+            ## Alignment of fasta sequences to the DB
+            ##
+            start_time = time.time()
+            hits = aligner.align(query_fasta, db, ref_type, threshold_id, threshold_cov)
+            
+            if self._db_stats != None:
+                num_aligned = len(set([hit.get_query_id() for hit in hits]))
+                self._record_db_stats(db, query_fasta.get_num_queries(), num_aligned, time.time() - start_time)
+            
+        except m2pException as m2pe:
+            sys.stderr.write("\t"+m2pe.msg+"\n")
+            sys.stderr.write("\tContinuing with alignments to next DB...\n")
+            hits = None
+        
+        return hits
+    
+    # Statistics for the DBs order planner (see DBOrderPlanner)
+    def _record_db_stats(self, db, num_queries, num_aligned, seconds):
+        try:
+            self._db_stats.record(db, self._aligner_list, num_queries, num_aligned, seconds)
+        except Exception as e:
+            sys.stderr.write("AlignmentEngine: statistics of "+db+" could not be recorded. "+str(e)+"\n")
+        
+        return
+    
+    # Aligns the queries (QueryFasta) to every DB in dbs_list.
+    # If n_jobs > 1, up to n_jobs DBs are aligned concurrently, each one
+    # with its own aligner and a share of n_threads.
+    # Hits are returned in the order of dbs_list in both cases,
+    # so that results are the same than those of the sequential run.
+    def _align_dbs(self, query_fasta, dbs_list, databases_config, threshold_id, threshold_cov):
+        results = []
+        
+        n_jobs = min(self._n_jobs, len(dbs_list))
+        
+        if n_jobs > 1:
+            job_threads = max(1, self._n_threads / n_jobs)
+            
+            if self._verbose: sys.stderr.write("AlignmentEngine: aligning to "+str(len(dbs_list))+" DBs with "+\
+                                               str(n_jobs)+" jobs of "+str(job_threads)+" threads each.\n")
+            
+            def align_job(db):
+                # Aligners keep the results of the last alignment,
+                # so each job needs its own aligner
+                aligner = self._create_aligner(self._aligner_list, job_threads)
+                return self._align_db(aligner, query_fasta, db, databases_config, threshold_id, threshold_cov)
+            
+            pool = ThreadPool(n_jobs)
+            try:
+                dbs_hits = pool.map(ProcessGroup.propagate(align_job), dbs_list)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            dbs_hits = [self._align_db(self._aligner, query_fasta, db, databases_config, threshold_id, threshold_cov)
+                        for db in dbs_list]
+        
+        for hits in dbs_hits:
+            if hits != None: results.extend(hits)
+        
+        return results
+    
+    # query_fasta: a QueryFasta, or the path to a fasta file
+    def perform_alignment(self, query_fasta, dbs_list, databases_config, threshold_id, threshold_cov):
         raise m2pException("SearchEngine is an abstract class. 'perform_alignment' must be implemented in a child class.")
     
+    def get_sketch_filter(self):
+        return self._sketch_filter
+    
     def get_alignment_results(self, ):
         return self._alignment_results
     
@@ -82,9 +213,56 @@ class AlignmentEngine(object):
             
         return ref_type
     
+    # Queries with the same sequence are aligned only once, if configured
+    def _deduplicate(self, query_fasta):
+        
+        query_dedup = QueryDuplicates(query_fasta, self._paths_config.get_tmp_files_path(),
+                                      self._paths_config.get_query_dedup(), self._verbose)
+        
+        return query_dedup
+    
+    # Large lists of hits are converted to ColumnarAlignmentResults,
+    # so that filtering and sorting them is vectorized
+    def _columnar_results(self, results):
+        
+        if len(results) >= COLUMNAR_MIN_RESULTS and ColumnarAlignmentResults.is_available():
+            if self._verbose: sys.stderr.write("AlignmentEngine: using columnar results for "+str(len(results))+" hits.\n")
+            results = ColumnarAlignmentResults(results, [])
+        
+        return results
+    
+    def _create_alignment_results(self, results, unaligned):
+        
+        if isinstance(results, ColumnarAlignmentResults):
+            results.set_unaligned(unaligned)
+            alignment_results = results
+        else:
+            alignment_results = AlignmentResults(results, unaligned)
+        
+        return alignment_results
+    
+    def _get_unaligned(self, query_fasta, results):
+        
+        if isinstance(results, ColumnarAlignmentResults):
+            no_redundant_results = set(results.get_query_ids())
+        else:
+            no_redundant_results = set()
+            #for db in self._alignment_results:
+            for alignment_result in results:#self._alignment_results[db]:
+                query_id = alignment_result.get_query_id()
+                if query_id not in no_redundant_results:
+                    no_redundant_results.add(query_id)
+        
+        unaligned = query_fasta.get_unaligned(no_redundant_results)
+        
+        return unaligned
+    
     # Best score across all databases
     #
     def _best_score(self, results):
+        
+        if isinstance(results, ColumnarAlignmentResults): return results.best_score()
+        
         ###### best score filtering
         # chooses the best score from alignments
         # to ALL databases for a given query
@@ -94,7 +272,7 @@ class AlignmentEngine(object):
         for alignment_result in results:
             query_id = alignment_result.get_query_id()
             
-            align_score = float(alignment_result.get_align_score())
+            align_score = alignment_result.get_align_score()
             
             if query_id in best_score_filtering:
                 query_best = best_score_filtering[query_id]
@@ -124,6 +302,9 @@ class AlignmentEngine(object):
     ## where the AlignmentResults are iterated once, so call this function
     ## only if necessary, since involves a new iteration over all results
     def _best_db_score(self, results):
+        
+        if isinstance(results, ColumnarAlignmentResults): return results.best_db_score()
+        
         ###### best score filtering
         # chooses the best score from alignments
         # to each database for a given query
@@ -140,7 +321,7 @@ class AlignmentEngine(object):
                 db_best = {}
                 best_score_filtering[db_id] = db_best
             
-            align_score = float(alignment_result.get_align_score())
+            align_score = alignment_result.get_align_score()
             
             if query_id in db_best:
                 query_best_score = db_best[query_id]["best_score"]
@@ -166,58 +347,39 @@ class AlignmentEngine(object):
         return best_results
     
     def _sort_results(self, results):
-        sorted_results = sorted(results, key=lambda x:(x.get_query_id(),x.get_subject_id(),
-                                                       x.get_local_position(),x.get_end_position()))
+        
+        if isinstance(results, ColumnarAlignmentResults): return results.sort_results()
+        
+        sorted_results = sorted(results, key=ALIGNMENT_SORT_KEY)
         
         return sorted_results
 
 class GreedyEngine(AlignmentEngine):
     
-    def _get_unaligned(self, query_fasta_path, results):
+    def perform_alignment(self, query_fasta, dbs_list, databases_config, threshold_id, threshold_cov):
         
-        fasta_headers = alignment_utils.get_fasta_headers(query_fasta_path)
-        no_redundant_results = set()
-        #for db in self._alignment_results:
-        for alignment_result in results:#self._alignment_results[db]:
-            query_id = alignment_result.get_query_id()
-            if query_id not in no_redundant_results:
-                no_redundant_results.add(query_id)
-        
-        unaligned = alignment_utils.filter_list(fasta_headers, no_redundant_results)
-        
-        return unaligned
-    
-    def perform_alignment(self, query_fasta_path, dbs_list, databases_config, threshold_id, threshold_cov):
-        
-        fasta_to_align = query_fasta_path
+        query_fasta = load_query_fasta(query_fasta, self._paths_config.get_query_subsets_in_memory())
         
         results = []
         
         if self._verbose: sys.stderr.write("GreedyEngine: performing alignment...\n")
         
-        # Create a record for each DB
-        for db in dbs_list:
-            
-            # Obtain ref_type of current database
-            ref_type = self.get_reftype(db, databases_config)
-            
-            try:
-                ## Alignment of fasta sequences to the DB
-                ##
-                hits = self._aligner.align(fasta_to_align, db, ref_type, threshold_id, threshold_cov)
-                
-                results.extend(hits)
-                
-            except m2pException as m2pe:
-                sys.stderr.write("\t"+m2pe.msg+"\n")
-                sys.stderr.write("\tContinuing with alignments to next DB...\n")
+        query_dedup = self._deduplicate(query_fasta)
+        try:
+            # Create a record for each DB
+            results = self._align_dbs(query_dedup.get_representatives(), dbs_list, databases_config, threshold_id, threshold_cov)
+        finally:
+            query_dedup.remove()
+        
+        results = query_dedup.fan_out(results)
+        results = self._columnar_results(results)
         
         results = self._sort_results(results)
         
         ## Recover unmapped queries
-        unaligned = self._get_unaligned(query_fasta_path, results)
+        unaligned = self._get_unaligned(query_fasta, results)
         
-        alignment_results = AlignmentResults(results, unaligned) # reset alignment results
+        alignment_results = self._create_alignment_results(results, unaligned) # reset alignment results
         
         return alignment_results
 
@@ -226,15 +388,18 @@ class GreedyEngine(AlignmentEngine):
 ## in subsequent DBs
 class HierarchicalEngine(AlignmentEngine):
     
-    def perform_alignment(self, query_fasta_path, dbs_list, databases_config, threshold_id, threshold_cov):
+    def perform_alignment(self, query_fasta, dbs_list, databases_config, threshold_id, threshold_cov):
         
-        fasta_to_align = query_fasta_path
+        query_fasta = load_query_fasta(query_fasta, self._paths_config.get_query_subsets_in_memory())
         
         results = []
         
         if self._verbose: sys.stderr.write("HierarchicalEngine: performing alignment...\n")
         
-        tmp_files_list = []
+        query_dedup = self._deduplicate(query_fasta)
+        query_to_align = query_dedup.get_representatives()
+        
+        subsets_list = []
         tmp_files_dir = self._paths_config.get_tmp_files_path()
         try:
             for db in dbs_list:
@@ -242,19 +407,24 @@ class HierarchicalEngine(AlignmentEngine):
                 ref_type = self.get_reftype(db, databases_config)
                 
                 try:
-                    db_hits = self._aligner.align(fasta_to_align, db, ref_type, threshold_id, threshold_cov)
+                    start_time = time.time()
+                    db_hits = self._aligner.align(query_to_align, db, ref_type, threshold_id, threshold_cov)
                     
                     results.extend(db_hits)
                     
                     ## Recover unmapped queries if needed
                     unmapped = self._aligner.get_unaligned()
                     
+                    if self._db_stats != None:
+                        num_queries = query_to_align.get_num_queries()
+                        self._record_db_stats(db, num_queries, num_queries - len(unmapped), time.time() - start_time)
+                    
                     if len(unmapped) > 0:
-                        fasta_to_align = alignment_utils.extract_fasta_headers(fasta_to_align, unmapped, tmp_files_dir)
-                        tmp_files_list.append(fasta_to_align)
+                        query_to_align = query_to_align.subset(unmapped, tmp_files_dir)
+                        subsets_list.append(query_to_align)
                     else:
                         break # Once all queries have been found in DBs
-                    # else: fasta_to_align = fasta_path
+                    # else: query_to_align = query_fasta
                 except m2pException as m2pe:
                     sys.stderr.write("\t"+m2pe.msg+"\n")
                     sys.stderr.write("\tContinuing with alignments to next DB...\n")
@@ -262,67 +432,187 @@ class HierarchicalEngine(AlignmentEngine):
         except Exception:
             raise
         finally:
-            for tmp_file in tmp_files_list:
-                os.remove(tmp_file)
+            for query_subset in subsets_list:
+                query_subset.remove()
+            query_dedup.remove()
         
+        results = query_dedup.fan_out(results)
+        results = self._columnar_results(results)
         results = self._sort_results(results)
         
         ## Recover unmapped queries from last DB which was queried
-        unaligned = self._aligner.get_unaligned()
+        unaligned = query_dedup.fan_out_ids(self._aligner.get_unaligned())
         
-        alignment_results = AlignmentResults(results, unaligned) # reset alignment results
+        alignment_results = self._create_alignment_results(results, unaligned) # reset alignment results
         
         return alignment_results
 
+## This Engine aligns the queries to every database,
+## and keeps the hits with the best score of each query across all of them.
+##
+## Early exit (best_score_early_exit in paths config): a query with a hit of
+## 100% identity over its whole length has the maximal score which the aligner
+## can report for it, so the only hits which it can have in the subsequent DBs
+## and are kept by the best score are ties at that score: other hits of 100%
+## identity over the whole query. These are looked up in the exact match index
+## of each DB (exact_index_path in paths config), and a DB is skipped for the
+## queries which do not occur in it, since a tie there is impossible. Queries which
+## can not be resolved with the index, and those of DBs without index, are aligned,
+## and only their hits tied at the best score are kept. Therefore, the results are
+## the same than those of the exhaustive search, in the order of the DBs given.
+## DBs are aligned one after another, so n_jobs does not apply. Since the scores
+## of different aligners are not comparable, early exit requires a single aligner.
+## It requires also the exact match index: without it, every query with a perfect hit
+## would be aligned again to each of the subsequent DBs to search its ties, which saves
+## nothing. Otherwise, a warning is written and the queries are aligned to every DB.
+## The DBs are not reordered (e.g. by their rate of perfect hits) in early exit:
+## they are aligned in the order given.
 class BestScoreEngine(AlignmentEngine):
     
-    def _get_unaligned(self, query_fasta_path, results):
+    def perform_alignment(self, query_fasta, dbs_list, databases_config, threshold_id, threshold_cov):
         
-        fasta_headers = alignment_utils.get_fasta_headers(query_fasta_path)
-        no_redundant_results = set()
-        #for db in self._alignment_results:
-        for alignment_result in results:#self._alignment_results[db]:
-            query_id = alignment_result.get_query_id()
-            if query_id not in no_redundant_results:
-                no_redundant_results.add(query_id)
+        query_fasta = load_query_fasta(query_fasta, self._paths_config.get_query_subsets_in_memory())
         
-        unaligned = alignment_utils.filter_list(fasta_headers, no_redundant_results)
+        results = []
         
-        return unaligned
-    
-    def perform_alignment(self, query_fasta_path, dbs_list, databases_config, threshold_id, threshold_cov):
+        if self._verbose: sys.stderr.write("BestScoreEngine: performing alignment...\n")
         
-        fasta_to_align = query_fasta_path
+        early_exit = self._paths_config.get_best_score_early_exit()
+        if early_exit and len(self._aligner_list) > 1:
+            sys.stderr.write("BestScoreEngine: early exit requires a single aligner, "+\
+                             "since scores of different aligners are not comparable. Aligning to every DB.\n")
+            early_exit = False
         
-        results = []
+        if early_exit and not self._paths_config.get_exact_index_path():
+            sys.stderr.write("BestScoreEngine: early exit requires an exact match index (exact_index_path), "+\
+                             "to search the ties of the queries with perfect hits. Aligning to every DB.\n")
+            early_exit = False
         
-        if self._verbose: sys.stderr.write("BestScoreEngine: performing alignment...\n")
+        query_dedup = self._deduplicate(query_fasta)
+        try:
+            if early_exit:
+                results = self._align_dbs_early_exit(query_dedup.get_representatives(), dbs_list, databases_config,
+                                                     threshold_id, threshold_cov)
+            else:
+                # Create a record for each DB
+                results = self._align_dbs(query_dedup.get_representatives(), dbs_list, databases_config, threshold_id, threshold_cov)
+        finally:
+            query_dedup.remove()
         
-        # Create a record for each DB
-        for db in dbs_list:
-            
-            # Obtain ref_type of current database
-            ref_type = self.get_reftype(db, databases_config)
-            
-            try:
-                ## Alignment of fasta sequences to the DB
-                ##
-                hits = self._aligner.align(fasta_to_align, db, ref_type, threshold_id, threshold_cov)
-                
-                results.extend(hits)
-                
-            except m2pException as m2pe:
-                sys.stderr.write("\t"+m2pe.msg+"\n")
-                sys.stderr.write("\tContinuing with alignments to next DB...\n")
+        results = query_dedup.fan_out(results)
+        results = self._columnar_results(results)
         
         results = self._best_score(results)
         results = self._sort_results(results)
         
         ## Recover unmapped queries
-        unaligned = self._get_unaligned(query_fasta_path, results)
+        unaligned = self._get_unaligned(query_fasta, results)
         
-        alignment_results = AlignmentResults(results, unaligned) # reset alignment results
+        alignment_results = self._create_alignment_results(results, unaligned) # reset alignment results
         
         return alignment_results
+    
+    # Aligns the queries (QueryFasta) to the DBs one after another.
+    # Queries with a perfect hit are not aligned as the rest to the next DBs,
+    # but only their ties at the best score are searched (see _align_perfect_queries)
+    def _align_dbs_early_exit(self, query_fasta, dbs_list, databases_config, threshold_id, threshold_cov):
+        results = []
+        
+        best_scores = {} # query with a perfect hit --> its best score
+        
+        query_to_align = query_fasta
+        perfect_fasta = None
+        subsets_list = []
+        tmp_files_dir = self._paths_config.get_tmp_files_path()
+        try:
+            for db in dbs_list:
+                if perfect_fasta != None:
+                    results.extend(self._align_perfect_queries(perfect_fasta, db, databases_config,
+                                                               threshold_id, threshold_cov, best_scores))
+                
+                if query_to_align == None: continue # Every query has a perfect hit already
+                
+                hits = self._align_db(self._aligner, query_to_align, db, databases_config, threshold_id, threshold_cov)
+                if hits == None: continue
+                
+                results.extend(hits)
+                
+                perfect = self._get_perfect_queries(query_to_align, hits)
+                
+                if self._verbose: sys.stderr.write("BestScoreEngine: "+str(len(perfect))+" of "+\
+                                                   str(query_to_align.get_num_queries())+" queries with perfect hits in "+db+"\n")
+                
+                if len(perfect) == 0: continue
+                
+                for hit in hits:
+                    query_id = hit.get_query_id()
+                    if query_id in perfect:
+                        best_scores[query_id] = max(best_scores.get(query_id, hit.get_align_score()), hit.get_align_score())
+                
+                perfect_fasta = query_fasta.subset(best_scores.keys(), tmp_files_dir)
+                subsets_list.append(perfect_fasta)
+                
+                remaining = [query_id for query_id in query_to_align.get_ids() if query_id not in perfect]
+                if len(remaining) > 0:
+                    query_to_align = query_to_align.subset(remaining, tmp_files_dir)
+                    subsets_list.append(query_to_align)
+                else:
+                    query_to_align = None
+        finally:
+            for query_subset in subsets_list:
+                query_subset.remove()
+        
+        return results
+    
+    # Hits in the DB of the queries with a perfect hit in a previous DB (QueryFasta)
+    # which tie their best score (best_scores: query id --> score).
+    # If the DB has an exact match index, the queries which do not occur in it are
+    # not aligned, since they can not have a tie there. Queries filtered by the sketches
+    # of the DBs are aligned, so that they are filtered as in the exhaustive search.
+    def _align_perfect_queries(self, perfect_fasta, db, databases_config, threshold_id, threshold_cov, best_scores):
+        
+        index = None
+        exact_index_path = self._paths_config.get_exact_index_path()
+        if exact_index_path and (self._sketch_filter == None or self._sketch_filter.is_audit()):
+            index = ExactMatchIndex.ExactMatchIndexes.get_index(exact_index_path, db, self._verbose)
+        
+        if index != None:
+            (hits, unresolved) = ExactMatchIndex.get_exact_hits(index, perfect_fasta, db, self._aligner_routing,
+                                                                resolve_absent = True)
+        else:
+            (hits, unresolved) = ([], perfect_fasta.get_ids())
+        
+        if self._verbose: sys.stderr.write("BestScoreEngine: "+str(perfect_fasta.get_num_queries() - len(unresolved))+\
+                                           " queries with perfect hits resolved with the exact match index of "+db+\
+                                           ", to align "+str(len(unresolved))+"\n")
+        
+        if len(unresolved) > 0:
+            if len(unresolved) == perfect_fasta.get_num_queries():
+                query_to_align = perfect_fasta
+            else:
+                query_to_align = perfect_fasta.subset(unresolved, self._paths_config.get_tmp_files_path())
+            
+            try:
+                aligned_hits = self._align_db(self._aligner, query_to_align, db, databases_config, threshold_id, threshold_cov)
+            finally:
+                if query_to_align is not perfect_fasta: query_to_align.remove()
+            
+            if aligned_hits != None: hits = hits + aligned_hits
+        
+        tie_hits = [hit for hit in hits if hit.get_align_score() >= best_scores[hit.get_query_id()]]
+        
+        return tie_hits
+    
+    # Queries with a hit of 100% identity from the first to the last base of the query
+    def _get_perfect_queries(self, query_fasta, hits):
+        perfect = set()
+        
+        for hit in hits:
+            if hit.get_align_ident() >= 100.0 and hit.get_qstart_pos() == 1:
+                query_id = hit.get_query_id()
+                if hit.get_qend_pos() == query_fasta.get_seq_len(query_id):
+                    perfect.add(query_id)
+        
+        return perfect
 
 ## END
\ No newline at end of file
@@ -12,6 +12,7 @@ from barleymapcore.db.DatabasesConfig import REF_TYPE_STD
 
 from AlignmentEngines import AlignmentEnginesFactory
 from AlignmentResult import AlignmentResults, AlignmentResult
+from AlignmentRequest import AlignmentRequest
 
 class AlignmentFacade():
     
@@ -78,22 +79,53 @@ class AlignmentFacade():
         self._alignment_results = alignment_results
         return alignment_results
     
-    # Performs the alignment of fasta sequences different DBs
-    def perform_alignment(self, query_fasta_path, dbs_list, databases_config, search_type, aligner_list, \
-                          threshold_id = 98, threshold_cov = 95, n_threads = 1, ref_type_param = REF_TYPE_STD):
+    def _align(self, query_fasta, dbs_list, databases_config, search_type, aligner_list, \
+               threshold_id, threshold_cov, n_threads, ref_type_param, n_jobs):
         
         ## Create the SearchEngine (greedy, hierarchical, exhaustive searches on top of splitblast, gmap,...)
+        ## n_jobs: number of DBs to be aligned concurrently (n_threads are split among them)
         alignment_engine = AlignmentEnginesFactory.get_alignment_engine(search_type, aligner_list, self._paths_config, 
-                                                               ref_type_param, n_threads, self._verbose)
+                                                               ref_type_param, n_threads, self._verbose, n_jobs)
         
         ## Perform the search and alignments
-        alignment_results = alignment_engine.perform_alignment(query_fasta_path, dbs_list, databases_config, threshold_id, threshold_cov)
+        alignment_results = alignment_engine.perform_alignment(query_fasta, dbs_list, databases_config, threshold_id, threshold_cov)
+        
+        return alignment_results
+    
+    # Performs the alignment of fasta sequences different DBs
+    # query_fasta: a QueryFasta (indexed once and shared by engines and aligners)
+    # or the path to the fasta file
+    def perform_alignment(self, query_fasta, dbs_list, databases_config, search_type, aligner_list, \
+                          threshold_id = 98, threshold_cov = 95, n_threads = 1, ref_type_param = REF_TYPE_STD, n_jobs = 1):
+        
+        alignment_results = self._align(query_fasta, dbs_list, databases_config, search_type, aligner_list,
+                                        threshold_id, threshold_cov, n_threads, ref_type_param, n_jobs)
         
         self._alignment_results = alignment_results
         
         return alignment_results
     
+    # Performs the alignment in the background, with the same parameters than perform_alignment.
+    # Returns an AlignmentRequest at once, whose get_results() returns the AlignmentResults.
+    # timeout: seconds after which the request is cancelled (None: no timeout)
+    # callback: function called with the AlignmentRequest once it has finished
+    # Several requests can be submitted at the same time. Their results are not
+    # kept as the alignment results of the facade (see get_alignment_results).
+    def submit_alignment(self, query_fasta, dbs_list, databases_config, search_type, aligner_list, \
+                         threshold_id = 98, threshold_cov = 95, n_threads = 1, ref_type_param = REF_TYPE_STD, n_jobs = 1, \
+                         timeout = None, callback = None):
+        
+        align_function = lambda: self._align(query_fasta, dbs_list, databases_config, search_type, aligner_list,
+                                             threshold_id, threshold_cov, n_threads, ref_type_param, n_jobs)
+        
+        alignment_request = AlignmentRequest(align_function, timeout, callback, self._verbose)
+        
+        return alignment_request.start()
+    
     def get_alignment_results(self):
         return self._alignment_results
     
+    def get_paths_config(self):
+        return self._paths_config
+
 ## END
\ No newline at end of file
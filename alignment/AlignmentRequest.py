@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# AlignmentRequest.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import sys, time, threading
+
+from barleymapcore.m2p_exception import m2pException
+from barleymapcore.utils.process_utils import ProcessGroup
+
+### An alignment which runs in the background (see AlignmentFacade.submit_alignment),
+### so that the caller (e.g. a web server) is not blocked while the aligners run,
+### and the aligners of several requests run concurrently in the same process.
+### The alignment itself is performed by the same engines and aligners
+### than AlignmentFacade.perform_alignment, so the results are the same.
+### The aligner processes of the request are killed if it is cancelled
+### or if its timeout expires. Note that a GMAP worker (see AlignerWorkers)
+### which is serving the request is not killed, since it is shared.
+class AlignmentRequest(object):
+    
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CANCELLED = "cancelled"
+    STATUS_TIMED_OUT = "timed_out"
+    
+    _align_function = None
+    _timeout = None
+    _callback = None
+    _verbose = False
+    
+    _status = STATUS_RUNNING
+    _results = None
+    _error = None
+    _process_group = None
+    _thread = None
+    _timer = None
+    _lock = None
+    _done_event = None
+    _start_time = 0
+    _end_time = None
+    
+    # align_function: function without arguments which returns the AlignmentResults
+    # timeout: seconds after which the request is cancelled (None: no timeout)
+    # callback: function called with this request once it has finished
+    # (successfully or not), from the thread which finished it
+    def __init__(self, align_function, timeout = None, callback = None, verbose = False):
+        self._align_function = align_function
+        self._timeout = timeout
+        self._callback = callback
+        self._verbose = verbose
+        
+        self._status = self.STATUS_RUNNING
+        self._process_group = ProcessGroup()
+        self._lock = threading.Lock()
+        self._done_event = threading.Event()
+    
+    def start(self):
+        self._start_time = time.time()
+        
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        
+        if self._timeout != None:
+            self._timer = threading.Timer(self._timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+        
+        return self
+    
+    def _run(self):
+        ProcessGroup.set_current(self._process_group)
+        try:
+            results = self._align_function()
+        except Exception as e:
+            self._finish(self.STATUS_FAILED, error = e)
+        else:
+            self._finish(self.STATUS_DONE, results = results)
+        finally:
+            ProcessGroup.set_current(None)
+        
+        return
+    
+    # Only the first call has effect: once cancelled or timed out,
+    # the results of the alignment (which is being stopped) are discarded
+    def _finish(self, status, results = None, error = None):
+        with self._lock:
+            if self._status != self.STATUS_RUNNING: return False
+            self._status = status
+            self._results = results
+            self._error = error
+            self._end_time = time.time()
+        
+        if self._timer != None: self._timer.cancel()
+        
+        if status == self.STATUS_CANCELLED or status == self.STATUS_TIMED_OUT:
+            self._process_group.cancel()
+        
+        if self._verbose: sys.stderr.write("AlignmentRequest: "+status+" after "+\
+                                           "%.3f" % (self._end_time - self._start_time)+" s\n")
+        
+        self._done_event.set()
+        
+        if self._callback != None:
+            try:
+                self._callback(self)
+            except Exception as e:
+                sys.stderr.write("AlignmentRequest: error in callback. "+str(e)+"\n")
+        
+        return True
+    
+    def _expire(self):
+        self._finish(self.STATUS_TIMED_OUT,
+                     error = m2pException("AlignmentRequest: timed out after "+str(self._timeout)+" s."))
+        return
+    
+    # Returns True if the request was running (and thus has been cancelled)
+    def cancel(self):
+        return self._finish(self.STATUS_CANCELLED,
+                            error = m2pException("AlignmentRequest: cancelled."))
+    
+    def get_status(self):
+        return self._status
+    
+    def is_done(self):
+        return self._done_event.is_set()
+    
+    # Returns True if the request finished within timeout seconds (None: waits until it finishes)
+    def wait(self, timeout = None):
+        # Event.wait without timeout can not be interrupted (e.g. Ctrl-C) in python 2
+        while timeout == None and not self._done_event.is_set():
+            self._done_event.wait(1.0)
+        
+        return self._done_event.wait(timeout)
+    
+    # Returns the AlignmentResults, waiting for them up to timeout seconds.
+    # Raises the error of the alignment if it failed, and m2pException
+    # if it was cancelled, timed out, or it did not finish within timeout seconds
+    def get_results(self, timeout = None):
+        
+        if not self.wait(timeout):
+            raise m2pException("AlignmentRequest: results not ready after "+str(timeout)+" s.")
+        
+        if self._status != self.STATUS_DONE: raise self._error
+        
+        return self._results
+    
+    def get_error(self):
+        return self._error
+    
+    # Seconds since the request started (until it finished, if it has)
+    def get_elapsed_time(self):
+        end_time = self._end_time if self._end_time != None else time.time()
+        return end_time - self._start_time
+
+## END
@@ -5,59 +5,65 @@
 # Copyright (C)  2017  Carlos P Cantalapiedra.
 # (terms of use can be found within the distributed LICENSE file).
 
+from operator import attrgetter
+
+from barleymapcore.m2p_exception import m2pException
+
+# NumPy is optional: it is needed only for ColumnarAlignmentResults
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+## Alignment of a query to a subject sequence of a DB.
+## Scores and positions are stored as numbers (float and long),
+## and __slots__ are used since there could be millions of these objects.
 class AlignmentResult(object):
     
-    _query_id = ""
-    _subject_id = ""
-    _align_ident = -1.0
-    _query_cov = -1.0
-    _align_score = -1
-    _strand = "+"
-    _local_position = -1
-    _end_position = -1
-    _qstart_pos = -1
-    _qend_pos = -1
-    _db_id = ""
-    _algorithm = ""
-    
-    def __init__(self):
+    __slots__ = ("_query_id", "_subject_id", "_align_ident", "_query_cov", "_align_score", "_strand",
+                 "_qstart_pos", "_qend_pos", "_local_position", "_end_position", "_db_id", "_algorithm")
+    
+    # Fast constructor: values are expected to be already of the right type
+    # (see create_from_attributes to convert them)
+    def __init__(self, query_id = "", subject_id = "", align_ident = -1.0, query_cov = -1.0, align_score = -1.0,
+                 strand = "+", qstart_pos = -1, qend_pos = -1, local_position = -1, end_position = -1,
+                 db_id = "", algorithm = ""):
+        self._query_id = query_id
+        self._subject_id = subject_id
+        self._align_ident = align_ident
+        self._query_cov = query_cov
+        self._align_score = align_score
+        self._strand = strand
+        self._qstart_pos = qstart_pos
+        self._qend_pos = qend_pos
+        self._local_position = local_position
+        self._end_position = end_position
+        self._db_id = db_id
+        self._algorithm = algorithm
+        
         return
     
     def create_from_attributes(self, query_id, subject_id, align_ident, query_cov, align_score,
                         strand, qstart_pos, qend_pos, local_position, end_position,
                         db_id, algorithm):
-        self.set_query_id(query_id)
-        self.set_subject_id(subject_id)
-        self.set_align_ident(align_ident)
-        self.set_query_cov(query_cov)
-        self.set_align_score(align_score)
-        self.set_strand(strand)
-        self.set_qstart_pos(qstart_pos)
-        self.set_qend_pos(qend_pos)
-        self.set_local_position(local_position)
-        self.set_end_position(end_position)
-        self.set_db_id(db_id)
-        self.set_algorithm(algorithm)
+        self._query_id = query_id
+        self._subject_id = subject_id
+        self._align_ident = float(align_ident)
+        self._query_cov = float(query_cov)
+        self._align_score = float(align_score)
+        self._strand = strand
+        self._qstart_pos = long(qstart_pos)
+        self._qend_pos = long(qend_pos)
+        self._local_position = long(local_position)
+        self._end_position = long(end_position)
+        self._db_id = db_id
+        self._algorithm = algorithm
         
         return
     
     def create_from_alignment_data(self, alignment_data):
         
-        self._query_id = alignment_data[0]
-        self._subject_id = alignment_data[1]
-        self._align_ident = alignment_data[2]
-        self._query_cov = alignment_data[3]
-        self._align_score = alignment_data[4]
-        self._strand = alignment_data[5]
-        
-        self._qstart_pos = alignment_data[6]
-        self._qend_pos = alignment_data[7]
-        
-        self._local_position = alignment_data[8]
-        self._end_position = alignment_data[9]
-        
-        self._db_id = alignment_data[10]
-        self._algorithm = alignment_data[11]
+        self.create_from_attributes(*alignment_data[:12])
         
         return
     
@@ -77,19 +83,19 @@ class AlignmentResult(object):
         return self._align_ident
     
     def set_align_ident(self, align_ident):
-        self._align_ident = align_ident
+        self._align_ident = float(align_ident)
     
     def get_query_cov(self):
         return self._query_cov
     
     def set_query_cov(self, query_cov):
-        self._query_cov = query_cov
+        self._query_cov = float(query_cov)
     
     def get_align_score(self):
         return self._align_score
     
     def set_align_score(self, align_score):
-        self._align_score = align_score
+        self._align_score = float(align_score)
     
     def get_strand(self):
         return self._strand
@@ -101,25 +107,25 @@ class AlignmentResult(object):
         return self._local_position
     
     def set_local_position(self, local_position):
-        self._local_position = local_position
+        self._local_position = long(local_position)
     
     def get_end_position(self):
         return self._end_position
     
     def set_end_position(self, end_position):
-        self._end_position = end_position
+        self._end_position = long(end_position)
     
     def get_qstart_pos(self):
         return self._qstart_pos
     
     def set_qstart_pos(self, qstart_pos):
-        self._qstart_pos = qstart_pos
+        self._qstart_pos = long(qstart_pos)
     
     def get_qend_pos(self):
         return self._qend_pos
     
     def set_qend_pos(self, qend_pos):
-        self._qend_pos = qend_pos
+        self._qend_pos = long(qend_pos)
     
     def get_db_id(self):
         return self._db_id
@@ -138,6 +144,9 @@ class AlignmentResult(object):
                           self._strand, str(self._local_position), str(self._end_position), str(self._qstart_pos), str(self._qend_pos),
                           self._db_id, self._algorithm])
 
+# Key to sort alignments by query, subject and position
+ALIGNMENT_SORT_KEY = attrgetter("_query_id", "_subject_id", "_local_position", "_end_position")
+
 class AlignmentResults(object):
     _aligned = None
     _unaligned = None
@@ -157,5 +166,156 @@ class AlignmentResults(object):
     
     def set_unaligned(self, unaligned):
         self._unaligned = unaligned
+
+### AlignmentResults which stores the alignments as parallel NumPy arrays
+### (ids are interned as indexes to lists of names),
+### so that best score filtering and sorting are vectorized.
+### It can be used as the list of aligned results: iterating over it
+### yields AlignmentResult objects, created lazily from the arrays.
+class ColumnarAlignmentResults(AlignmentResults):
+    
+    # Rows converted to AlignmentResult at once while iterating
+    ITER_BLOCK_SIZE = 10000
+    
+    _names = None # column --> list of names (interned ids)
+    _columns = None # column --> numpy array
+    
+    # Columns of interned ids, and numeric columns
+    ID_COLUMNS = ["query_id", "subject_id", "strand", "db_id", "algorithm"]
+    FLOAT_COLUMNS = ["align_ident", "query_cov", "align_score"]
+    POS_COLUMNS = ["qstart_pos", "qend_pos", "local_position", "end_position"]
+    
+    def __init__(self, aligned, unaligned):
+        
+        if numpy == None:
+            raise m2pException("ColumnarAlignmentResults: NumPy is not available.")
+        
+        self._unaligned = unaligned
+        self._names = {}
+        self._columns = {}
+        
+        num_rows = len(aligned)
+        
+        for column in self.ID_COLUMNS:
+            getter = attrgetter("_"+column)
+            names_idx = {}
+            names = []
+            column_idx = numpy.empty(num_rows, dtype=numpy.int32)
+            for i, alignment_result in enumerate(aligned):
+                name = getter(alignment_result)
+                name_idx = names_idx.get(name)
+                if name_idx == None:
+                    name_idx = len(names)
+                    names_idx[name] = name_idx
+                    names.append(name)
+                column_idx[i] = name_idx
+            
+            self._names[column] = names
+            self._columns[column] = column_idx
+        
+        for column in self.FLOAT_COLUMNS:
+            self._columns[column] = numpy.array(map(attrgetter("_"+column), aligned), dtype=numpy.float64)
+        
+        for column in self.POS_COLUMNS:
+            self._columns[column] = numpy.array(map(attrgetter("_"+column), aligned), dtype=numpy.int64)
+        
+        return
+    
+    @staticmethod
+    def is_available():
+        return numpy != None
+    
+    # Returns new ColumnarAlignmentResults with the given rows (indexes or mask)
+    def _take(self, rows):
+        new_results = ColumnarAlignmentResults([], self._unaligned)
+        new_results._names = self._names
+        new_results._columns = dict([(column, self._columns[column][rows]) for column in self._columns])
+        
+        return new_results
+    
+    # Rows with the best score of their group
+    def _best_score_rows(self, groups, num_groups):
+        align_score = self._columns["align_score"]
+        
+        groups_max = numpy.full(num_groups, -numpy.inf)
+        numpy.maximum.at(groups_max, groups, align_score)
+        
+        return align_score == groups_max[groups]
+    
+    # Best score across all databases
+    def best_score(self):
+        query_idx = self._columns["query_id"]
+        rows = self._best_score_rows(query_idx, len(self._names["query_id"]))
+        
+        return self._take(rows)
+    
+    # Best score of each query for each database
+    def best_db_score(self):
+        num_dbs = len(self._names["db_id"])
+        groups = self._columns["query_id"].astype(numpy.int64) * num_dbs + self._columns["db_id"]
+        rows = self._best_score_rows(groups, len(self._names["query_id"]) * num_dbs)
+        
+        return self._take(rows)
+    
+    # Rank of each name in the lexicographic order of the names
+    def _names_rank(self, column):
+        names = self._names[column]
+        rank = numpy.empty(len(names), dtype=numpy.int64)
+        rank[sorted(xrange(len(names)), key=names.__getitem__)] = numpy.arange(len(names))
+        
+        return rank[self._columns[column]]
+    
+    # Sorted by query, subject and position (as ALIGNMENT_SORT_KEY)
+    def sort_results(self):
+        # lexsort: last key is the primary one, and it is a stable sort
+        rows = numpy.lexsort((self._columns["end_position"], self._columns["local_position"],
+                              self._names_rank("subject_id"), self._names_rank("query_id")))
+        
+        return self._take(rows)
+    
+    # Queries with at least one alignment
+    def get_query_ids(self):
+        query_names = self._names["query_id"]
+        
+        return [query_names[query_idx] for query_idx in numpy.unique(self._columns["query_id"])]
+    
+    def get_aligned(self):
+        return self
+    
+    def __len__(self):
+        return len(self._columns["align_score"])
+    
+    # Negative rows count from the end, as in a list
+    def __getitem__(self, row):
+        num_rows = len(self)
+        if row < 0: row += num_rows
+        if row < 0 or row >= num_rows:
+            raise IndexError("ColumnarAlignmentResults: row out of range.")
+        
+        return self._get_rows(row, row+1)[0]
+    
+    def __iter__(self):
+        num_rows = len(self)
+        for block_start in xrange(0, num_rows, self.ITER_BLOCK_SIZE):
+            for alignment_result in self._get_rows(block_start, min(block_start+self.ITER_BLOCK_SIZE, num_rows)):
+                yield alignment_result
+        
+        return
+    
+    # Creates the AlignmentResult objects of a block of rows
+    def _get_rows(self, start, end):
+        columns = self._columns
+        names = self._names
+        
+        block = []
+        for column in ["query_id", "subject_id", "align_ident", "query_cov", "align_score", "strand",
+                       "qstart_pos", "qend_pos", "local_position", "end_position", "db_id", "algorithm"]:
+            values = columns[column][start:end].tolist()
+            if column in names:
+                column_names = names[column]
+                values = [column_names[value] for value in values]
+            block.append(values)
+        
+        return [AlignmentResult(*row_data) for row_data in zip(*block)]
     
-## END
\ No newline at end of file
+## END
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# DBOrderPlanner.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import sys, sqlite3
+
+# Time (seconds) to wait for other processes holding the stats lock
+LOCK_TIMEOUT = 60
+
+# Modes of the planner (db_order in paths config)
+DB_ORDER_CONFIG = "config" # DBs are aligned in the given order, and no statistics are recorded
+DB_ORDER_SUGGEST = "suggest" # the planned order is reported, but DBs are aligned in the given order
+DB_ORDER_APPLY = "apply" # DBs are aligned in the planned order
+
+### Statistics of the alignments to each DB: number of queries,
+### number of queries with hits and seconds spent, accumulated over
+### previous runs for each DB and list of aligners.
+### Stored in a SQLite file, so that it can be shared by several processes.
+class DBStatsStore(object):
+    
+    _stats_path = ""
+    _verbose = False
+    
+    def __init__(self, stats_path, verbose = False):
+        self._stats_path = stats_path
+        self._verbose = verbose
+        
+        conn = self._connect()
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS db_stats "+\
+                         "(db TEXT, aligners TEXT, queries INTEGER, aligned INTEGER, seconds REAL, runs INTEGER, "+\
+                         "PRIMARY KEY (db, aligners))")
+        finally:
+            conn.close()
+    
+    def _connect(self):
+        conn = sqlite3.connect(self._stats_path, timeout = LOCK_TIMEOUT, isolation_level = None)
+        conn.text_factory = str
+        return conn
+    
+    def record(self, db, aligner_list, num_queries, num_aligned, seconds):
+        
+        if num_queries == 0: return
+        
+        aligners = ",".join(aligner_list)
+        
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("INSERT OR IGNORE INTO db_stats VALUES (?, ?, 0, 0, 0.0, 0)", (db, aligners))
+                conn.execute("UPDATE db_stats SET queries = queries + ?, aligned = aligned + ?, "+\
+                             "seconds = seconds + ?, runs = runs + 1 WHERE db = ? AND aligners = ?",
+                             (num_queries, num_aligned, seconds, db, aligners))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        
+        if self._verbose: sys.stderr.write("DBStatsStore: "+db+" "+str(num_aligned)+" of "+str(num_queries)+\
+                                           " queries with hits in "+"%.3f" % seconds+" s\n")
+        
+        return
+    
+    # Returns a dict db --> (queries, aligned, seconds, runs), only for DBs with statistics
+    def get_stats(self, dbs_list, aligner_list):
+        
+        aligners = ",".join(aligner_list)
+        
+        conn = self._connect()
+        try:
+            placeholders = ",".join(["?"]*len(dbs_list))
+            cursor = conn.execute("SELECT db, queries, aligned, seconds, runs FROM db_stats "+\
+                                  "WHERE aligners = ? AND db IN ("+placeholders+")", [aligners]+list(dbs_list))
+            db_stats = dict([(row[0], tuple(row[1:])) for row in cursor])
+        finally:
+            conn.close()
+        
+        return db_stats
+
+### Chooses the order in which DBs are searched when queries found in a DB
+### are not aligned to the next ones (hierarchical and exhaustive searches).
+### Each DB has a hit rate p (queries with hits / queries aligned) and a cost c
+### (seconds per query aligned), from the DBStatsStore. The expected time
+### per query of an order is sum(c_i * prod(1 - p_j, j < i)), which is
+### minimised by sorting the DBs by c / p (lower first).
+### DBs without statistics keep the given order and go first,
+### so that their statistics are recorded. Note that the order of the DBs
+### changes which DB a query is assigned to, so maps whose hierarchy
+### must be kept are pinned (see MapConfig.is_db_order_pinned).
+class DBOrderPlanner(object):
+    
+    _stats_store = None
+    _mode = DB_ORDER_CONFIG
+    _verbose = False
+    
+    def __init__(self, stats_store, mode, verbose = False):
+        self._stats_store = stats_store
+        self._mode = mode
+        self._verbose = verbose
+    
+    # Returns a planner from the paths config, or None if it is not enabled
+    @staticmethod
+    def from_paths_config(paths_config, verbose = False):
+        planner = None
+        
+        mode = paths_config.get_db_order()
+        stats_path = paths_config.get_db_stats_path()
+        
+        if mode != DB_ORDER_CONFIG:
+            if mode not in [DB_ORDER_SUGGEST, DB_ORDER_APPLY]:
+                sys.stderr.write("DBOrderPlanner: unrecognized db_order "+str(mode)+". DBs order will not be planned.\n")
+            elif not stats_path:
+                sys.stderr.write("DBOrderPlanner: db_stats_path is not set. DBs order will not be planned.\n")
+            else:
+                planner = DBOrderPlanner(DBStatsStore(stats_path, verbose), mode, verbose)
+        
+        return planner
+    
+    def get_mode(self):
+        return self._mode
+    
+    def get_stats_store(self):
+        return self._stats_store
+    
+    # Returns the DBs in the order in which they have to be aligned
+    # pinned: the given order is kept, the planned one is only reported
+    def plan(self, dbs_list, aligner_list, pinned = False, name = ""):
+        
+        if len(dbs_list) < 2: return dbs_list
+        
+        db_stats = self._stats_store.get_stats(dbs_list, aligner_list)
+        
+        # (hit rate, seconds per query)
+        db_costs = {}
+        for db in db_stats:
+            (queries, aligned, seconds, runs) = db_stats[db]
+            if queries > 0: db_costs[db] = (float(aligned) / queries, float(seconds) / queries)
+        
+        unknown_dbs = [db for db in dbs_list if db not in db_costs]
+        known_dbs = [db for db in dbs_list if db in db_costs]
+        # sorted is stable: DBs with the same ratio keep the given order
+        known_dbs = sorted(known_dbs, key=lambda db: self._get_ratio(db_costs[db]))
+        planned_dbs = unknown_dbs + known_dbs
+        
+        apply_plan = self._mode == DB_ORDER_APPLY and not pinned
+        
+        # Suggestions are reported always, and the rest of decisions if verbose
+        if self._verbose or (planned_dbs != dbs_list and self._mode == DB_ORDER_SUGGEST and not pinned):
+            self._report(dbs_list, planned_dbs, db_costs, pinned, apply_plan, name)
+        
+        if apply_plan: return planned_dbs
+        
+        return dbs_list
+    
+    # Seconds spent per query found
+    def _get_ratio(self, db_cost):
+        (hit_rate, query_cost) = db_cost
+        
+        if hit_rate > 0: return query_cost / hit_rate
+        
+        return float("inf")
+    
+    # Expected seconds per query of the given order, or None if any DB has no statistics
+    def _get_expected_cost(self, dbs_list, db_costs):
+        expected_cost = 0.0
+        reaching = 1.0 # fraction of queries which reach the DB
+        
+        for db in dbs_list:
+            if db not in db_costs: return None
+            (hit_rate, query_cost) = db_costs[db]
+            expected_cost += reaching * query_cost
+            reaching *= (1.0 - hit_rate)
+        
+        return expected_cost
+    
+    def _report(self, dbs_list, planned_dbs, db_costs, pinned, apply_plan, name):
+        
+        prefix = "DBOrderPlanner: "+(name+": " if name else "")
+        
+        for db in planned_dbs:
+            if db in db_costs:
+                (hit_rate, query_cost) = db_costs[db]
+                sys.stderr.write(prefix+db+": hit rate "+"%.3f" % hit_rate+", "+\
+                                 "%.4f" % query_cost+" s/query, "+"%.4f" % self._get_ratio(db_costs[db])+" s/hit\n")
+            else:
+                sys.stderr.write(prefix+db+": no statistics\n")
+        
+        config_cost = self._get_expected_cost(dbs_list, db_costs)
+        planned_cost = self._get_expected_cost(planned_dbs, db_costs)
+        
+        sys.stderr.write(prefix+"config order: "+",".join(dbs_list)+\
+                         (" (expected "+"%.4f" % config_cost+" s/query)" if config_cost != None else "")+"\n")
+        sys.stderr.write(prefix+"planned order: "+",".join(planned_dbs)+\
+                         (" (expected "+"%.4f" % planned_cost+" s/query)" if planned_cost != None else "")+"\n")
+        
+        if planned_dbs == dbs_list:
+            decision = "config order is already the planned one"
+        elif pinned:
+            decision = "config order kept (pinned)"
+        elif apply_plan:
+            decision = "planned order applied"
+        else:
+            decision = "planned order suggested (db_order "+DB_ORDER_APPLY+" to apply it)"
+        
+        sys.stderr.write(prefix+decision+"\n")
+        
+        return
+
+## END
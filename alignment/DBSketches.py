@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# DBSketches.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import sys, os, re, zlib, string, threading
+from array import array
+from bisect import bisect_left
+
+from barleymapcore.m2p_exception import m2pException
+from barleymapcore.utils.array_utils import sort_arrays, unique_sorted
+
+# Modes of the filter (db_sketches in paths config)
+DB_SKETCHES_NO = "no" # queries are aligned to every DB
+DB_SKETCHES_YES = "yes" # queries without k-mers shared with a DB are not aligned to it
+DB_SKETCHES_AUDIT = "audit" # queries are aligned to every DB, and the queries which would be skipped are reported
+
+SKETCH_EXT = ".sketch" # sketch of each DB: sketches_path/DB.sketch
+SKETCH_MAGIC = "BMSKETCH1\n"
+HASH_SPACE = 2**32 # k-mers are sampled by the first 32 bits of their hash
+HASH_TYPECODE = "L" # array of hashes: unsigned long, 8 bytes in 64-bit Linux and Mac OS
+
+DEFAULT_K = 21
+DEFAULT_SCALED = 20 # about 1 of each 20 k-mers is kept in the sketch
+
+# Queries whose k-mer hashes are kept by DBSketchFilter, to be reused with the sketches of other DBs
+QUERY_HASHES_CACHE_SIZE = 100000
+
+_REVCOMP_TABLE = string.maketrans("ACGT", "TGCA")
+_NON_ACGT = re.compile("[^ACGT]+")
+
+# Hashes (64 bits) of the canonical k-mers of sequence whose sampling hash
+# (first 32 bits) is lower than max_hash. K-mers with bases other than ACGT are skipped.
+def get_kmer_hashes(sequence, k, max_hash):
+    kmer_hashes = set()
+    
+    for segment in _NON_ACGT.split(sequence.upper()):
+        seg_len = len(segment)
+        if seg_len < k: continue
+        
+        revcomp = segment.translate(_REVCOMP_TABLE)[::-1]
+        
+        for i in xrange(seg_len - k + 1):
+            kmer = segment[i:i+k]
+            kmer_rc = revcomp[seg_len-i-k:seg_len-i]
+            if kmer_rc < kmer: kmer = kmer_rc
+            
+            sample_hash = zlib.crc32(kmer) & 0xffffffff
+            if sample_hash < max_hash:
+                kmer_hashes.add((sample_hash << 32) | (zlib.adler32(kmer) & 0xffffffff))
+    
+    return kmer_hashes
+
+### Sketch of the k-mers of a DB (FracMinHash): the hashes of the
+### canonical k-mers of the reference whose sampling hash falls in the
+### lowest 1/scaled of the hash space. The same sampling is applied to
+### the k-mers of a query, so that a query which comes from the DB shares
+### about 1/scaled of its k-mers with the sketch, whatever the size of the DB.
+### The hashes are kept sorted in an array (8 bytes each) and searched with bisect.
+class DBSketch(object):
+    
+    _k = DEFAULT_K
+    _scaled = DEFAULT_SCALED
+    _hashes = None # array(HASH_TYPECODE), sorted
+    
+    def __init__(self, k, scaled, hashes):
+        self._k = k
+        self._scaled = scaled
+        self._hashes = hashes
+    
+    def get_k(self):
+        return self._k
+    
+    def get_scaled(self):
+        return self._scaled
+    
+    def get_max_hash(self):
+        return HASH_SPACE / self._scaled
+    
+    def get_num_hashes(self):
+        return len(self._hashes)
+    
+    # Number of hashes of query_hashes which are in the sketch
+    def get_num_shared(self, query_hashes):
+        num_shared = 0
+        
+        hashes = self._hashes
+        num_hashes = len(hashes)
+        for query_hash in query_hashes:
+            pos = bisect_left(hashes, query_hash)
+            if pos < num_hashes and hashes[pos] == query_hash:
+                num_shared += 1
+        
+        return num_shared
+    
+    # Sketch of the sequences of a fasta file.
+    # The hashes are appended to an array, and sorted and deduplicated
+    # at the end without Python objects (see array_utils)
+    @staticmethod
+    def build(fasta_path, k = DEFAULT_K, scaled = DEFAULT_SCALED, verbose = False):
+        
+        max_hash = HASH_SPACE / scaled
+        hashes = array(HASH_TYPECODE)
+        
+        # Sequences are hashed by chunks of lines, keeping the last k-1 bases
+        # of each chunk so that the k-mers across chunks are not lost
+        def hash_sequence(seq_lines):
+            if len(seq_lines) > 0:
+                hashes.extend(get_kmer_hashes("".join(seq_lines), k, max_hash))
+            return
+        
+        num_seqs = 0
+        with open(fasta_path, 'r') as fasta_file:
+            seq_lines = []
+            seq_len = 0
+            for line in fasta_file:
+                if line.startswith(">"):
+                    hash_sequence(seq_lines)
+                    seq_lines = []
+                    seq_len = 0
+                    num_seqs += 1
+                    if verbose: sys.stderr.write("DBSketch: "+line[1:].strip()+"\n")
+                else:
+                    line = line.strip()
+                    seq_lines.append(line)
+                    seq_len += len(line)
+                    if seq_len >= 1000000:
+                        hash_sequence(seq_lines)
+                        tail = "".join(seq_lines)[-(k-1):]
+                        seq_lines = [tail]
+                        seq_len = len(tail)
+            
+            hash_sequence(seq_lines)
+        
+        sort_arrays(hashes)
+        unique_sorted(hashes)
+        
+        if verbose: sys.stderr.write("DBSketch: "+str(num_seqs)+" sequences, "+str(len(hashes))+" hashes.\n")
+        
+        return DBSketch(k, scaled, hashes)
+    
+    @staticmethod
+    def load(sketch_path):
+        with open(sketch_path, 'rb') as sketch_file:
+            if sketch_file.read(len(SKETCH_MAGIC)) != SKETCH_MAGIC:
+                raise m2pException("DBSketch: "+sketch_path+" is not a sketch file.")
+            
+            (k, scaled, num_hashes, itemsize) = [int(field) for field in sketch_file.readline().split()]
+            
+            hashes = array(HASH_TYPECODE)
+            if hashes.itemsize != itemsize:
+                raise m2pException("DBSketch: "+sketch_path+" was built with hashes of "+str(itemsize)+\
+                                   " bytes, but they are of "+str(hashes.itemsize)+" bytes in this platform.")
+            
+            hashes.fromfile(sketch_file, num_hashes)
+        
+        return DBSketch(k, scaled, hashes)
+    
+    def write(self, sketch_path):
+        with open(sketch_path, 'wb') as sketch_file:
+            sketch_file.write(SKETCH_MAGIC)
+            sketch_file.write(" ".join([str(self._k), str(self._scaled), str(len(self._hashes)),
+                                        str(self._hashes.itemsize)])+"\n")
+            self._hashes.tofile(sketch_file)
+        
+        return
+
+### Decides which queries are plausible for a DB, from its sketch:
+### a query whose sampled k-mers do not include at least min_shared
+### k-mers of the sketch of the DB is not aligned to it. Queries with
+### fewer than min_shared sampled k-mers (e.g. too short) are always aligned,
+### as well as every query to a DB without a sketch.
+### Sketches are loaded once per process, and reloaded if the file changes.
+### In audit mode every query is aligned, and the filter reports the recall:
+### the fraction of queries with hits which would not have been skipped.
+class DBSketchFilter(object):
+    
+    # sketch path --> (mtime, DBSketch)
+    _sketches = {}
+    _sketches_lock = threading.Lock()
+    
+    _sketches_path = ""
+    _mode = DB_SKETCHES_NO
+    _min_shared = 1
+    _verbose = False
+    
+    # (k, max_hash) --> sequence --> k-mer hashes, of the last queries filtered
+    _query_hashes = None
+    _query_hashes_size = 0
+    _query_hashes_lock = None
+    
+    _stats_lock = None
+    # Counters of this filter
+    _num_queries = 0
+    _num_skipped = 0
+    _num_aligned = 0 # audit: queries with hits
+    _num_missed = 0 # audit: queries with hits which would be skipped
+    
+    def __init__(self, sketches_path, mode, min_shared, verbose = False):
+        self._sketches_path = sketches_path
+        self._mode = mode
+        self._min_shared = min_shared
+        self._verbose = verbose
+        
+        self._query_hashes = {}
+        self._query_hashes_size = 0
+        self._query_hashes_lock = threading.Lock()
+        
+        self._stats_lock = threading.Lock()
+        self._num_queries = 0
+        self._num_skipped = 0
+        self._num_aligned = 0
+        self._num_missed = 0
+    
+    # Returns a filter from the paths config, or None if it is not enabled
+    @staticmethod
+    def from_paths_config(paths_config, verbose = False):
+        sketch_filter = None
+        
+        mode = paths_config.get_db_sketches()
+        sketches_path = paths_config.get_db_sketches_path()
+        
+        if mode != DB_SKETCHES_NO:
+            if mode not in [DB_SKETCHES_YES, DB_SKETCHES_AUDIT]:
+                sys.stderr.write("DBSketchFilter: unrecognized db_sketches "+str(mode)+". Queries will not be filtered.\n")
+            elif not sketches_path:
+                sys.stderr.write("DBSketchFilter: db_sketches_path is not set. Queries will not be filtered.\n")
+            else:
+                sketch_filter = DBSketchFilter(sketches_path, mode, paths_config.get_db_sketches_min_shared(), verbose)
+        
+        return sketch_filter
+    
+    def get_mode(self):
+        return self._mode
+    
+    def is_audit(self):
+        return self._mode == DB_SKETCHES_AUDIT
+    
+    # The sketch of the DB, or None if it has no sketch
+    def get_sketch(self, db):
+        sketch_path = os.path.join(self._sketches_path, db + SKETCH_EXT)
+        
+        if not os.path.isfile(sketch_path): return None
+        
+        mtime = os.path.getmtime(sketch_path)
+        
+        with DBSketchFilter._sketches_lock:
+            loaded = DBSketchFilter._sketches.get(sketch_path)
+            if loaded != None and loaded[0] == mtime:
+                return loaded[1]
+            
+            if self._verbose: sys.stderr.write("DBSketchFilter: loading sketch "+sketch_path+"\n")
+            
+            sketch = DBSketch.load(sketch_path)
+            DBSketchFilter._sketches[sketch_path] = (mtime, sketch)
+        
+        return sketch
+    
+    # K-mer hashes of the queries (list of sequences) for k and max_hash.
+    # These are kept (up to QUERY_HASHES_CACHE_SIZE queries), so that
+    # each query is hashed only once for the DBs with sketches of the same k and scaled
+    def _get_query_hashes(self, sequences, k, max_hash):
+        
+        with self._query_hashes_lock:
+            sketch_hashes = self._query_hashes.setdefault((k, max_hash), {})
+            cached = [sketch_hashes.get(sequence) for sequence in sequences]
+        
+        new_hashes = {}
+        for i, sequence in enumerate(sequences):
+            if cached[i] == None:
+                cached[i] = tuple(get_kmer_hashes(sequence, k, max_hash))
+                new_hashes[sequence] = cached[i]
+        
+        with self._query_hashes_lock:
+            if self._query_hashes_size + len(new_hashes) > QUERY_HASHES_CACHE_SIZE:
+                self._query_hashes = {}
+                self._query_hashes_size = 0
+            
+            if len(new_hashes) <= QUERY_HASHES_CACHE_SIZE:
+                self._query_hashes.setdefault((k, max_hash), {}).update(new_hashes)
+                self._query_hashes_size += len(new_hashes)
+        
+        return cached
+    
+    # Returns the ids of the queries (QueryFasta) which are plausible for the DB,
+    # in the order of the fasta, or None if the DB has no sketch (every query is plausible)
+    def get_plausible(self, query_fasta, db):
+        
+        sketch = self.get_sketch(db)
+        if sketch == None:
+            if self._verbose: sys.stderr.write("DBSketchFilter: no sketch for "+db+". Queries will not be filtered.\n")
+            return None
+        
+        k = sketch.get_k()
+        max_hash = sketch.get_max_hash()
+        min_shared = self._min_shared
+        
+        queries = list(query_fasta.get_sequences())
+        queries_hashes = self._get_query_hashes([sequence for header, sequence in queries], k, max_hash)
+        
+        plausible = []
+        for (header, sequence), query_hashes in zip(queries, queries_hashes):
+            if len(query_hashes) < min_shared or sketch.get_num_shared(query_hashes) >= min_shared:
+                plausible.append(header.split(" ")[0])
+        
+        num_queries = query_fasta.get_num_queries()
+        num_skipped = num_queries - len(plausible)
+        with self._stats_lock:
+            self._num_queries += num_queries
+            self._num_skipped += num_skipped
+        
+        if self._verbose or self._mode == DB_SKETCHES_AUDIT:
+            sys.stderr.write("DBSketchFilter: "+db+": "+str(num_skipped)+" of "+str(num_queries)+" queries "+\
+                             ("would be " if self._mode == DB_SKETCHES_AUDIT else "")+"skipped.\n")
+        
+        return plausible
+    
+    # Audit mode: reports the queries with hits in the DB which would have been skipped
+    def audit(self, db, plausible, hits):
+        
+        aligned = set([hit.get_query_id() for hit in hits])
+        plausible = set(plausible)
+        missed = [query_id for query_id in aligned if query_id not in plausible]
+        
+        with self._stats_lock:
+            self._num_aligned += len(aligned)
+            self._num_missed += len(missed)
+        
+        recall = float(len(aligned) - len(missed)) / len(aligned) if len(aligned) > 0 else 1.0
+        
+        sys.stderr.write("DBSketchFilter: audit "+db+": "+str(len(aligned))+" queries with hits, "+\
+                         str(len(missed))+" of them would be skipped (recall "+"%.4f" % recall+").\n")
+        if self._verbose and len(missed) > 0:
+            sys.stderr.write("DBSketchFilter: audit "+db+": missed "+",".join(sorted(missed))+"\n")
+        
+        return
+    
+    # queries, skipped (or would be skipped, in audit mode) and, in audit mode,
+    # aligned (queries with hits) and missed (queries with hits which would be skipped)
+    def get_stats(self):
+        with self._stats_lock:
+            stats = {"queries":self._num_queries, "skipped":self._num_skipped}
+            if self._mode == DB_SKETCHES_AUDIT:
+                stats["aligned"] = self._num_aligned
+                stats["missed"] = self._num_missed
+        
+        return stats
+
+## END
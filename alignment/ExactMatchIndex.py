@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ExactMatchIndex.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import sys, os, re, zlib, math, mmap, string, struct, threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+from barleymapcore.m2p_exception import m2pException
+from barleymapcore.utils.array_utils import sort_arrays
+from AlignmentResult import AlignmentResult
+
+ALGORITHM = "exact" # algorithm of the hits found in the index
+
+INDEX_EXT = ".exidx" # seeds of each DB: exact_index_path/DB.exidx
+SEQ_EXT = ".exseq" # sequences of each DB: exact_index_path/DB.exseq
+INDEX_MAGIC = "BMEXACT1\n"
+HASH_TYPECODE = "L" # arrays of hashes and positions: unsigned long, 8 bytes in 64-bit Linux and Mac OS
+
+DEFAULT_SEED_LEN = 32
+DEFAULT_STEP = 16 # a seed every 16 bp of the reference
+
+# Queries with more exact hits than this are aligned by the aligner
+MAX_EXACT_HITS = 100
+
+# Karlin-Altschul parameters of megablast (reward 1, penalty -2),
+# to report the same score than blastn and HS-Blastn for a perfect hit
+BLAST_LAMBDA = 1.28
+BLAST_K = 0.46
+
+_REVCOMP_TABLE = string.maketrans("ACGT", "TGCA")
+_NON_ACGT = re.compile("[^ACGT]")
+
+def _seed_hash(seed):
+    return ((zlib.crc32(seed) & 0xffffffff) << 32) | (zlib.adler32(seed) & 0xffffffff)
+
+# Bit score as written by blastn and HS-Blastn in tabular output
+# (the score of their hits is parsed from it): in scientific notation
+# above 99999, truncated to an integer above 99.9, and with one decimal below
+def _format_bit_score(bit_score):
+    if bit_score > 99999:
+        bit_score_str = "%5.3e" % bit_score
+    elif bit_score > 99.9:
+        bit_score_str = "%3.0d" % long(bit_score)
+    else:
+        bit_score_str = "%4.1f" % bit_score
+    
+    return bit_score_str
+
+# Score of a hit of 100% identity over the whole query, as reported by the aligner
+def get_perfect_score(aligner_name, query_len):
+    if aligner_name in ["blastn", "hsblastn"]:
+        bit_score = (BLAST_LAMBDA * query_len - math.log(BLAST_K)) / math.log(2)
+        align_score = float(_format_bit_score(bit_score))
+    else: # gmap, minimap2
+        align_score = float(query_len - 1)
+    
+    return align_score
+
+### Read-only array of unsigned integers stored in a mmap (e.g. of an index file),
+### which can be searched with bisect without loading it in memory.
+class _MappedArray(object):
+    
+    _mmap = None
+    _offset = 0
+    _length = 0
+    _format = HASH_TYPECODE
+    _itemsize = 0
+    
+    def __init__(self, data_mmap, offset, length, typecode):
+        self._mmap = data_mmap
+        self._offset = offset
+        self._length = length
+        self._format = typecode # native size, as array
+        self._itemsize = struct.calcsize(self._format)
+    
+    def __len__(self):
+        return self._length
+    
+    def __getitem__(self, i):
+        if i < 0: i += self._length
+        if i < 0 or i >= self._length:
+            raise IndexError("_MappedArray: index out of range.")
+        
+        return struct.unpack_from(self._format, self._mmap, self._offset + i * self._itemsize)[0]
+
+### Index of the exact occurrences of queries in the sequences of a DB.
+### A seed (k-mer of seed_len) is indexed every step bp of each sequence of the DB,
+### by its hash, so that any occurrence of a query of at least seed_len + step - 1 bp
+### contains an indexed seed at one of its first step positions. The candidate
+### occurrences of these seeds are verified against the sequences of the DB,
+### which are read through mmap from a separate file.
+### The hashes and positions of the seeds are kept in two arrays (8 bytes each),
+### sorted by hash and searched with bisect. Both arrays are read through mmap
+### from the index file, as the sequences.
+class ExactMatchIndex(object):
+    
+    _seed_len = DEFAULT_SEED_LEN
+    _step = DEFAULT_STEP
+    _hashes = None # _MappedArray of HASH_TYPECODE, sorted
+    _positions = None # _MappedArray of HASH_TYPECODE, offset of the seed of each hash in the sequences file
+    _contigs = None # list of (name, offset, length), sorted by offset
+    _contigs_offsets = None
+    _index_mmap = None
+    _seq_file = None
+    _seq_mmap = None
+    
+    def __init__(self, seed_len, step, hashes, positions, contigs, seq_path, index_mmap = None):
+        self._seed_len = seed_len
+        self._step = step
+        self._hashes = hashes
+        self._positions = positions
+        self._contigs = contigs
+        self._contigs_offsets = [offset for (name, offset, length) in contigs]
+        self._index_mmap = index_mmap
+        
+        self._seq_file = open(seq_path, 'rb')
+        if os.path.getsize(seq_path) > 0:
+            self._seq_mmap = mmap.mmap(self._seq_file.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            self._seq_mmap = ""
+    
+    def get_seed_len(self):
+        return self._seed_len
+    
+    def get_step(self):
+        return self._step
+    
+    def get_min_query_len(self):
+        return self._seed_len + self._step - 1
+    
+    def get_num_seeds(self):
+        return len(self._hashes)
+    
+    def close(self):
+        if self._index_mmap != None: self._index_mmap.close()
+        if self._seq_mmap != "": self._seq_mmap.close()
+        self._seq_file.close()
+        return
+    
+    # (contig name, 1-based position) of an offset of the sequences file
+    def _get_contig(self, offset, length):
+        i = bisect_right(self._contigs_offsets, offset) - 1
+        (name, contig_offset, contig_len) = self._contigs[i]
+        
+        if offset + length > contig_offset + contig_len: return None # across two contigs
+        
+        return (name, offset - contig_offset + 1)
+    
+    # Returns a list of (contig name, 1-based position, strand) of the
+    # exact occurrences of sequence, or None if they can not be resolved
+    # with the index (too short, with bases other than ACGT, or more than max_hits)
+    def find(self, sequence, max_hits = MAX_EXACT_HITS):
+        
+        sequence = sequence.upper()
+        seq_len = len(sequence)
+        
+        if seq_len < self.get_min_query_len() or _NON_ACGT.search(sequence): return None
+        
+        hashes = self._hashes
+        positions = self._positions
+        seq_mmap = self._seq_mmap
+        seed_len = self._seed_len
+        
+        occurrences = []
+        found = set()
+        
+        revcomp = sequence.translate(_REVCOMP_TABLE)[::-1]
+        strands = [("+", sequence)] if revcomp == sequence else [("+", sequence), ("-", revcomp)]
+        
+        for strand, strand_seq in strands:
+            for seed_offset in xrange(self._step):
+                seed_hash = _seed_hash(strand_seq[seed_offset:seed_offset+seed_len])
+                
+                first = bisect_left(hashes, seed_hash)
+                last = bisect_right(hashes, seed_hash, first)
+                
+                for i in xrange(first, last):
+                    start = positions[i] - seed_offset
+                    if start < 0 or (strand, start) in found: continue
+                    
+                    if seq_mmap[start:start+seq_len] != strand_seq: continue
+                    
+                    contig = self._get_contig(start, seq_len)
+                    if contig == None: continue
+                    
+                    found.add((strand, start))
+                    occurrences.append((contig[0], contig[1], strand))
+                    
+                    if len(occurrences) > max_hits: return None
+        
+        return occurrences
+    
+    # Builds the index of the sequences of a fasta file:
+    # writes index_path (seeds) and seq_path (sequences).
+    # The seeds are kept in two arrays (8 bytes each) and sorted
+    # without Python objects (see array_utils.sort_arrays)
+    @staticmethod
+    def build(fasta_path, index_path, seq_path, seed_len = DEFAULT_SEED_LEN, step = DEFAULT_STEP, verbose = False):
+        
+        hashes = array(HASH_TYPECODE)
+        positions = array(HASH_TYPECODE)
+        contigs = []
+        
+        with open(seq_path, 'wb') as seq_file:
+            offset = 0
+            
+            def index_sequence(name, seq_lines):
+                if name == None: return 0
+                sequence = "".join(seq_lines).upper()
+                seq_file.write(sequence)
+                
+                for pos in xrange(0, len(sequence) - seed_len + 1, step):
+                    seed = sequence[pos:pos+seed_len]
+                    if _NON_ACGT.search(seed): continue
+                    hashes.append(_seed_hash(seed))
+                    positions.append(offset + pos)
+                
+                contigs.append((name, offset, len(sequence)))
+                if verbose: sys.stderr.write("ExactMatchIndex: "+name+" "+str(len(sequence))+" bp\n")
+                
+                return len(sequence)
+            
+            with open(fasta_path, 'r') as fasta_file:
+                name = None
+                seq_lines = []
+                for line in fasta_file:
+                    if line.startswith(">"):
+                        offset += index_sequence(name, seq_lines)
+                        name = line[1:].split()[0]
+                        seq_lines = []
+                    else:
+                        seq_lines.append(line.strip())
+                
+                offset += index_sequence(name, seq_lines)
+        
+        # Positions are appended in increasing order, so that a stable sort
+        # by hash sorts the seeds by hash and position
+        sort_arrays(hashes, positions, os.path.dirname(os.path.abspath(index_path)))
+        
+        with open(index_path, 'wb') as index_file:
+            index_file.write(INDEX_MAGIC)
+            index_file.write(" ".join([str(seed_len), str(step), str(len(hashes)), str(hashes.itemsize),
+                                       str(len(contigs))])+"\n")
+            for (name, contig_offset, contig_len) in contigs:
+                index_file.write("\t".join([name, str(contig_offset), str(contig_len)])+"\n")
+            hashes.tofile(index_file)
+            positions.tofile(index_file)
+        
+        if verbose: sys.stderr.write("ExactMatchIndex: "+str(len(contigs))+" sequences, "+str(len(hashes))+" seeds.\n")
+        
+        return
+    
+    # The arrays of hashes and positions are not read, but mapped from index_path
+    @staticmethod
+    def load(index_path, seq_path):
+        with open(index_path, 'rb') as index_file:
+            if index_file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise m2pException("ExactMatchIndex: "+index_path+" is not an exact match index.")
+            
+            (seed_len, step, num_seeds, itemsize, num_contigs) = [int(field) for field in index_file.readline().split()]
+            
+            contigs = []
+            for i in xrange(num_contigs):
+                (name, contig_offset, contig_len) = index_file.readline().rstrip("\n").split("\t")
+                contigs.append((name, long(contig_offset), long(contig_len)))
+            
+            platform_itemsize = array(HASH_TYPECODE).itemsize
+            if platform_itemsize != itemsize:
+                raise m2pException("ExactMatchIndex: "+index_path+" was built with hashes of "+str(itemsize)+\
+                                   " bytes, but they are of "+str(platform_itemsize)+" bytes in this platform.")
+            
+            hashes_offset = index_file.tell()
+            if os.path.getsize(index_path) < hashes_offset + 2 * num_seeds * itemsize:
+                raise m2pException("ExactMatchIndex: "+index_path+" is truncated.")
+            
+            # mmap keeps its own descriptor of the file
+            index_mmap = mmap.mmap(index_file.fileno(), 0, access = mmap.ACCESS_READ)
+        
+        hashes = _MappedArray(index_mmap, hashes_offset, num_seeds, HASH_TYPECODE)
+        positions = _MappedArray(index_mmap, hashes_offset + num_seeds * itemsize, num_seeds, HASH_TYPECODE)
+        
+        return ExactMatchIndex(seed_len, step, hashes, positions, contigs, seq_path, index_mmap)
+
+### Indexes of the DBs, loaded once per process and reloaded if the files change.
+class ExactMatchIndexes(object):
+    
+    # index path --> (mtime, ExactMatchIndex)
+    _indexes = {}
+    _indexes_lock = threading.Lock()
+    
+    @staticmethod
+    def get_index(exact_index_path, db, verbose = False):
+        index_path = os.path.join(exact_index_path, db + INDEX_EXT)
+        seq_path = os.path.join(exact_index_path, db + SEQ_EXT)
+        
+        if not (os.path.isfile(index_path) and os.path.isfile(seq_path)): return None
+        
+        mtime = max(os.path.getmtime(index_path), os.path.getmtime(seq_path))
+        
+        with ExactMatchIndexes._indexes_lock:
+            loaded = ExactMatchIndexes._indexes.get(index_path)
+            if loaded != None and loaded[0] == mtime:
+                return loaded[1]
+            
+            if verbose: sys.stderr.write("ExactMatchIndexes: loading index "+index_path+"\n")
+            
+            index = ExactMatchIndex.load(index_path, seq_path)
+            # A previous version of the index is not closed, since it could
+            # still be used by other threads (its mmap is closed when collected)
+            ExactMatchIndexes._indexes[index_path] = (mtime, index)
+        
+        return index
+
+# Hits of the queries (QueryFasta) which are found as exact occurrences in the index.
+# Returns (hits, ids of the queries which were not resolved with the index).
+# The score of the hits is that of the aligner which would align each query first
+# (aligner_routing: AlignerRouting of the list of aligners).
+# If resolve_absent, the queries which do not occur in the DB are resolved (without hits),
+# otherwise these are not resolved, so that they are aligned
+def get_exact_hits(index, query_fasta, db_name, aligner_routing, resolve_absent = False):
+    hits = []
+    unresolved = []
+    
+    for header, sequence in query_fasta.get_sequences():
+        query_id = header.split(" ")[0]
+        
+        occurrences = index.find(sequence)
+        if occurrences == None or (len(occurrences) == 0 and not resolve_absent): # not resolved with the index
+            unresolved.append(query_id)
+            continue
+        
+        query_len = len(sequence)
+        align_score = get_perfect_score(aligner_routing.get_first_name(sequence), query_len)
+        
+        for (subject_id, local_position, strand) in occurrences:
+            hits.append(AlignmentResult(query_id, subject_id,
+                                        100.0, 100.0, align_score,
+                                        strand, 1L, long(query_len), long(local_position), long(local_position + query_len - 1),
+                                        db_name, ALGORITHM))
+    
+    return (hits, unresolved)
+
+## END
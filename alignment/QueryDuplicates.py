@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# QueryDuplicates.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import sys, string
+
+from AlignmentResult import AlignmentResult
+from barleymapcore.m2p_exception import m2pException
+
+DEDUP_NONE = "none"
+DEDUP_IDENTICAL = "identical" # queries with the same sequence
+DEDUP_REVCOMP = "revcomp" # also queries with the reverse complement sequence
+
+COMPLEMENT = string.maketrans("ACGTURYKMBDHVN", "TGCAAYRMKVHDBN")
+STRAND_FLIP = {"+":"-", "-":"+"}
+
+def reverse_complement(sequence):
+    return sequence.translate(COMPLEMENT)[::-1]
+
+### Collapses the queries of a QueryFasta with the same sequence
+### (case-insensitive, and optionally also those which are reverse complementary),
+### so that only one representative of each sequence is aligned.
+### The hits of each representative are then copied to the other queries
+### with its sequence (fan_out), and so are the unaligned representatives (fan_out_ids).
+class QueryDuplicates(object):
+    
+    _query_fasta = None
+    _representatives = None # QueryFasta with the queries to be aligned
+    _copies = None # representative id --> list of (query_id, is_revcomp) of the other queries with its sequence
+    _num_copies = 0
+    
+    def __init__(self, query_fasta, tmp_files_dir, dedup_mode = DEDUP_NONE, verbose = False):
+        self._query_fasta = query_fasta
+        self._representatives = query_fasta
+        self._copies = {}
+        self._num_copies = 0
+        
+        if dedup_mode == DEDUP_NONE: return
+        
+        if dedup_mode not in [DEDUP_IDENTICAL, DEDUP_REVCOMP]:
+            raise m2pException("QueryDuplicates: unrecognized deduplication mode "+str(dedup_mode)+".")
+        
+        revcomp = (dedup_mode == DEDUP_REVCOMP)
+        
+        representatives = {} # sequence --> representative id
+        representatives_ids = []
+        for query_id, (header, sequence) in zip(query_fasta.get_ids(), query_fasta.get_sequences()):
+            sequence = sequence.upper()
+            
+            if sequence in representatives:
+                self._copies[representatives[sequence]].append((query_id, False))
+                self._num_copies += 1
+                continue
+            
+            if revcomp:
+                rc_sequence = reverse_complement(sequence)
+                if rc_sequence in representatives:
+                    self._copies[representatives[rc_sequence]].append((query_id, True))
+                    self._num_copies += 1
+                    continue
+            
+            representatives[sequence] = query_id
+            representatives_ids.append(query_id)
+            self._copies.setdefault(query_id, [])
+        
+        if self._num_copies > 0:
+            self._representatives = query_fasta.subset(representatives_ids, tmp_files_dir)
+        
+        if verbose: sys.stderr.write("QueryDuplicates: "+str(len(query_fasta))+" queries, "+\
+                                     str(len(self._representatives))+" distinct sequences to align.\n")
+    
+    def get_representatives(self):
+        return self._representatives
+    
+    def get_num_copies(self):
+        return self._num_copies
+    
+    # Returns the results with a copy of each hit of a representative for each
+    # of its copies, in the same order than the hits of the representative
+    def fan_out(self, results):
+        
+        if self._num_copies == 0: return results
+        
+        fanned_results = []
+        for alignment_result in results:
+            fanned_results.append(alignment_result)
+            
+            for query_id, is_revcomp in self._copies.get(alignment_result.get_query_id(), []):
+                fanned_results.append(self._copy_result(alignment_result, query_id, is_revcomp))
+        
+        return fanned_results
+    
+    # Returns the ids of the representatives in rep_ids and their copies,
+    # in the order of the query fasta
+    def fan_out_ids(self, rep_ids):
+        
+        if self._num_copies == 0: return rep_ids
+        
+        fanned_ids = set()
+        for rep_id in rep_ids:
+            fanned_ids.add(rep_id)
+            for query_id, is_revcomp in self._copies.get(rep_id, []):
+                fanned_ids.add(query_id)
+        
+        return [query_id for query_id in self._query_fasta.get_ids() if query_id in fanned_ids]
+    
+    # A copy of the hit of a representative for other query with its sequence.
+    # If the query is the reverse complement, the strand and query positions are reversed.
+    def _copy_result(self, alignment_result, query_id, is_revcomp):
+        
+        strand = alignment_result.get_strand()
+        qstart_pos = alignment_result.get_qstart_pos()
+        qend_pos = alignment_result.get_qend_pos()
+        
+        if is_revcomp:
+            query_len = self._query_fasta.get_seq_len(query_id)
+            strand = STRAND_FLIP.get(strand, strand)
+            (qstart_pos, qend_pos) = (query_len - qend_pos + 1, query_len - qstart_pos + 1)
+        
+        return AlignmentResult(query_id, alignment_result.get_subject_id(),
+                               alignment_result.get_align_ident(), alignment_result.get_query_cov(),
+                               alignment_result.get_align_score(),
+                               strand, qstart_pos, qend_pos,
+                               alignment_result.get_local_position(), alignment_result.get_end_position(),
+                               alignment_result.get_db_id(), alignment_result.get_algorithm())
+    
+    # Removes the fasta of representatives, if it was created
+    def remove(self):
+        if self._representatives is not self._query_fasta:
+            self._representatives.remove()
+        
+        return
+
+## END
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# QueryFasta.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import sys, os, tempfile
+
+COPY_BLOCK_SIZE = 1048576 # bytes read at once when copying records to a subset
+
+# memfd_create (Linux >= 3.17, glibc >= 2.27) is used to keep subsets of queries in memory.
+# If it is not available, subsets are written to temporary files.
+try:
+    import ctypes, ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno = True)
+    _memfd_create = _libc.memfd_create
+    _memfd_create.argtypes = [ctypes.c_char_p, ctypes.c_uint]
+    _memfd_create.restype = ctypes.c_int
+except (ImportError, OSError, AttributeError):
+    _memfd_create = None
+
+def is_memfd_available():
+    return _memfd_create != None and os.path.isdir("/proc/self/fd")
+
+# Returns (file descriptor, path) of a new anonymous file in memory,
+# or (None, None) if memfd_create is not available.
+# The path (/proc/self/fd/N) can be opened as a regular file while the file
+# descriptor is open, also by the aligners, which inherit the descriptor.
+def create_memfd(name):
+    if not is_memfd_available():
+        return (None, None)
+    
+    memfd = _memfd_create(name, 0)
+    if memfd < 0:
+        return (None, None)
+    
+    return (memfd, "/proc/self/fd/"+str(memfd))
+
+### Query fasta file, indexed in a single pass.
+### Keeps the headers and ids (first word of the header) of the queries,
+### in the order of the file, and the byte range and sequence length of each one,
+### so that the same object can be shared by engines and aligners
+### instead of reading the fasta file again at each step.
+### Subsets of queries are written by copying the byte ranges
+### of their records into a new (temporary) fasta file or,
+### if in_memory, into an anonymous file in memory (memfd), so that
+### the aligners read them through a path without any disk writes.
+class QueryFasta(object):
+    
+    _fasta_path = ""
+    _headers = None # headers of the queries, in the order of the fasta file
+    _ids = None # normalised ids: first word of each header
+    _records = None # (offset, length, seq_len) of each query (byte range of header and sequence)
+    _index = None # query_id --> position in _records (first record with that id)
+    _is_temp = False # subsets are temporary files, removed with remove()
+    _memfd = None # file descriptor of subsets in memory
+    _in_memory = False # whether subsets of this fasta are created in memory
+    
+    def __init__(self, fasta_path, records = None, is_temp = False, memfd = None, in_memory = False):
+        self._fasta_path = fasta_path
+        self._is_temp = is_temp
+        self._memfd = memfd
+        self._in_memory = in_memory
+        
+        if records == None:
+            records = self._index_fasta(fasta_path)
+        
+        (self._headers, self._records) = records
+        self._ids = [header.split(" ")[0] for header in self._headers]
+        
+        self._index = {}
+        for record_num, query_id in enumerate(self._ids):
+            if query_id not in self._index: self._index[query_id] = record_num
+    
+    def _index_fasta(self, fasta_path):
+        headers = []
+        records = []
+        
+        offset = 0
+        record_offset = -1
+        seq_len = 0
+        with open(fasta_path, 'rb') as fasta_file:
+            for fasta_line in fasta_file:
+                if fasta_line.startswith(">"):
+                    if record_offset != -1:
+                        records.append((record_offset, offset - record_offset, seq_len))
+                    headers.append(fasta_line[1:].strip())
+                    record_offset = offset
+                    seq_len = 0
+                elif record_offset != -1:
+                    seq_len += len(fasta_line.strip())
+                
+                offset += len(fasta_line)
+        
+        if record_offset != -1:
+            records.append((record_offset, offset - record_offset, seq_len))
+        
+        return (headers, records)
+    
+    def get_path(self):
+        return self._fasta_path
+    
+    def get_headers(self):
+        return self._headers
+    
+    def get_ids(self):
+        return self._ids
+    
+    def is_in_memory(self):
+        return self._memfd != None
+    
+    # Whether subsets of this fasta (and other files of its queries) are created in memory
+    def get_subsets_in_memory(self):
+        return self._in_memory
+    
+    def get_num_queries(self):
+        return len(self._ids)
+    
+    def __len__(self):
+        return len(self._ids)
+    
+    def has_query(self, query_id):
+        return query_id in self._index
+    
+    def get_seq_len(self, query_id):
+        return self._records[self._index[query_id]][2]
+    
+    # Returns a dict query_id --> sequence length
+    def get_lengths(self):
+        return dict([(query_id, self._records[self._index[query_id]][2]) for query_id in self._index])
+    
+    def get_sequence(self, query_id):
+        (offset, length, seq_len) = self._records[self._index[query_id]]
+        with open(self._fasta_path, 'rb') as fasta_file:
+            fasta_file.seek(offset)
+            record_lines = fasta_file.read(length).split("\n")
+        
+        return "".join([seq_line.strip() for seq_line in record_lines[1:]])
+    
+    # Yields (header, sequence) of each query, in the order of the fasta file
+    def get_sequences(self):
+        with open(self._fasta_path, 'rb') as fasta_file:
+            for header, (offset, length, seq_len) in zip(self._headers, self._records):
+                fasta_file.seek(offset)
+                record_lines = fasta_file.read(length).split("\n")
+                yield (header, "".join([seq_line.strip() for seq_line in record_lines[1:]]))
+        
+        return
+    
+    # Ids of the queries which are not in aligned_ids, in the order of the fasta file
+    def get_unaligned(self, aligned_ids):
+        aligned_set = aligned_ids if isinstance(aligned_ids, (set, frozenset)) else set(aligned_ids)
+        
+        return [query_id for query_id in self._ids if query_id not in aligned_set]
+    
+    # Writes the records of query_ids to a new fasta file in tmp_files_dir
+    # (or in memory), keeping the order of this fasta, and returns it as a new QueryFasta.
+    # The new file has to be deleted with remove() once it is not needed.
+    def subset(self, query_ids, tmp_files_dir):
+        query_set = set([query_id.split(" ")[0] for query_id in query_ids])
+        
+        subset_headers = []
+        subset_records = []
+        ranges = [] # byte ranges to copy, merging adjacent records
+        subset_offset = 0
+        for record_num, query_id in enumerate(self._ids):
+            if query_id not in query_set: continue
+            
+            (offset, length, seq_len) = self._records[record_num]
+            
+            subset_headers.append(self._headers[record_num])
+            subset_records.append((subset_offset, length, seq_len))
+            subset_offset += length
+            
+            if len(ranges) > 0 and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+            else:
+                ranges.append((offset, length))
+        
+        memfd = None
+        if self._in_memory:
+            (memfd, subset_path) = create_memfd("m2p_facade")
+            if memfd == None:
+                sys.stderr.write("QueryFasta: subsets in memory are not available. Using "+str(tmp_files_dir)+"\n")
+                self._in_memory = False
+        
+        if memfd != None:
+            file_desc = os.dup(memfd) # memfd is kept open until remove()
+        else:
+            (file_desc, subset_path) = tempfile.mkstemp(suffix="_m2p_facade", dir=tmp_files_dir)
+        
+        try:
+            with os.fdopen(file_desc, 'wb') as subset_file:
+                with open(self._fasta_path, 'rb') as fasta_file:
+                    for (offset, length) in ranges:
+                        fasta_file.seek(offset)
+                        while length > 0:
+                            data = fasta_file.read(min(length, COPY_BLOCK_SIZE))
+                            if not data: break
+                            subset_file.write(data)
+                            length -= len(data)
+        except Exception:
+            if memfd != None: os.close(memfd)
+            else: os.remove(subset_path)
+            raise
+        
+        return QueryFasta(subset_path, (subset_headers, subset_records), is_temp = True,
+                          memfd = memfd, in_memory = self._in_memory)
+    
+    # Removes the fasta file, only if it is a temporary subset
+    def remove(self):
+        if self._memfd != None:
+            os.close(self._memfd)
+            self._memfd = None
+        elif self._is_temp and os.path.exists(self._fasta_path):
+            os.remove(self._fasta_path)
+        
+        return
+
+# Returns query_fasta if it is already a QueryFasta,
+# or a new QueryFasta if it is the path to a fasta file.
+# in_memory: whether the subsets of a new QueryFasta are created in memory
+def load_query_fasta(query_fasta, in_memory = False):
+    if isinstance(query_fasta, QueryFasta):
+        return query_fasta
+    else:
+        return QueryFasta(query_fasta, in_memory = in_memory)
+
+## END
@@ -5,18 +5,28 @@
 # Copyright (C)  2013-2014  Carlos P Cantalapiedra.
 # (terms of use can be found within the distributed LICENSE file).
 
-import sys, re, os
+import sys, re, os, time
+from distutils.spawn import find_executable
+from bisect import bisect_left
+from operator import itemgetter
 from subprocess import Popen, PIPE
 
 from AlignmentResult import *
 from barleymapcore.m2p_exception import m2pException
+from barleymapcore.utils.process_utils import StreamedProcess
 
 #from Aligners import SELECTION_BEST_SCORE, SELECTION_NONE
 
 ALIGNER = "GMAP"
 MAX_NUMBER_PATHS_PER_QUERY = 100
 
-def __gmap(gmap_app_path, n_threads, threshold_id, threshold_cov, query_fasta_path, gmap_dbs_path, db_name, verbose = False):
+# GMAP batch mode of the workers: the whole index is loaded in memory (see get_best_score_hits)
+WORKER_BATCH_MODE = "5"
+# Line buffering of the output of the workers, so that the output of each query
+# is received as soon as it is aligned (see AlignerWorkers)
+WORKER_STDBUF_APP = "stdbuf"
+
+def __check_db(gmap_dbs_path, db_name):
     
     # CPCantalapiedra 201701
     ###### Check that DB is available for this aligner
@@ -27,10 +37,17 @@ def __gmap(gmap_app_path, n_threads, threshold_id, threshold_cov, query_fasta_pa
     if not (os.path.exists(dbpathfile) and os.path.isfile(dbpathfile)):
         raise m2pException("DB path "+dbpath+" for "+ALIGNER+" aligner NOT FOUND.")
     
+    return
+
+# GMAP command, without the query fasta
+def __gmap_command(gmap_app_path, n_threads, threshold_id, threshold_cov, gmap_dbs_path, db_name,
+                   batch_mode = "0", verbose = False):
+    
     # GMAP
     __command = "".join([gmap_app_path, \
                 " -t ", str(n_threads), \
-                " -B 0 -n ", str(MAX_NUMBER_PATHS_PER_QUERY)])
+                " -B ", batch_mode, " -n ", str(MAX_NUMBER_PATHS_PER_QUERY), \
+                " -Z"]) # compressed output (see GMAPCompressedParser)
     
     gmap_thres_id = float(threshold_id) / 100.0
     gmap_thres_cov = float(threshold_cov) / 100.0
@@ -42,315 +59,308 @@ def __gmap(gmap_app_path, n_threads, threshold_id, threshold_cov, query_fasta_pa
     __db = "".join([" -d ", db_name])
     __db_dir = "".join([" -D ", gmap_dbs_path])
     
-    gmap_cmd = " ".join([__command, __filter_id, __filter_cov, __db, __db_dir, query_fasta_path])
+    gmap_cmd = " ".join([__command, __filter_id, __filter_cov, __db, __db_dir])
     
-    if verbose: sys.stderr.write("m2p_gmap: Executing '"+gmap_cmd+"'\n")
+    return gmap_cmd
+
+def __gmap(gmap_app_path, n_threads, threshold_id, threshold_cov, query_fasta_path, gmap_dbs_path, db_name, verbose = False):
     
-    retValue = 0
-    FNULL = open(os.devnull, 'w')
-    if verbose:
-        p = Popen(gmap_cmd, shell=True, stdout=PIPE, stderr=sys.stderr)
-    else:
-        p = Popen(gmap_cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    
-    com_list = p.communicate()
-    output = com_list[0]
-    output_err = com_list[1]
-    retValue = p.returncode
-    
-    if retValue != 0:
-        if verbose:
-            raise Exception("m2p_gmap: return != 0. "+gmap_cmd+"\n")
-        else:
-            raise Exception("m2p_gmap: return != 0. "+gmap_cmd+"\nError: "+str(output_err)+"\n")
+    __check_db(gmap_dbs_path, db_name)
     
-    if verbose: sys.stderr.write("m2p_gmap: GMAP return value "+str(retValue)+"\n"+str(output_err)+"\n")
+    gmap_cmd = " ".join([__gmap_command(gmap_app_path, n_threads, threshold_id, threshold_cov, gmap_dbs_path, db_name,
+                                        verbose = verbose),
+                         query_fasta_path])
     
-    results = __compress(output, db_name)
+    if verbose: sys.stderr.write("m2p_gmap: Executing '"+gmap_cmd+"'\n")
     
-    #print "M2PGMAP***********************"
-    #for result in results:
-    #    print result
+    # The output is not buffered: it is parsed and filtered
+    # as it is read from the pipe
+    process = StreamedProcess(gmap_cmd)
     
-    return results
+    return process
 
-# NOTE that this method could create an different format
-# but that has been created like this for further compatibility with
-# existing GMAP -Z (compressed) format.
-def __compress(output, db_name):
+# Command of a GMAP worker: queries are read from stdin one at a time
+# (--input-buffer-size=1) and their output is written in the same order (--ordered)
+def __gmap_worker_command(gmap_app_path, n_threads, threshold_id, threshold_cov, gmap_dbs_path, db_name, verbose = False):
     
-    compressed = []
+    stdbuf_path = find_executable(WORKER_STDBUF_APP)
+    if not stdbuf_path: return None
     
-    new_line = None
-    query_id = None
-    is_chimera = False
+    gmap_cmd = " ".join([stdbuf_path, "-oL",
+                         __gmap_command(gmap_app_path, n_threads, threshold_id, threshold_cov, gmap_dbs_path, db_name,
+                                        WORKER_BATCH_MODE, verbose),
+                         "--ordered --input-buffer-size=1"])
     
-    numb_exp = re.compile("[0-9]+\.[0-9]")
-    direction_exp = re.compile("cDNA direction: (sense|antisense|indeterminate)")
-    strand_exp = re.compile("([+-]) strand")
-    
-    for output_line in output.strip().split("\n"):
-        
-        ##print "M2PGMAP***********************"
-        #sys.stdout.write(str(output_line)+"\n")
+    return gmap_cmd
+
+# Fields of the lines of GMAP compressed output (-Z) which report a path:
+# >query_id db_version path_num/num_paths query_length num_exons coverage identity
+#  qstart..qend genome_start..genome_end chrom:start..end strand dir:direction [md5:...]
+# Note that the coverage of -Z output is the one which GMAP computes over the whole query,
+# whereas the summary output, read by previous versions of barleymap, reports also
+# the "Trimmed coverage" (over the query without the ends trimmed by GMAP, e.g. poly-A tails),
+# which was the coverage of the hits. Both are the same for queries without trimmed ends,
+# otherwise the coverage of the hits is now lower than before. The filter of paths
+# by coverage is still that of GMAP (--min-trimmed-coverage), so the same paths are reported,
+# but they could be selected differently by their coverage (see ParetoFront).
+# This has not been checked against the output of every version of GMAP.
+Z_FIELD_PATHS = 2
+Z_FIELD_COV = 5
+Z_FIELD_IDENT = 6
+Z_FIELD_QUERY_POS = 7
+Z_FIELD_CHROM_POS = 9
+Z_FIELD_STRAND = 10
+Z_MIN_FIELDS = 11
+
+### Single-pass parser of GMAP compressed output (-Z).
+### Each path is reported by GMAP in a single line (see Z_FIELD_*),
+### followed by a line for each of its exons, which are skipped.
+### The paths of a query are reported together, and are returned
+### as AlignmentResult, without any intermediate text format.
+### The queries which GMAP reports as chimeras are skipped.
+class GMAPCompressedParser(object):
+    
+    _db_name = ""
+    _num_chimeras = 0
+    
+    def __init__(self, db_name):
+        self._db_name = db_name
+        self._num_chimeras = 0
+    
+    def get_num_chimeras(self):
+        return self._num_chimeras
+    
+    # Yields (query_id, list of AlignmentResult) for each query with paths
+    def parse(self, output_lines):
+        db_name = self._db_name
+        algorithm = "gmap"
         
-        ## Header of query
-        if output_line.startswith(">"):
-            if query_id != None:
-                prev_query_id = query_id
-            else:
-                prev_query_id = output_line
-            query_id = output_line
+        query_id = None
+        query_hits = []
+        is_chimera = False
         
-        ## Data of query
-        else:
+        for line in output_lines:
             
-            if "chimera" in output_line:
-                compressed.append("chimera")
-                is_chimera = True
-                query_id = prev_query_id
+            if not line.startswith(">"): continue # exon lines
+            
+            line_data = line.split()
+            
+            # Queries without paths
+            if len(line_data) < Z_MIN_FIELDS or line_data[Z_FIELD_PATHS].startswith("0/"):
                 continue
-            elif output_line.startswith("Paths "):
+            
+            path_query_id = line_data[0][1:]
+            if path_query_id != query_id:
+                if len(query_hits) > 0: yield (query_id, query_hits)
+                query_id = path_query_id
+                query_hits = []
                 is_chimera = False
-                if "Paths (0)" in output_line:
-                    query_id = prev_query_id
-                    continue
-                
-            elif is_chimera:
+            
+            if is_chimera: continue
+            
+            if "chimera" in line:
+                is_chimera = True
+                self._num_chimeras += 1
+                query_hits = []
                 continue
+            
+            align_ident = float(line_data[Z_FIELD_IDENT])
+            query_cov = float(line_data[Z_FIELD_COV])
+            
+            (qstart_pos, qend_pos) = line_data[Z_FIELD_QUERY_POS].split("..")
+            qstart_pos = long(qstart_pos)
+            qend_pos = long(qend_pos)
+            
+            (subject_id, chrom_pos) = line_data[Z_FIELD_CHROM_POS].rsplit(":", 1)
+            (chrom_start, chrom_end) = chrom_pos.split("..")
+            
+            strand = line_data[Z_FIELD_STRAND]
+            if strand == "+":
+                local_position = long(chrom_start)
+                end_position = long(chrom_end)
+            elif strand == "-":
+                local_position = long(chrom_end)
+                end_position = long(chrom_start)
             else:
-                if "cDNA direction" in output_line:
-                    # which is faster
-                    re_obj = re.search(direction_exp, output_line).group(1)
-                    direction = str(re_obj)
-                    # or
-                    #direction = str(output_line.strip().split(" ")[2])
-                
-                if "Genomic pos" in output_line:
-                    re_obj = re.search(strand_exp, output_line).group(1)
-                    strand = str(re_obj)
-                    #strand = str(output_line.strip().split(" ")[3][1])
-                
-                if "Trimmed coverage" in output_line:
-                    re_obj = re.search(numb_exp, output_line).group(0)
-                    query_cov = float(re_obj)
-                    #query_cov = float(output_line.strip().split(" ")[2])
-                
-                if "Percent identity" in output_line:
-                    re_obj = re.search(numb_exp, output_line).group(0)
-                    identity = float(re_obj)
-                    #identity = float(output_line.strip().split(" ")[2])
-                    
-                if "Path" in output_line:
-                    
-                    ## Add data of the previous line
-                    #sys.stderr.write("New line "+str(new_line)+"\n")
-                    
-                    if new_line != None:
-                        #sys.stderr.write("INTO NEW LINE "+str(new_line)+"\n")
-                        
-                        new_line.append(prev_query_id)
-                        prev_query_id = query_id
-                        
-                        new_line.append(db_name)
-                        new_line.append("0/0") # I dont need this field with path_number/total_paths
-                        new_line.append("0") # I dont need either the query length
-                        new_line.append("0") # Nor the exon number
-                        new_line.append(str(query_cov))
-                        new_line.append(str(identity))
-                        new_line.append(str(qstart)+".."+str(qend))
-                        new_line.append("0..0") # Whole genome GMAP coordinates
-                        new_line.append(subject_id+":"+str(sstart)+".."+str(send))
-                        new_line.append(str(strand))
-                        new_line.append("dir:"+str(direction))
-                        
-                        #sys.stderr.write("Inserting new line: "+str(new_line)+"\n")
-                        
-                        compressed.append(" ".join(new_line))
-                        
-                        new_line = None
-                    
-                    new_line = []
-                    path_line = output_line.strip().split(" ")
-                    
-                    qstart = path_line[3].split("..")[0]
-                    qend = path_line[3].split("..")[1]
-                    
-                    subject_data = path_line[8].split(":")
-                    subject_id = subject_data[0]
-                    sstart = subject_data[1].split("..")[0].replace(",", "")
-                    send = subject_data[1].split("..")[1].replace(",", "")
-    
-    ## Last alignment found
-    if new_line != None:
+                raise Exception("m2p_gmap: wrong strand "+str(strand)+".")
+            
+            align_score = (qend_pos - qstart_pos) * (align_ident / 100)
+            
+            query_hits.append(AlignmentResult(query_id, subject_id,
+                                              align_ident, query_cov, align_score,
+                                              strand, qstart_pos, qend_pos, local_position, end_position,
+                                              db_name, algorithm))
         
-        #sys.stderr.write("LAST new line "+str(new_line)+"\n")
+        if len(query_hits) > 0: yield (query_id, query_hits)
         
-        new_line.append(prev_query_id)
-        prev_query_id = query_id
+        return
+
+### Pareto front of the paths of a query over (identity, coverage).
+### A path is kept unless another path has equal or greater identity and coverage,
+### and is better in at least one of them. Paths with the same identity and coverage
+### are all kept. The distinct points of the front are kept sorted by identity
+### (ascending) and thus by coverage (descending), so that each new path is checked
+### with a binary search instead of comparing it with every kept path.
+class ParetoFront(object):
+    
+    _idents = None # ascending
+    _covs = None # descending
+    _hits = None # for each point, list of (insertion_order, hit)
+    _num_added = 0
+    
+    def __init__(self):
+        self._idents = []
+        self._covs = []
+        self._hits = []
+        self._num_added = 0
+    
+    # Returns True if the hit is kept in the front
+    def add(self, align_ident, query_cov, hit):
+        idents = self._idents
+        covs = self._covs
         
-        new_line.append(db_name)
-        new_line.append("0/0") # I dont need this field with path_number/total_paths
-        new_line.append("0") # I dont need either the query length
-        new_line.append("0") # Nor the exon number
-        new_line.append(str(query_cov))
-        new_line.append(str(identity))
-        new_line.append(str(qstart)+".."+str(qend))
-        new_line.append("0..0") # Whole genome GMAP coordinates
-        new_line.append(subject_id+":"+str(sstart)+".."+str(send))
-        new_line.append(str(strand))
-        new_line.append("dir:"+str(direction))
+        hit_order = self._num_added
+        self._num_added += 1
         
-        #sys.stderr.write("Inserting new line: "+str(new_line)+"\n")
+        # First point with identity >= align_ident,
+        # which has the highest coverage among those points
+        pos = bisect_left(idents, align_ident)
         
-        compressed.append(" ".join(new_line))
-    
-    #sys.stderr.write("Len results "+str(len(compressed))+"\n")
+        end = pos
+        if pos < len(idents):
+            if idents[pos] == align_ident and covs[pos] == query_cov:
+                self._hits[pos].append((hit_order, hit))
+                return True
+            
+            if covs[pos] >= query_cov:
+                return False # dominated
+            
+            if idents[pos] == align_ident:
+                end = pos + 1 # same identity, lower coverage: dominated by the new hit
+        
+        # Points with lower identity and lower or equal coverage are dominated by the new hit
+        start = pos
+        while start > 0 and covs[start-1] <= query_cov:
+            start -= 1
+        
+        idents[start:end] = [align_ident]
+        covs[start:end] = [query_cov]
+        self._hits[start:end] = [[(hit_order, hit)]]
+        
+        return True
     
-    return compressed
+    # Hits in the front, in the order they were added
+    def get_hits(self):
+        front_hits = [order_hit for point_hits in self._hits for order_hit in point_hits]
+        front_hits.sort(key=itemgetter(0))
+        return [hit for hit_order, hit in front_hits]
 
-def __filter_gmap_results(results, threshold_id, threshold_cov, db_name, verbose = False):
+# The paths of each query which are not dominated by another path of the same query
+def __filter_gmap_results(output_lines, db_name, verbose = False):
     filtered_results = []
     
-    chimera_num = 0 #chimera_dict = set([])
     filter_dict = {}
     
-    #debug = True
-    
-    strand_exp = re.compile("([0-9]+)..([0-9]+)")
+    parser = GMAPCompressedParser(db_name)
     
-    algorithm = "gmap"
-    
-    for line in results:
-        
-        #sys.stderr.write("m2p_gmap Result "+str(line)+"\n")
-        
-        # Specific GMAP pre-filter: chimera results
-        if line.find("chimera") != -1:
-            #sys.stderr.write("GMAP chimera "+str([line.split(" ")[0][1:]])+"\n")
-            chimera_num += 1 #chimera_dict.add(str([line.split(" ")[0][1:]]))
-            continue
-        
-        line_data = line.split(" ")
-        
-        #sys.stderr.write("Line "+str(line)+"\n")
-        #sys.stderr.write("Data "+str(line_data)+"\n")
-        
-        query_id = line_data[0][1:]
-        subject_id = line_data[9].split(":")[0] # Because GMAP adding subject positions after subject name separated by ":" in compress output mode
-        align_ident = float(line_data[6])
-        query_cov = float(line_data[5])
-        
-        strand = line_data[10]
-        
-        strand = line_data[10]
-        s_pos = re.search(strand_exp, line_data[9])
-        
-        if strand == "+":
-            local_position = long(line_data[9].split(":")[1].split("..")[0])
-            end_position = long(line_data[9].split(":")[1].split("..")[1])
-            #local_position = long(s_pos.group(1))
-        elif strand == "-":
-            local_position = long(line_data[9].split(":")[1].split("..")[1])
-            end_position = long(line_data[9].split(":")[1].split("..")[0])
-            #local_position = long(s_pos.group(2))
-        else:
-            raise Exception("m2p_gmap: wrong strand "+str(strand)+".")
-        
-        #sys.stderr.write("Local position "+str(local_position)+"\n")
-        
-        query_positions = line_data[7].split("..")
-        qstart_pos = query_positions[0]
-        qend_pos = query_positions[1]
-        align_score = (long(qend_pos) - long(qstart_pos)) * (align_ident / 100)
-        #if query_id == "i_BK_02": debug = True
-        #else: debug = False
-        
-        result_tuple = AlignmentResult()
-        result_tuple.create_from_attributes(query_id, subject_id,
-                                        align_ident, query_cov, align_score,
-                                        strand, qstart_pos, qend_pos, local_position, end_position,
-                                        db_name, algorithm)
+    for (query_id, query_hits) in parser.parse(output_lines):
         
         # For a given DB, keep always the best score
-        #if selection == SELECTION_BEST_SCORE:
+        # (the paths which are not dominated by another path of the same query)
         if query_id in filter_dict:
-            prev_max_scores = filter_dict[query_id]["max_scores"]
-            
-            new_max_score = True
-            new_max_score_list = []
-            new_query_list = []
-            for i, max_score in enumerate(prev_max_scores):
-                best_query = filter_dict[query_id]["query_list"][i]
-                
-                #print "m2p_gmap************************"
-                #print str(max_score)+"-"+str(best_query)
-                
-                max_align_ident = max_score[0]
-                max_query_cov = max_score[1]
-                
-                # If it is worse than at least one alignment, it will be discarded
-                if (align_ident <= max_align_ident and query_cov < max_query_cov) \
-                or (align_ident < max_align_ident and query_cov <= max_query_cov):
-                    
-                    new_max_score = False # The new alignment is definitely discarded
-                    new_max_score_list.append(max_score)
-                    new_query_list.append(best_query)
-                
-                # If it is equal as another, the existing one remains in the new list
-                elif (align_ident == max_align_ident and query_cov == max_query_cov):
-                    
-                    new_max_score_list.append(max_score)
-                    new_query_list.append(best_query)
-                
-                # If it is as good as another, but different
-                elif (align_ident > max_align_ident and query_cov < max_query_cov) \
-                or (align_ident < max_align_ident and query_cov > max_query_cov):
-                    
-                    new_max_score_list.append(max_score)
-                    new_query_list.append(best_query)
-                
-                # If it is better than the other, the old one is not added to the new list
-                elif (align_ident >= max_align_ident and query_cov > max_query_cov) \
-                or (align_ident > max_align_ident and query_cov >= max_query_cov):
-                    
-                    pass#new_max_score_list.append((align_ident, query_cov))
-                
-                else:
-                    raise Exception("m2p_gmap: unknown max score relation between alignments.")
-            
-            if new_max_score:
-                new_max_score_list.append((align_ident, query_cov))
-                new_query_list.append(result_tuple)
-            
-            # Update the max_scores list for this query
-            filter_dict[query_id]["max_scores"] = new_max_score_list
-            filter_dict[query_id]["query_list"] = new_query_list
-            
+            query_front = filter_dict[query_id]
         else:
-            filter_dict[query_id] = {"query_list":[result_tuple], "max_scores":[(align_ident, query_cov)]}
+            query_front = ParetoFront()
+            filter_dict[query_id] = query_front
         
+        for hit in query_hits:
+            query_front.add(hit.get_align_ident(), hit.get_query_cov(), hit)
+    
     # Recover filtered results
     for query_id in filter_dict:
-        for alignment_result in filter_dict[query_id]["query_list"]:
-            filtered_results.append(alignment_result)
+        filtered_results.extend(filter_dict[query_id].get_hits())
     
-    if verbose: sys.stderr.write("m2p_gmap: number of chimeras found: "+str(chimera_num)+"\n")
+    if verbose: sys.stderr.write("m2p_gmap: number of chimeras found: "+str(parser.get_num_chimeras())+"\n")
     
     return filtered_results
 
+# Alignment with a GMAP worker of workers_pool (AlignerWorkersPool),
+# which keeps the DB index loaded between requests.
+# Returns None if no worker could be used.
+def __get_best_score_hits_worker(workers_pool, gmap_app_path, n_threads, query_fasta_path, gmap_dbs_path, db_name, \
+                                 threshold_id, threshold_cov, verbose = False):
+    results = None
+    
+    worker_cmd = __gmap_worker_command(gmap_app_path, n_threads, threshold_id, threshold_cov, gmap_dbs_path, db_name, verbose)
+    if worker_cmd == None:
+        if verbose: sys.stderr.write("m2p_gmap: "+WORKER_STDBUF_APP+" not found. GMAP workers can not be used.\n")
+        return None
+    
+    worker_key = (ALIGNER, gmap_app_path, gmap_dbs_path, db_name, n_threads, float(threshold_id), float(threshold_cov))
+    
+    start_time = time.time()
+    
+    (worker, cold) = workers_pool.acquire_worker(worker_key, worker_cmd)
+    if worker == None:
+        if verbose: sys.stderr.write("m2p_gmap: no GMAP worker available for "+db_name+".\n")
+        return None
+    
+    if verbose: sys.stderr.write("m2p_gmap: "+query_fasta_path+" to GMAP worker of "+db_name+"\n")
+    
+    worker_failed = True
+    try:
+        results = __filter_gmap_results(worker.request_lines(query_fasta_path), db_name, verbose)
+        worker_failed = False
+    except Exception as e:
+        sys.stderr.write("m2p_gmap: GMAP worker failed. "+str(e)+"\n")
+    finally:
+        workers_pool.release_worker(worker, worker_failed)
+    
+    if worker_failed: return None
+    
+    workers_pool.record_request(cold, time.time() - start_time)
+    
+    return results
+
+# workers_pool: if an AlignerWorkersPool is given, GMAP workers are used,
+# falling back to a new GMAP process if a worker is not available.
+# If GMAP reported errors (and thus 0 results), db_name is appended to errors.
 def get_best_score_hits(gmap_app_path, n_threads, query_fasta_path, gmap_dbs_path, db_name, \
-             threshold_id, threshold_cov, verbose = False):
+             threshold_id, threshold_cov, verbose = False, workers_pool = None, errors = None):
     results = []
     
+    if workers_pool != None:
+        __check_db(gmap_dbs_path, db_name)
+        
+        results = __get_best_score_hits_worker(workers_pool, gmap_app_path, n_threads, query_fasta_path, gmap_dbs_path, db_name, \
+                                               threshold_id, threshold_cov, verbose)
+        if results != None:
+            if verbose: sys.stderr.write("m2p_gmap: pass-filter results --> "+str(len(results))+"\n")
+            return results
+        
+        results = []
+    
     if verbose: sys.stderr.write("m2p_gmap: "+query_fasta_path+" against "+db_name+"\n")
     
-    results = __gmap(gmap_app_path, n_threads, threshold_id, threshold_cov, query_fasta_path,
+    start_time = time.time()
+    
+    process = __gmap(gmap_app_path, n_threads, threshold_id, threshold_cov, query_fasta_path,
                      gmap_dbs_path, db_name, verbose)
     
-    if verbose: sys.stderr.write("m2p_gmap: raw results --> "+str(len(results))+"\n")
-    if len(results)>0:
-        results = __filter_gmap_results(results, threshold_id, threshold_cov, db_name, verbose)
+    try:
+        results = __filter_gmap_results(process.lines(), db_name, verbose)
+    finally:
+        process.close()
+    
+    if verbose: sys.stderr.write("m2p_gmap: raw output lines --> "+str(process.get_num_lines())+"\n")
+    
+    # Errors are detected from the exit code and stderr of GMAP
+    if not process.check("m2p_gmap", verbose):
+        results = []
+        if errors != None: errors.append(db_name)
+    
+    if workers_pool != None: workers_pool.record_request(True, time.time() - start_time)
+    
     if verbose: sys.stderr.write("m2p_gmap: pass-filter results --> "+str(len(results))+"\n")
     #sys.stderr.write(str(results)+"\n")
     
@@ -10,6 +10,7 @@ from subprocess import Popen, PIPE
 
 from barleymapcore.utils.alignment_utils import load_fasta_lengths
 from barleymapcore.m2p_exception import m2pException
+from barleymapcore.utils.process_utils import StreamedProcess, ProcessCancelledException
 from AlignmentResult import *
 
 #from Aligners import SELECTION_BEST_SCORE, SELECTION_NONE
@@ -26,8 +27,24 @@ ALIGN_SEND = 9
 ALIGN_SCORE = 11
 # ALIGN_QLEN = there is no query len in HS-Blastn tabular results
 
-def __hs_blast(hsblastn_app_path, n_threads, query_fasta_path, hsblastn_dbs_path, db_name, verbose = False):
-    results = []
+PUSHDOWN_ID_MARGIN = 0.01 # identity (%) below threshold_id still reported by HS-Blastn (pident is reported rounded)
+
+# HS-Blastn binaries which do not know -perc_identity, which are run without it
+__no_pushdown_apps = set()
+# Words of the error of HS-Blastn for an option which it does not know (lower case)
+UNKNOWN_OPTION_ERRORS = ["unknown", "unrecognized", "unrecognised", "invalid"]
+
+# Whether HS-Blastn failed because it does not know the -perc_identity option
+def __is_pushdown_error(err_output):
+    err_output = err_output.lower()
+    
+    if "perc_identity" not in err_output: return False
+    
+    return any([unknown_error in err_output for unknown_error in UNKNOWN_OPTION_ERRORS])
+
+# threshold_id: hits below it are discarded by HS-Blastn (-perc_identity), if not None.
+# Query coverage can not be applied by HS-Blastn, since it does not know the query length.
+def __hs_blast(hsblastn_app_path, n_threads, query_fasta_path, hsblastn_dbs_path, db_name, threshold_id = None, verbose = False):
     
     # CPCantalapiedra 201701
     ###### Check that DB is available for this aligner
@@ -45,6 +62,9 @@ def __hs_blast(hsblastn_app_path, n_threads, query_fasta_path, hsblastn_dbs_path
                 '-outfmt 6'])
                 #'-outfmt \"6 qseqid qlen sseqid slen length qstart qend sstart send bitscore evalue pident mismatch gapopen\"'])
     
+    if threshold_id != None:
+        blast_command = " ".join([blast_command, "-perc_identity", str(float(threshold_id) - PUSHDOWN_ID_MARGIN)])
+    
     blast_db = "".join(["-db ", dbpath]) # blast_db = "".join(["-db ", blast_dbs_path, db_name , ".fa"]) # 
     blast_query = " ".join(["-query ", query_fasta_path])
     #blast_cmd = " ".join([ResourcesMng.get_deploy_dir()+blast_command, blast_db, blast_query])
@@ -52,35 +72,18 @@ def __hs_blast(hsblastn_app_path, n_threads, query_fasta_path, hsblastn_dbs_path
     
     if verbose: sys.stderr.write(os.path.basename(__file__)+": Running '"+blast_cmd+"'\n")
     
-    retValue = 0
-    FNULL = open(os.devnull, 'w')
-    if verbose:
-        p = Popen(blast_cmd, shell=True, stdout=PIPE, stderr=sys.stderr)
-    else:
-        p = Popen(blast_cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    
-    com_list = p.communicate()
-    output = com_list[0]
-    output_err = com_list[1]
-    retValue = p.returncode
-    
-    if retValue != 0:
-        if verbose:
-            raise Exception(os.path.basename(__file__)+": HS-Blastn return != 0. "+blast_cmd+"\n"+str(output)+"\n")
-        else:
-            raise Exception(os.path.basename(__file__)+": HS-Blastn return != 0. "+blast_cmd+"\n"+str(output)+"\n"+str(output_err)+"\n")
-    
-    if "error" in output or "Error" in output or "ERROR" in output:
-        sys.stderr.write("m2p_hs_blast: error in hs-blastn output. We will report 0 results for this alignment.\n")
-        sys.stderr.write(output+"\n")
-        sys.stderr.write(str(output_err)+"\n")
-        results = []
-    else:
-        if verbose: sys.stderr.write(os.path.basename(__file__)+": HS-Blastn return value "+str(retValue)+"\n")
-        
-        [results.append(line) for line in output.strip().split("\n") if line != ""]
+    # The output is not buffered: hits are read from the pipe by the filter
+    process = StreamedProcess(blast_cmd)
+    
+    return process
+
+# Lines of tabular HS-Blastn output, as they arrive from the pipe
+def __blast_lines(process):
+    for line in process.lines():
+        if line != "":
+            yield line
     
-    return results
+    return
 
 def __filter_blast_results(results, threshold_id, threshold_cov, db_name, qlen_dict, verbose = False):
     
@@ -131,27 +134,26 @@ def __filter_blast_results(results, threshold_id, threshold_cov, db_name, qlen_d
         qstart_pos = long(line_data[ALIGN_QSTART])
         qend_pos = long(line_data[ALIGN_QEND])
         
-        result_tuple = AlignmentResult()
-        result_tuple.create_from_attributes(query_id, subject_id,
-                                        align_ident, query_cov, align_score,
-                                        strand, qstart_pos, qend_pos, local_position, end_position,
-                                        db_name, algorithm)
-        
         # For a given DB, keep always the best score
-        #if selection == SELECTION_BEST_SCORE:
+        # (the AlignmentResult is created only for hits which are kept)
         if query_id in filter_dict:
             prev_max_score = filter_dict[query_id]["max_score"]
             
             if align_score > prev_max_score:
-                filter_dict[query_id]["query_list"] = [result_tuple]
+                filter_dict[query_id]["query_list"] = []
                 filter_dict[query_id]["max_score"] = align_score
                 
-            elif align_score == prev_max_score:
-                filter_dict[query_id]["query_list"].append(result_tuple)
-            #else:
-            #    print "FILTERED"
+            elif align_score < prev_max_score:
+                continue
         else:
-            filter_dict[query_id] = {"query_list":[result_tuple], "max_score":align_score}
+            filter_dict[query_id] = {"query_list":[], "max_score":align_score}
+        
+        result_tuple = AlignmentResult(query_id, subject_id,
+                                       align_ident, query_cov, align_score,
+                                       strand, qstart_pos, qend_pos, local_position, end_position,
+                                       db_name, algorithm)
+        
+        filter_dict[query_id]["query_list"].append(result_tuple)
     
     # Recover filtered results
     for query_id in filter_dict:
@@ -160,19 +162,47 @@ def __filter_blast_results(results, threshold_id, threshold_cov, db_name, qlen_d
     
     return filtered_results
 
+# If HS-Blastn reported errors (and thus 0 results), db_name is appended to errors.
 def get_best_score_hits(hsblastn_app_path, n_threads, query_fasta_path, hsblastn_dbs_path, db_name, \
-                        threshold_id, threshold_cov, verbose = False):
+                        threshold_id, threshold_cov, verbose = False, qlen_dict = None, errors = None):
     
     if verbose: sys.stderr.write(os.path.basename(__file__)+": "+query_fasta_path+" against "+db_name+"\n")
     
-    results = __hs_blast(hsblastn_app_path, n_threads, query_fasta_path, hsblastn_dbs_path, db_name, verbose)
+    # HS-Blastn does not report the query length
+    # (qlen_dict: query_id --> length, if it has been already loaded)
+    if qlen_dict == None:
+        qlen_dict = load_fasta_lengths(query_fasta_path)
     
-    if verbose: sys.stderr.write(os.path.basename(__file__)+": raw results --> "+str(len(results))+"\n")
+    pushdown = hsblastn_app_path not in __no_pushdown_apps
     
-    if len(results)>0:
-        qlen_dict = load_fasta_lengths(query_fasta_path)
-        results = __filter_blast_results(results, threshold_id, threshold_cov, db_name, qlen_dict, verbose)
+    while True:
+        process = __hs_blast(hsblastn_app_path, n_threads, query_fasta_path, hsblastn_dbs_path, db_name,
+                             threshold_id if pushdown else None, verbose)
         
+        try:
+            results = __filter_blast_results(__blast_lines(process), threshold_id, threshold_cov, db_name, qlen_dict, verbose)
+        finally:
+            process.close()
+        
+        if verbose: sys.stderr.write(os.path.basename(__file__)+": raw results --> "+str(process.get_num_lines())+"\n")
+        
+        # Errors are detected from the exit code and stderr of HS-Blastn
+        try:
+            if not process.check(os.path.basename(__file__), verbose):
+                results = []
+                if errors != None: errors.append(db_name)
+        except ProcessCancelledException:
+            raise
+        except Exception:
+            # HS-Blastn versions without -perc_identity are run again without it
+            if not (pushdown and __is_pushdown_error(process.get_err_output())): raise
+            sys.stderr.write(os.path.basename(__file__)+": HS-Blastn does not know -perc_identity. Running it without it.\n")
+            __no_pushdown_apps.add(hsblastn_app_path)
+            pushdown = False
+            continue
+        
+        break
+    
     if verbose: sys.stderr.write(os.path.basename(__file__)+": pass-filter results --> "+str(len(results))+"\n")
     #sys.stderr.write(str(len(results))+"\n")
     #sys.stderr.write(str(results)+"\n")
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# m2p_minimap2.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import sys, os, threading
+from multiprocessing.pool import ThreadPool
+
+from AlignmentResult import *
+from m2p_gmap import ParetoFront
+from barleymapcore.m2p_exception import m2pException
+from barleymapcore.utils.process_utils import ProcessGroup, ProcessCancelledException
+
+# mappy (Python binding of minimap2) is optional: it is needed only for the minimap2 aligner
+try:
+    import mappy
+except ImportError:
+    mappy = None
+
+ALIGNER = "minimap2"
+MAX_NUMBER_HITS_PER_QUERY = 100 # as the max number of paths of GMAP (m2p_gmap)
+INDEX_EXT = ".mmi" # index prebuilt with "minimap2 -d"
+
+# Indexes already loaded in this process: (index path, preset) --> mappy.Aligner
+# They are kept loaded, and shared by all the threads and requests, since
+# mappy.Aligner.map is thread-safe (each thread uses its own mappy.ThreadBuffer)
+__indexes = {}
+__indexes_lock = threading.Lock()
+
+def is_available():
+    return mappy != None
+
+def get_version():
+    return "mappy:"+str(getattr(mappy, "__version__", None))
+
+def __get_index(minimap2_dbs_path, db_name, preset, n_threads, verbose = False):
+    
+    ###### Check that DB is available for this aligner
+    dbpathfile = os.path.join(minimap2_dbs_path, db_name + INDEX_EXT)
+    sys.stderr.write("Checking database: "+dbpathfile+" DB exists for "+ALIGNER+".\n")
+    
+    if not (os.path.exists(dbpathfile) and os.path.isfile(dbpathfile)):
+        raise m2pException("DB path "+dbpathfile+" for "+ALIGNER+" aligner NOT FOUND.")
+    
+    index_key = (dbpathfile, preset)
+    
+    with __indexes_lock:
+        if index_key in __indexes:
+            return __indexes[index_key]
+        
+        if verbose: sys.stderr.write("m2p_minimap2: loading index "+dbpathfile+"\n")
+        
+        index = mappy.Aligner(fn_idx_in = dbpathfile, preset = preset if preset != "" else None,
+                              n_threads = n_threads, best_n = MAX_NUMBER_HITS_PER_QUERY)
+        if not index:
+            raise m2pException("m2p_minimap2: index "+dbpathfile+" could not be loaded.")
+        
+        __indexes[index_key] = index
+    
+    return index
+
+# Aligns the records (header, sequence) of a chunk of queries.
+# Returns a list of (query_id, list of AlignmentResult) of the queries with hits
+def __map_chunk(index, records, threshold_id, threshold_cov, db_name):
+    chunk_results = []
+    
+    group = ProcessGroup.get_current()
+    
+    thres_id = float(threshold_id)
+    thres_cov = float(threshold_cov)
+    
+    algorithm = "minimap2"
+    
+    thread_buffer = mappy.ThreadBuffer()
+    
+    for header, sequence in records:
+        if group != None and group.is_cancelled():
+            raise ProcessCancelledException("m2p_minimap2: alignment cancelled.")
+        
+        query_id = header.split(" ")[0]
+        query_len = len(sequence)
+        if query_len == 0: continue
+        
+        # For a given DB, keep always the best score
+        # (the hits which are not dominated by another hit of the same query)
+        query_front = None
+        
+        for hit in index.map(sequence, buf = thread_buffer):
+            
+            # filter: based on identity
+            align_ident = (hit.mlen / float(hit.blen))*100
+            if align_ident < thres_id:
+                continue
+            
+            # filter: based on query coverage of alignment
+            query_cov = ((hit.q_en - hit.q_st) / float(query_len))*100
+            if query_cov < thres_cov:
+                continue
+            
+            # mappy positions are 0-based, end excluded.
+            # local_position is the leftmost position in both strands, as for the other aligners
+            qstart_pos = long(hit.q_st + 1)
+            qend_pos = long(hit.q_en)
+            local_position = long(hit.r_st + 1)
+            end_position = long(hit.r_en)
+            strand = "+" if hit.strand == 1 else "-"
+            
+            align_score = (qend_pos - qstart_pos) * (align_ident / 100)
+            
+            if query_front == None: query_front = ParetoFront()
+            query_front.add(align_ident, query_cov,
+                            AlignmentResult(query_id, hit.ctg,
+                                            align_ident, query_cov, align_score,
+                                            strand, qstart_pos, qend_pos, local_position, end_position,
+                                            db_name, algorithm))
+        
+        if query_front != None:
+            chunk_results.append((query_id, query_front.get_hits()))
+    
+    return chunk_results
+
+# The queries are aligned in-process, by n_threads threads
+# (mappy releases the GIL while aligning), with the index of the DB
+# which is loaded once and reused by later calls.
+def get_best_score_hits(minimap2_dbs_path, preset, n_threads, query_fasta, db_name, \
+                        threshold_id, threshold_cov, verbose = False):
+    results = []
+    
+    if mappy == None:
+        raise m2pException("m2p_minimap2: mappy is not installed. It is required to align with "+ALIGNER+".")
+    
+    index = __get_index(minimap2_dbs_path, db_name, preset, n_threads, verbose)
+    
+    if verbose: sys.stderr.write("m2p_minimap2: "+query_fasta.get_path()+" against "+db_name+"\n")
+    
+    records = list(query_fasta.get_sequences())
+    
+    if len(records) == 0: return results
+    
+    n_chunks = max(1, min(n_threads, len(records)))
+    chunk_size = (len(records) + n_chunks - 1) / n_chunks
+    chunks = [records[i:i+chunk_size] for i in xrange(0, len(records), chunk_size)]
+    
+    map_chunk = ProcessGroup.propagate(lambda chunk: __map_chunk(index, chunk, threshold_id, threshold_cov, db_name))
+    
+    if len(chunks) > 1:
+        pool = ThreadPool(len(chunks))
+        try:
+            chunks_results = pool.map(map_chunk, chunks)
+            pool.close()
+        finally:
+            pool.terminate()
+    else:
+        chunks_results = [map_chunk(chunk) for chunk in chunks]
+    
+    # Results in the order of the query fasta
+    for chunk_results in chunks_results:
+        for query_id, query_hits in chunk_results:
+            results.extend(query_hits)
+    
+    if verbose: sys.stderr.write("m2p_minimap2: pass-filter results --> "+str(len(results))+"\n")
+    
+    return results
+
+## END
@@ -5,18 +5,217 @@
 # Copyright (C)  2013-2014  Carlos P Cantalapiedra.
 # (terms of use can be found within the distributed LICENSE file).
 
-import sys, os
-from subprocess import Popen, PIPE
+import sys, os, tempfile, shutil, heapq
+from multiprocessing.pool import ThreadPool
 
 from barleymapcore.m2p_exception import m2pException
+from barleymapcore.utils.process_utils import StreamedProcess, ProcessGroup, ProcessCancelledException
+from barleymapcore.utils.alignment_utils import load_fasta_sequences
+from QueryFasta import create_memfd, is_memfd_available
 from AlignmentResult import *
 
 #from Aligners import SELECTION_BEST_SCORE, SELECTION_NONE
 
 ALIGNER = "Blastn(SplitBlast)-Megablast"
+CHUNK_BASES = 50000 # approximate number of query bases per blast job
+MAX_CHUNK_ATTEMPTS = 3 # a chunk is retried if blast fails
+MAX_HSPS = 100 # max HSPs reported by blast for each query and subject sequence (0: no limit)
+PUSHDOWN_ID_MARGIN = 0.01 # identity (%) below threshold_id still reported by blast
+PUSHDOWN_COV_MARGIN = 1.0 # query coverage (%) below the bound of threshold_cov still reported by blast
 
-def __split_blast(split_blast_path, blast_app_path, n_threads, query_fasta_path, blast_dbs_path, db_name, verbose = False):
-    results = []
+# Splits the query sequences in chunks with similar number of bases
+# (longest sequences first, each one to the chunk with less bases).
+# Returns a list of chunks, each one a list of (header, sequence) tuples
+# in the same order than in the query fasta file.
+def __make_chunks(fasta_seqs, n_threads):
+    
+    total_bases = sum([len(seq) for header, seq in fasta_seqs])
+    num_chunks = max(n_threads, (total_bases / CHUNK_BASES) + 1)
+    num_chunks = max(1, min(num_chunks, len(fasta_seqs)))
+    
+    chunks_heap = [(0, chunk_num, []) for chunk_num in xrange(num_chunks)]
+    
+    by_length = sorted(xrange(len(fasta_seqs)), key=lambda i: len(fasta_seqs[i][1]), reverse=True)
+    for seq_num in by_length:
+        (chunk_bases, chunk_num, chunk_seqs) = heapq.heappop(chunks_heap)
+        chunk_seqs.append(seq_num)
+        heapq.heappush(chunks_heap, (chunk_bases + len(fasta_seqs[seq_num][1]), chunk_num, chunk_seqs))
+    
+    chunks = [[fasta_seqs[seq_num] for seq_num in sorted(chunk_seqs)]
+              for (chunk_bases, chunk_num, chunk_seqs) in sorted(chunks_heap, key=lambda x: x[1])
+              if len(chunk_seqs) > 0]
+    
+    return chunks
+
+def __write_records(chunk, chunk_file):
+    for header, seq in chunk:
+        chunk_file.write(">"+header+"\n"+seq+"\n")
+    
+    return
+
+# Writes a chunk of queries to chunks_dir/chunk_name or, if chunks_dir is None,
+# to an anonymous file in memory (see QueryFasta.create_memfd).
+# Returns (path of the chunk, file descriptor of the file in memory or None),
+# and the file descriptor has to be closed once the chunk is not needed.
+def __write_chunk(chunk, chunks_dir, chunk_name):
+    
+    if chunks_dir == None:
+        (memfd, chunk_path) = create_memfd("m2p_split_blast")
+        if memfd == None:
+            raise m2pException("m2p_split_blast: chunk "+chunk_name+" could not be created in memory.")
+        
+        try:
+            with os.fdopen(os.dup(memfd), 'w') as chunk_file:
+                __write_records(chunk, chunk_file)
+        except Exception:
+            os.close(memfd)
+            raise
+    else:
+        memfd = None
+        chunk_path = os.path.join(chunks_dir, chunk_name)
+        with open(chunk_path, 'w') as chunk_file:
+            __write_records(chunk, chunk_file)
+    
+    return (chunk_path, memfd)
+
+# Runs blastn for a chunk of queries, retrying if it fails.
+# Returns the list of blast lines, or None if blast reported errors.
+def __blast_chunk(blast_cmd, chunk_path, verbose = False):
+    chunk_lines = None
+    
+    chunk_cmd = " ".join([blast_cmd, "-query", chunk_path])
+    
+    for attempt in xrange(1, MAX_CHUNK_ATTEMPTS + 1):
+        
+        if verbose: sys.stderr.write("m2p_split_blast: Executing '"+chunk_cmd+"'\n")
+        
+        process = StreamedProcess(chunk_cmd)
+        try:
+            chunk_lines = [line for line in process.lines() if line != "" and not line.startswith("#")]
+        finally:
+            process.close()
+        
+        try:
+            if process.check("m2p_split_blast", verbose):
+                break
+            else:
+                chunk_lines = None
+        except ProcessCancelledException:
+            raise
+        except Exception:
+            if attempt == MAX_CHUNK_ATTEMPTS: raise
+            chunk_lines = None
+        
+        if attempt < MAX_CHUNK_ATTEMPTS:
+            sys.stderr.write("m2p_split_blast: blast failed for chunk "+chunk_path+". Retrying...\n")
+    
+    return chunk_lines
+
+# Blast options to discard the hits below the thresholds within blast,
+# so that they are neither written nor parsed. They are slightly less restrictive
+# than the thresholds (which are still applied by __filter_blast_results):
+# - pident is reported rounded.
+# - qcov_hsp_perc is the span of the HSP in the query, whereas barleymap coverage
+#   is the length of the alignment, which also counts the gaps in the query.
+#   Since gaps are mismatches in pident, span >= length * pident / 100.
+def __pushdown_options(threshold_id, threshold_cov):
+    options = []
+    
+    perc_identity = float(threshold_id) - PUSHDOWN_ID_MARGIN
+    if perc_identity > 0:
+        options.append("-perc_identity "+str(perc_identity))
+    
+    qcov_hsp_perc = float(threshold_cov) * perc_identity / 100.0 - PUSHDOWN_COV_MARGIN
+    if qcov_hsp_perc > 0:
+        options.append("-qcov_hsp_perc "+str(qcov_hsp_perc))
+    
+    return " ".join(options)
+
+# Queries for which the limit of HSPs per subject (max_hsps) could have discarded hits
+# as good as the best hit passing the thresholds. Since blast reports the best max_hsps HSPs
+# of each subject, only subjects with max_hsps HSPs could have discarded hits,
+# and those hits do not score more than the worst HSP reported for that subject.
+def __capped_queries(chunk_lines, max_hsps, threshold_id, threshold_cov):
+    capped_queries = set()
+    
+    thres_id = float(threshold_id)
+    thres_cov = float(threshold_cov)
+    
+    best_scores = {} # query_id --> best score of the hits which pass the thresholds
+    subjects_hsps = {} # (query_id, subject_id) --> [number of HSPs, min score]
+    
+    for line in chunk_lines:
+        line_data = line.split("\t")
+        query_id = line_data[0]
+        align_score = float(line_data[9])
+        
+        subject_key = (query_id, line_data[2])
+        if subject_key in subjects_hsps:
+            subject_hsps = subjects_hsps[subject_key]
+            subject_hsps[0] += 1
+            if align_score < subject_hsps[1]: subject_hsps[1] = align_score
+        else:
+            subjects_hsps[subject_key] = [1, align_score]
+        
+        if float(line_data[11]) >= thres_id and (int(line_data[4])/float(line_data[1]))*100 >= thres_cov:
+            if align_score > best_scores.get(query_id, align_score - 1):
+                best_scores[query_id] = align_score
+    
+    for (query_id, subject_id), (num_hsps, min_score) in subjects_hsps.iteritems():
+        if num_hsps >= max_hsps and (query_id not in best_scores or min_score >= best_scores[query_id]):
+            capped_queries.add(query_id)
+    
+    return capped_queries
+
+# Runs blastn for a chunk of queries with a limit of max_hsps HSPs per subject.
+# The queries which could have lost hits due to that limit are aligned again without it
+# (written to chunks_dir as chunk_num, or in memory, see __write_chunk),
+# and their hits replace those of the first run.
+# Returns the list of blast lines, or None if blast reported errors.
+def __blast_chunk_capped(blast_cmd, uncapped_blast_cmd, chunk, chunk_path, chunks_dir, chunk_num,
+                         max_hsps, threshold_id, threshold_cov, verbose = False):
+    
+    chunk_lines = __blast_chunk(blast_cmd, chunk_path, verbose)
+    
+    if chunk_lines == None or max_hsps <= 0: return chunk_lines
+    
+    capped_queries = __capped_queries(chunk_lines, max_hsps, threshold_id, threshold_cov)
+    
+    if len(capped_queries) == 0: return chunk_lines
+    
+    if verbose: sys.stderr.write("m2p_split_blast: "+str(len(capped_queries))+" queries reached max_hsps "+\
+                                 str(max_hsps)+" in chunk "+chunk_path+". Aligning them without limit.\n")
+    
+    (uncapped_path, uncapped_memfd) = __write_chunk([(header, seq) for header, seq in chunk if header.split(" ")[0] in capped_queries],
+                                                    chunks_dir, "chunk_"+str(chunk_num)+".uncapped.fa")
+    try:
+        uncapped_lines = __blast_chunk(uncapped_blast_cmd, uncapped_path, verbose)
+    finally:
+        if uncapped_memfd != None: os.close(uncapped_memfd)
+    
+    if uncapped_lines == None: return None
+    
+    uncapped_hits = {}
+    for line in uncapped_lines:
+        uncapped_hits.setdefault(line.split("\t", 1)[0], []).append(line)
+    
+    # The hits of each capped query are replaced, keeping the order of the queries
+    merged_lines = []
+    for line in chunk_lines:
+        query_id = line.split("\t", 1)[0]
+        if query_id in capped_queries:
+            merged_lines.extend(uncapped_hits.pop(query_id, []))
+        else:
+            merged_lines.append(line)
+    
+    return merged_lines
+
+# Runs blastn on chunks of the query fasta, in a pool of n_threads workers,
+# and yields the blast lines of each chunk, in the order of the chunks.
+# If a chunk reported errors, its id is appended to chunks_errors.
+# If in_memory, the chunks are written in memory instead of in tmp_files_dir.
+def __split_blast(blast_app_path, n_threads, query_fasta_path, blast_dbs_path, db_name, threshold_id, threshold_cov,
+                  tmp_files_dir, chunks_errors, verbose = False, in_memory = False):
     
     # CPCantalapiedra 201701
     ###### Check that DB is available for this aligner
@@ -30,61 +229,66 @@ def __split_blast(split_blast_path, blast_app_path, n_threads, query_fasta_path,
         
         raise m2pException("DB path "+dbpath+" for "+ALIGNER+" aligner NOT FOUND.")
     
-    ###### Split blast bins
-    ###### Retrieve num of fasta seqs to calculate necessary bins
-    retValue = 0
-    p = Popen(" ".join(["cat", query_fasta_path, " | grep -c \"^>\""]), \
-              shell=True, stdout=PIPE, stderr=sys.stderr)
-    output = p.communicate()[0]
-    retValue = p.returncode
-    if retValue == 0:
-        num_of_seqs = int(output)
-        split_blast_bins = (num_of_seqs / 50) + 1
-    else:
-        split_blast_bins = 100
+    ###### Split query sequences in chunks
+    chunks = __make_chunks(load_fasta_sequences(query_fasta_path), n_threads)
+    
+    if verbose: sys.stderr.write("m2p_split_blast: "+str(len(chunks))+" chunks to "+str(n_threads)+" workers.\n")
     
-    ###### Split blast
-    blast_command = " ".join([split_blast_path+"split_blast.pl", str(n_threads), str(split_blast_bins), blast_app_path, \
-                "-dust no -soft_masking false -task megablast", \
-                '-outfmt \\"6 qseqid qlen sseqid slen length qstart qend sstart send bitscore evalue pident mismatch gapopen\\"'])
+    if len(chunks) == 0: return
     
-    blast_db = "".join(["-db ", dbpath]) # blast_db = "".join(["-db ", blast_dbs_path, db_name , ".fa"]) # 
-    blast_query = " ".join(["-query ", query_fasta_path])
-    #blast_cmd = " ".join([ResourcesMng.get_deploy_dir()+blast_command, blast_db, blast_query])
-    blast_cmd = " ".join([blast_command, blast_db, blast_query])
+    ###### Blast of each chunk
+    blast_command = " ".join([blast_app_path, \
+                "-dust no -soft_masking false -task megablast -num_threads 1", \
+                '-outfmt "6 qseqid qlen sseqid slen length qstart qend sstart send bitscore evalue pident mismatch gapopen"'])
     
-    if verbose: sys.stderr.write("m2p_split_blast: Executing '"+blast_cmd+"'\n")
+    blast_db = "".join(["-db ", dbpath])
     
-    retValue = 0
-    FNULL = open(os.devnull, 'w')
-    if verbose:
-        p = Popen(blast_cmd, shell=True, stdout=PIPE, stderr=sys.stderr)
+    # Thresholds and max number of HSPs are applied by blast
+    uncapped_blast_cmd = " ".join([blast_command, __pushdown_options(threshold_id, threshold_cov), blast_db])
+    if MAX_HSPS > 0:
+        blast_cmd = " ".join([uncapped_blast_cmd, "-max_hsps", str(MAX_HSPS)])
     else:
-        p = Popen(blast_cmd, shell=True, stdout=PIPE, stderr=PIPE)
+        blast_cmd = uncapped_blast_cmd
     
-    com_list = p.communicate()
-    output = com_list[0]
-    output_err = com_list[1]
-    retValue = p.returncode
+    if in_memory and not is_memfd_available():
+        sys.stderr.write("m2p_split_blast: chunks in memory are not available. Using "+str(tmp_files_dir)+"\n")
+        in_memory = False
     
-    if retValue != 0:
-        if verbose:
-            raise Exception("m2p_split_blast: Blast return != 0. "+blast_cmd+"\n"+str(output)+"\n")
-        else:
-            raise Exception("m2p_split_blast: Blast return != 0. "+blast_cmd+"\n"+str(output)+"\n"+str(output_err)+"\n")
-    
-    if "error" in output or "Error" in output or "ERROR" in output:
-        sys.stderr.write("m2p_split_blast: error in blast output. We will report 0 results for this alignment.\n")
-        sys.stderr.write(output+"\n")
-        sys.stderr.write(str(output_err)+"\n")
-        results = []
-    else:
-        if verbose: sys.stderr.write("m2p_split_blast: Blast return value "+str(retValue)+"\n")
+    chunks_dir = None if in_memory else tempfile.mkdtemp(suffix="_m2p_split_blast", dir=tmp_files_dir)
+    chunks_memfds = []
+    pool = None
+    try:
+        chunks_paths = []
+        for chunk_num, chunk in enumerate(chunks):
+            (chunk_path, chunk_memfd) = __write_chunk(chunk, chunks_dir, "chunk_"+str(chunk_num)+".fa")
+            if chunk_memfd != None: chunks_memfds.append(chunk_memfd)
+            chunks_paths.append(chunk_path)
+        
+        pool = ThreadPool(max(1, min(n_threads, len(chunks))))
         
-        [results.append(line) for line in output.strip().split("\n") if line != "" and not line.startswith("#")]
-        # startswith("#") due to split_blast.pl printing in stdout comments, warnings and so on
+        # The chunks are aligned on behalf of the request (if any) of this thread
+        blast_chunk = ProcessGroup.propagate(lambda chunk_num: __blast_chunk_capped(blast_cmd, uncapped_blast_cmd,
+                                                                                    chunks[chunk_num], chunks_paths[chunk_num],
+                                                                                    chunks_dir, chunk_num,
+                                                                                    MAX_HSPS, threshold_id, threshold_cov, verbose))
+        
+        # imap: results are obtained in the order of the chunks, as soon as each one is ready
+        for chunk_num, chunk_lines in enumerate(pool.imap(blast_chunk, xrange(len(chunks)))):
+            if chunk_lines == None:
+                chunks_errors.append(chunk_num)
+                continue
+            
+            for line in chunk_lines:
+                yield line
+        
+        pool.close()
+        
+    finally:
+        if pool: pool.terminate()
+        for chunk_memfd in chunks_memfds: os.close(chunk_memfd)
+        if chunks_dir != None: shutil.rmtree(chunks_dir, ignore_errors=True)
     
-    return results
+    return
 
 def __filter_blast_results(results, threshold_id, threshold_cov, db_name, verbose = False):
     
@@ -131,26 +335,26 @@ def __filter_blast_results(results, threshold_id, threshold_cov, db_name, verbos
         qstart_pos = long(line_data[5])
         qend_pos = long(line_data[6])
         
-        result_tuple = AlignmentResult()
-        result_tuple.create_from_attributes(query_id, subject_id,
-                                            align_ident, query_cov, align_score,
-                                            strand, qstart_pos, qend_pos, local_position, end_position,
-                                            db_name, algorithm)
-        
         # For a given DB, keep always the best score
+        # (the AlignmentResult is created only for hits which are kept)
         if query_id in filter_dict:
             prev_max_score = filter_dict[query_id]["max_score"]
             
             if align_score > prev_max_score:
-                filter_dict[query_id]["query_list"] = [result_tuple]
+                filter_dict[query_id]["query_list"] = []
                 filter_dict[query_id]["max_score"] = align_score
                 
-            elif align_score == prev_max_score:
-                filter_dict[query_id]["query_list"].append(result_tuple)
-            #else:
-            #    print "FILTERED"
+            elif align_score < prev_max_score:
+                continue
         else:
-            filter_dict[query_id] = {"query_list":[result_tuple], "max_score":align_score}
+            filter_dict[query_id] = {"query_list":[], "max_score":align_score}
+        
+        result_tuple = AlignmentResult(query_id, subject_id,
+                                       align_ident, query_cov, align_score,
+                                       strand, qstart_pos, qend_pos, local_position, end_position,
+                                       db_name, algorithm)
+        
+        filter_dict[query_id]["query_list"].append(result_tuple)
     
     # Recover filtered results
     for query_id in filter_dict:
@@ -159,18 +363,29 @@ def __filter_blast_results(results, threshold_id, threshold_cov, db_name, verbos
     
     return filtered_results
 
-def get_best_score_hits(split_blast_path, blast_app_path, n_threads, query_fasta_path, blast_dbs_path, db_name, \
-                        threshold_id, threshold_cov, verbose = False):
+# If blast reported errors (and thus 0 results), db_name is appended to errors.
+# If in_memory, the chunks of queries are not written to tmp_files_dir, but in memory.
+def get_best_score_hits(blast_app_path, n_threads, query_fasta_path, blast_dbs_path, db_name, \
+                        threshold_id, threshold_cov, tmp_files_dir, verbose = False, errors = None, in_memory = False):
     
     if verbose: sys.stderr.write("m2p_split_blast: "+query_fasta_path+" against "+db_name+"\n")
     
-    results = __split_blast(split_blast_path, blast_app_path, n_threads, query_fasta_path, blast_dbs_path, db_name, verbose)
+    chunks_errors = []
+    blast_lines = __split_blast(blast_app_path, n_threads, query_fasta_path, blast_dbs_path, db_name,
+                                threshold_id, threshold_cov, tmp_files_dir, chunks_errors, verbose, in_memory)
     
-    if verbose: sys.stderr.write("m2p_split_blast: raw results --> "+str(len(results))+"\n")
+    try:
+        results = __filter_blast_results(blast_lines, threshold_id, threshold_cov, db_name, verbose)
+    finally:
+        blast_lines.close()
+    
+    # Errors are detected from the exit code and stderr of blast
+    if len(chunks_errors) > 0:
+        sys.stderr.write("m2p_split_blast: errors in blast of "+str(len(chunks_errors))+" chunks. "+\
+                         "We will report 0 results for this alignment.\n")
+        results = []
+        if errors != None: errors.append(db_name)
     
-    if len(results)>0:
-        results = __filter_blast_results(results, threshold_id, threshold_cov, db_name, verbose)
-        
     if verbose: sys.stderr.write("m2p_split_blast: pass-filter results --> "+str(len(results))+"\n")
     #sys.stderr.write(str(len(results))+"\n")
     #sys.stderr.write(str(results)+"\n")
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# bench_bgzf_datasets.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+###########################
+## Benchmark of dataset files compressed as BGZF (see bgzf_utils)
+## against the same dataset as plain text. A physical dataset is generated,
+## compressed with BGZFWriter, and both files are indexed (.bidx and .pidx).
+## Each read is timed cold (the files are evicted from the page cache first,
+## with posix_fadvise, Linux only) and warm (right after the cold one):
+## a scan of the lines, a full parse, a lookup of ids with the index
+## and a query of a window of positions with the positional index.
+## The results of both files are checked to be identical.
+##
+## Usage: python bench_bgzf_datasets.py [num_records] [tmp_dir]
+###########################
+
+import sys, os, time, random, shutil, tempfile, ctypes, ctypes.util
+
+from barleymapcore.db.MapsConfig import MapConfig
+from barleymapcore.maps.MapInterval import MapInterval
+from barleymapcore.maps.reader.MappingsParser import MappingsParser
+from barleymapcore.maps.reader.DatasetIndex import DatasetIndex
+from barleymapcore.maps.reader.DatasetPosIndex import DatasetPosIndex
+from barleymapcore.utils.bgzf_utils import BGZFWriter, BGZF_EXT, open_data_file
+
+CHROMS = ["1H", "2H", "3H", "4H"]
+NUM_IDS = 100
+WINDOW_CHROM = "3H"
+WINDOW_SIZE = 1000000 # bp, in the middle of WINDOW_CHROM
+
+POSIX_FADV_DONTNEED = 4 # Linux
+
+def get_fadvise():
+    fadvise = None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+        fadvise = libc.posix_fadvise
+        fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+    except (OSError, AttributeError):
+        fadvise = None
+    
+    return fadvise
+
+# Removes the pages of the files from the page cache, so that the next read is from disk
+def evict(fadvise, paths):
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    
+    return
+
+# Physical dataset: marker, chrom, start, end, strand and features.
+# Returns the ids of the markers and the length of each chrom
+def create_dataset(data_path, num_records):
+    ids = []
+    chroms_lengths = {}
+    
+    with open(data_path, 'w') as data_file:
+        data_file.write("#marker\tchrom\tstart\tend\tstrand\tgenes\tmarkers\n")
+        for chrom in CHROMS:
+            bp_pos = 0
+            for record_num in xrange(num_records / len(CHROMS)):
+                bp_pos += random.randrange(1, 2000)
+                marker_id = chrom+"_"+str(record_num)
+                ids.append(marker_id)
+                data_file.write("\t".join([marker_id, chrom, str(bp_pos), str(bp_pos + random.randrange(0, 5000)),
+                                           "+", "No", "No"])+"\n")
+            chroms_lengths[chrom] = bp_pos
+    
+    return (ids, chroms_lengths)
+
+def compress(data_path, bgzf_path):
+    with open(data_path, 'rb') as data_file:
+        with BGZFWriter(bgzf_path) as bgzf_file:
+            while True:
+                data = data_file.read(1048576)
+                if not data: break
+                bgzf_file.write(data)
+    
+    return
+
+def scan_lines(data_path, map_config, chrom_dict, query_ids, window):
+    num_lines = 0
+    with open_data_file(data_path) as data_file:
+        for line in data_file: num_lines += 1
+    
+    return num_lines
+
+def full_parse(data_path, map_config, chrom_dict, query_ids, window):
+    return MappingsParser().parse_mapping_file(data_path, map_config, chrom_dict)
+
+def lookup_ids(data_path, map_config, chrom_dict, query_ids, window):
+    query_ids_dict = dict([(query_id, 0) for query_id in query_ids])
+    return MappingsParser().parse_mapping_file_by_id(query_ids_dict, data_path, map_config, chrom_dict,
+                                                     True, {}, set(query_ids))
+
+def query_window(data_path, map_config, chrom_dict, query_ids, window):
+    return MappingsParser().parse_mapping_file_by_pos([window], data_path, chrom_dict, map_config, "bp")
+
+# Comparable results of a read (number of lines, or sorted records)
+def get_key(results):
+    if isinstance(results, list):
+        results = sorted([(result.get_marker_id(), result.get_chrom_name(), result.get_sort_pos("bp")) for result in results])
+    
+    return results
+
+if __name__ == "__main__":
+    
+    num_records = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    tmp_dir = sys.argv[2] if len(sys.argv) > 2 else None
+    
+    fadvise = get_fadvise()
+    if fadvise == None:
+        sys.stderr.write("bench_bgzf_datasets: posix_fadvise is not available. Cold runs will not be from disk.\n")
+    
+    random.seed(1)
+    
+    work_dir = tempfile.mkdtemp(suffix="_bench_bgzf", dir=tmp_dir)
+    try:
+        map_config = MapConfig("bench", "bench", False, True, "bp", True, "greedy", ["db"], "bench", ["dataset"])
+        chrom_dict = dict([(chrom, chrom_num + 1) for chrom_num, chrom in enumerate(CHROMS)])
+        
+        plain_path = os.path.join(work_dir, "dataset.tsv")
+        (ids, chroms_lengths) = create_dataset(plain_path, num_records)
+        query_ids = random.sample(ids, min(NUM_IDS, len(ids)))
+        window_start = max(0, chroms_lengths.get(WINDOW_CHROM, 0) / 2 - WINDOW_SIZE / 2)
+        window = MapInterval(WINDOW_CHROM, window_start, window_start + WINDOW_SIZE)
+        
+        bgzf_path = plain_path+BGZF_EXT
+        compress(plain_path, bgzf_path)
+        
+        for data_path in [plain_path, bgzf_path]:
+            DatasetIndex.build(data_path, DatasetIndex.get_index_path(data_path))
+            DatasetPosIndex.build(data_path, DatasetPosIndex.get_index_path(data_path), map_config)
+        
+        sys.stdout.write("records: "+str(num_records)+", plain: "+str(os.path.getsize(plain_path))+\
+                         " bytes, bgzf: "+str(os.path.getsize(bgzf_path))+" bytes\n")
+        sys.stdout.write("%-22s %-6s %10s %10s %10s\n" % ("read", "file", "results", "cold (s)", "warm (s)"))
+        
+        for (read_name, read_function) in [("line scan", scan_lines), ("full parse", full_parse),
+                                           (str(NUM_IDS)+" ids (.bidx)", lookup_ids), ("1 Mbp window (.pidx)", query_window)]:
+            read_results = {}
+            for (file_name, data_path) in [("plain", plain_path), ("bgzf", bgzf_path)]:
+                if fadvise != None:
+                    evict(fadvise, [data_path, DatasetIndex.get_index_path(data_path),
+                                    DatasetPosIndex.get_index_path(data_path)])
+                
+                start_time = time.time()
+                results = read_function(data_path, map_config, chrom_dict, query_ids, window)
+                cold_time = time.time() - start_time
+                
+                start_time = time.time()
+                read_function(data_path, map_config, chrom_dict, query_ids, window)
+                warm_time = time.time() - start_time
+                
+                read_results[file_name] = get_key(results)
+                num_results = results if isinstance(results, int) else len(results)
+                sys.stdout.write("%-22s %-6s %10d %10.4f %10.4f\n" % (read_name, file_name, num_results, cold_time, warm_time))
+            
+            if read_results["plain"] != read_results["bgzf"]:
+                sys.stderr.write("bench_bgzf_datasets: ERROR, "+read_name+" results differ between plain and bgzf.\n")
+                sys.exit(1)
+    
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+## END
\ No newline at end of file
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# bench_gmap_filter.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+###########################
+## Benchmark of the GMAP paths filter (m2p_gmap.ParetoFront)
+## against the previous filter, which compared each new path
+## with every path kept for the same query.
+## Queries are highly repetitive: each one has many paths
+## with different identity and coverage.
+##
+## Usage: python bench_gmap_filter.py [num_queries] [paths_per_query]
+###########################
+
+import sys, time, random
+
+from barleymapcore.alignment.m2p_gmap import ParetoFront
+
+# Previous filter, used as reference
+def reference_filter(paths):
+    filter_dict = {}
+    
+    for (query_id, align_ident, query_cov, hit) in paths:
+        if query_id in filter_dict:
+            new_max_score = True
+            new_max_score_list = []
+            new_query_list = []
+            for i, (max_align_ident, max_query_cov) in enumerate(filter_dict[query_id]["max_scores"]):
+                best_query = filter_dict[query_id]["query_list"][i]
+                
+                if (align_ident <= max_align_ident and query_cov < max_query_cov) \
+                or (align_ident < max_align_ident and query_cov <= max_query_cov):
+                    new_max_score = False
+                    new_max_score_list.append((max_align_ident, max_query_cov))
+                    new_query_list.append(best_query)
+                
+                elif (align_ident >= max_align_ident and query_cov > max_query_cov) \
+                or (align_ident > max_align_ident and query_cov >= max_query_cov):
+                    pass
+                
+                else:
+                    new_max_score_list.append((max_align_ident, max_query_cov))
+                    new_query_list.append(best_query)
+            
+            if new_max_score:
+                new_max_score_list.append((align_ident, query_cov))
+                new_query_list.append(hit)
+            
+            filter_dict[query_id]["max_scores"] = new_max_score_list
+            filter_dict[query_id]["query_list"] = new_query_list
+        else:
+            filter_dict[query_id] = {"query_list":[hit], "max_scores":[(align_ident, query_cov)]}
+    
+    return dict([(query_id, filter_dict[query_id]["query_list"]) for query_id in filter_dict])
+
+def pareto_filter(paths):
+    filter_dict = {}
+    
+    for (query_id, align_ident, query_cov, hit) in paths:
+        if query_id in filter_dict:
+            filter_dict[query_id].add(align_ident, query_cov, hit)
+        else:
+            query_front = ParetoFront()
+            query_front.add(align_ident, query_cov, hit)
+            filter_dict[query_id] = query_front
+    
+    return dict([(query_id, filter_dict[query_id].get_hits()) for query_id in filter_dict])
+
+# Repetitive queries: paths spread along a trade-off between identity and coverage
+# (many of them are kept), with ties and dominated paths mixed in
+def create_paths(num_queries, paths_per_query):
+    paths = []
+    
+    for query_num in xrange(num_queries):
+        query_id = "query_"+str(query_num)
+        for path_num in xrange(paths_per_query):
+            align_ident = round(random.uniform(90.0, 100.0), 1)
+            query_cov = round(min(100.0, 190.0 - align_ident - random.choice([0.0, 0.0, 0.5, 2.0])), 1)
+            paths.append((query_id, align_ident, query_cov, query_id+"_path_"+str(path_num)))
+    
+    return paths
+
+def run_benchmark(filter_function, paths, repeats = 3):
+    best_time = None
+    for i in xrange(repeats):
+        start_time = time.time()
+        filtered = filter_function(paths)
+        elapsed = time.time() - start_time
+        if best_time == None or elapsed < best_time: best_time = elapsed
+    
+    return (filtered, best_time)
+
+if __name__ == "__main__":
+    
+    num_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    paths_per_query = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    
+    random.seed(1)
+    paths = create_paths(num_queries, paths_per_query)
+    
+    (reference_results, reference_time) = run_benchmark(reference_filter, paths)
+    (pareto_results, pareto_time) = run_benchmark(pareto_filter, paths)
+    
+    if reference_results != pareto_results:
+        sys.stderr.write("bench_gmap_filter: ERROR, results differ from the reference filter.\n")
+        sys.exit(1)
+    
+    num_kept = sum([len(hits) for hits in pareto_results.values()])
+    
+    sys.stdout.write("queries: "+str(num_queries)+", paths per query: "+str(paths_per_query)+\
+                     ", paths kept: "+str(num_kept)+" (identical results)\n")
+    sys.stdout.write("reference filter: "+"%.3f" % reference_time+" s\n")
+    sys.stdout.write("pareto front: "+"%.3f" % pareto_time+" s\n")
+    sys.stdout.write("speedup: "+"%.1f" % (reference_time / pareto_time)+"x\n")
+
+## END
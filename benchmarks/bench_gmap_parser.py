@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# bench_gmap_parser.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+###########################
+## Benchmark of the parser of GMAP output (m2p_gmap.GMAPCompressedParser),
+## which reads the compressed output of GMAP (-Z),
+## against the previous parser of the summary output of GMAP,
+## which created an intermediate line for each path that was split again.
+## The same paths are written in both formats, and the time
+## to obtain the AlignmentResult of every path is reported.
+## The paths are generated without trimmed ends, so that the coverage
+## of -Z output and the trimmed coverage of the summary output are the same
+## (GMAP reports different values for queries with trimmed ends, see m2p_gmap).
+##
+## Usage: python bench_gmap_parser.py [num_paths]
+###########################
+
+import sys, time, random, re
+
+from barleymapcore.alignment.AlignmentResult import AlignmentResult
+from barleymapcore.alignment.m2p_gmap import GMAPCompressedParser
+
+PATHS_PER_QUERY = [1, 3, 20]
+DB_NAME = "db"
+
+# Previous parser of the summary output, used as reference
+def reference_compress(output_lines, db_name):
+    
+    new_line = None
+    query_id = None
+    is_chimera = False
+    
+    numb_exp = re.compile("[0-9]+\.[0-9]")
+    direction_exp = re.compile("cDNA direction: (sense|antisense|indeterminate)")
+    strand_exp = re.compile("([+-]) strand")
+    
+    for output_line in output_lines:
+        if output_line.startswith(">"):
+            if query_id != None:
+                prev_query_id = query_id
+            else:
+                prev_query_id = output_line
+            query_id = output_line
+        else:
+            if "chimera" in output_line:
+                yield "chimera"
+                is_chimera = True
+                query_id = prev_query_id
+                continue
+            elif output_line.startswith("Paths "):
+                is_chimera = False
+                if "Paths (0)" in output_line:
+                    query_id = prev_query_id
+                    continue
+            elif is_chimera:
+                continue
+            else:
+                if "cDNA direction" in output_line:
+                    direction = str(re.search(direction_exp, output_line).group(1))
+                if "Genomic pos" in output_line:
+                    strand = str(re.search(strand_exp, output_line).group(1))
+                if "Trimmed coverage" in output_line:
+                    query_cov = float(re.search(numb_exp, output_line).group(0))
+                if "Percent identity" in output_line:
+                    identity = float(re.search(numb_exp, output_line).group(0))
+                
+                if "Path" in output_line:
+                    if new_line != None:
+                        new_line.append(prev_query_id)
+                        prev_query_id = query_id
+                        new_line.extend([db_name, "0/0", "0", "0", str(query_cov), str(identity),
+                                         str(qstart)+".."+str(qend), "0..0",
+                                         subject_id+":"+str(sstart)+".."+str(send), str(strand), "dir:"+str(direction)])
+                        yield " ".join(new_line)
+                        new_line = None
+                    
+                    new_line = []
+                    path_line = output_line.strip().split(" ")
+                    qstart = path_line[3].split("..")[0]
+                    qend = path_line[3].split("..")[1]
+                    subject_data = path_line[8].split(":")
+                    subject_id = subject_data[0]
+                    sstart = subject_data[1].split("..")[0].replace(",", "")
+                    send = subject_data[1].split("..")[1].replace(",", "")
+    
+    if new_line != None:
+        new_line.append(prev_query_id)
+        new_line.extend([db_name, "0/0", "0", "0", str(query_cov), str(identity),
+                         str(qstart)+".."+str(qend), "0..0",
+                         subject_id+":"+str(sstart)+".."+str(send), str(strand), "dir:"+str(direction)])
+        yield " ".join(new_line)
+    
+    return
+
+def reference_parser(output_lines, db_name):
+    hits = []
+    
+    for line in reference_compress(output_lines, db_name):
+        if line.find("chimera") != -1: continue
+        
+        line_data = line.split(" ")
+        
+        query_id = line_data[0][1:]
+        subject_id = line_data[9].split(":")[0]
+        align_ident = float(line_data[6])
+        query_cov = float(line_data[5])
+        strand = line_data[10]
+        
+        if strand == "+":
+            local_position = long(line_data[9].split(":")[1].split("..")[0])
+            end_position = long(line_data[9].split(":")[1].split("..")[1])
+        else:
+            local_position = long(line_data[9].split(":")[1].split("..")[1])
+            end_position = long(line_data[9].split(":")[1].split("..")[0])
+        
+        query_positions = line_data[7].split("..")
+        qstart_pos = long(query_positions[0])
+        qend_pos = long(query_positions[1])
+        align_score = (qend_pos - qstart_pos) * (align_ident / 100)
+        
+        hits.append(AlignmentResult(query_id, subject_id, align_ident, query_cov, align_score,
+                                    strand, qstart_pos, qend_pos, local_position, end_position,
+                                    db_name, "gmap"))
+    
+    return hits
+
+def compressed_parser(output_lines, db_name):
+    hits = []
+    
+    parser = GMAPCompressedParser(db_name)
+    for (query_id, query_hits) in parser.parse(output_lines):
+        hits.extend(query_hits)
+    
+    return hits
+
+# The same paths, in the summary output and in the compressed output of GMAP
+def create_output(num_paths):
+    summary_lines = []
+    compressed_lines = []
+    
+    query_num = 0
+    path_total = 0
+    while path_total < num_paths:
+        query_id = "query_"+str(query_num)
+        num_query_paths = random.choice(PATHS_PER_QUERY)
+        
+        summary_lines.append(">"+query_id)
+        summary_lines.append("Paths ("+str(num_query_paths)+"):")
+        
+        for path_num in xrange(1, num_query_paths+1):
+            qstart = random.randint(1, 5)
+            qend = random.randint(95, 100)
+            start = random.randint(1, 10**8)
+            strand = random.choice("+-")
+            if strand == "+": (pos_1, pos_2) = (start, start+qend-qstart)
+            else: (pos_1, pos_2) = (start+qend-qstart, start)
+            chrom = "chr"+str(random.randint(1, 7))+"H"
+            ident = random.choice([98.0, 99.0, 99.5, 100.0])
+            cov = random.choice([95.0, 97.5, 100.0])
+            
+            summary_lines.append("  Path "+str(path_num)+": query "+str(qstart)+".."+str(qend)+\
+                                 " ("+str(qend-qstart+1)+" bp) => genome "+chrom+":"+\
+                                 "{:,}".format(pos_1)+".."+"{:,}".format(pos_2)+" ("+str(qend-qstart+1)+" bp)")
+            summary_lines.append("    cDNA direction: sense")
+            summary_lines.append("    Genomic pos: "+chrom+":"+"{:,}".format(pos_1)+".."+"{:,}".format(pos_2)+\
+                                 " ("+strand+" strand)")
+            summary_lines.append("    Number of exons: 1")
+            summary_lines.append("    Coverage: "+str(cov)+" (query length: 100 bp)")
+            summary_lines.append("    Trimmed coverage: "+str(cov)+" (trimmed length: 100 bp, trimmed region: 1..100)")
+            summary_lines.append("    Percent identity: "+str(ident)+" (99 matches, 1 mismatches, 0 indels, 0 unknowns)")
+            summary_lines.append("")
+            
+            compressed_lines.append("\t".join([">"+query_id, DB_NAME, str(path_num)+"/"+str(num_query_paths),
+                                               "100", "1", str(cov), str(ident), str(qstart)+".."+str(qend),
+                                               str(pos_1)+".."+str(pos_2), chrom+":"+str(pos_1)+".."+str(pos_2),
+                                               strand, "dir:sense"]))
+            compressed_lines.append("\t"+str(qstart)+"-"+str(qend)+"\t("+str(pos_1)+"-"+str(pos_2)+")\t"+str(ident)+"%")
+        
+        summary_lines.append("")
+        path_total += num_query_paths
+        query_num += 1
+    
+    return (summary_lines, compressed_lines, path_total)
+
+def run_benchmark(parser_function, output_lines, repeats = 3):
+    best_time = None
+    for i in xrange(repeats):
+        start_time = time.time()
+        hits = parser_function(output_lines, DB_NAME)
+        elapsed = time.time() - start_time
+        if best_time == None or elapsed < best_time: best_time = elapsed
+    
+    return (hits, best_time)
+
+if __name__ == "__main__":
+    
+    num_paths = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    
+    random.seed(1)
+    (summary_lines, compressed_lines, num_paths) = create_output(num_paths)
+    
+    (reference_hits, reference_time) = run_benchmark(reference_parser, summary_lines)
+    (compressed_hits, compressed_time) = run_benchmark(compressed_parser, compressed_lines)
+    
+    if [str(hit) for hit in reference_hits] != [str(hit) for hit in compressed_hits]:
+        sys.stderr.write("bench_gmap_parser: ERROR, results differ from the reference parser.\n")
+        sys.exit(1)
+    
+    per_million = 1000000.0 / num_paths
+    
+    sys.stdout.write("paths: "+str(num_paths)+" (identical results)\n")
+    sys.stdout.write("summary output lines: "+str(len(summary_lines))+\
+                     ", compressed output lines: "+str(len(compressed_lines))+"\n")
+    sys.stdout.write("reference parser: "+"%.3f" % (reference_time * per_million)+" s per million paths\n")
+    sys.stdout.write("compressed parser: "+"%.3f" % (compressed_time * per_million)+" s per million paths\n")
+    sys.stdout.write("speedup: "+"%.1f" % (reference_time / compressed_time)+"x\n")
+
+## END
@@ -22,11 +22,12 @@ class DatasetsFacade(DatasetsRetriever):
     
     _datasets_retriever = None
     
-    def __init__(self, datasets_config, datasets_path, maps_path, verbose = True):
+    # dataset_cache: DatasetCache shared by the process (see DatasetCache.from_paths_config), or None
+    def __init__(self, datasets_config, datasets_path, maps_path, verbose = True, dataset_cache = None):
         self._datasets_config = datasets_config
         self._datasets_path = datasets_path
         self._verbose = verbose
-        self._datasets_retriever = DatasetsRetriever(datasets_config, datasets_path, maps_path, verbose)
+        self._datasets_retriever = DatasetsRetriever(datasets_config, datasets_path, maps_path, verbose, dataset_cache)
     
     def get_results(self):
         return self._datasets_retriever.get_results()
@@ -9,6 +9,8 @@ import sys, os
 
 from barleymapcore.db.DatasetsConfig import DatasetsConfig
 from barleymapcore.maps.reader.MappingsParser import MappingsParser
+from barleymapcore.maps.reader.DatasetIndex import DatasetIndexes
+from barleymapcore.utils.bgzf_utils import get_data_path
 from barleymapcore.maps.enrichment.FeatureMapping import FeaturesFactory
 from barleymapcore.m2p_exception import m2pException
 
@@ -18,20 +20,32 @@ class DatasetsRetriever(object):
     _datasets_path = None
     _maps_path = None
     _verbose = False
+    _dataset_cache = None # DatasetCache, or None if datasets are not cached
     
     _results = None
     _unmapped = None
     
-    def __init__(self, datasets_config, datasets_path, maps_path, verbose = False):
+    def __init__(self, datasets_config, datasets_path, maps_path, verbose = False, dataset_cache = None):
         self._datasets_config = datasets_config
         self._datasets_path = datasets_path
         self._maps_path = maps_path
         self._verbose = verbose
+        self._dataset_cache = dataset_cache
     
-    def load_synonyms(self, synonyms):
+    # If data_path is given and its index includes the synonyms,
+    # these are read from the index instead of loading the synonyms file.
+    # Otherwise, these are taken from the cache of datasets if there is one
+    def load_synonyms(self, synonyms, data_path = None):
         dataset_synonyms = {}
         
         if synonyms != "" and synonyms != DatasetsConfig.SYNONYMS_NO:
+            indexed_synonyms = DatasetIndexes.get_synonyms(data_path, synonyms) if data_path else None
+            if indexed_synonyms != None:
+                return indexed_synonyms
+            
+            if self._dataset_cache != None:
+                return self._dataset_cache.get_synonyms(synonyms)
+            
             for syn_line in open(synonyms, 'r'):
                 syn_data = syn_line.strip().split()
                 syn_key = syn_data[0]
@@ -42,6 +56,17 @@ class DatasetsRetriever(object):
         
         return dataset_synonyms
     
+    def get_dataset_cache(self):
+        return self._dataset_cache
+    
+    def _write_cache_stats(self):
+        cache_stats = self._dataset_cache.get_stats()
+        sys.stderr.write("DatasetsRetriever: dataset cache stats "+\
+                         ", ".join([stat+" "+str(cache_stats[stat]) for stat in sorted(cache_stats)])+\
+                         ", entries "+str(self._dataset_cache.get_num_entries())+\
+                         ", size "+str(self._dataset_cache.get_size())+" bytes\n")
+        return
+    
     def get_results(self):
         retvalue = None
         
@@ -72,6 +97,9 @@ class DatasetsRetriever(object):
             dataset_map_path = self._datasets_path+str(dataset)+"/"+str(dataset)+"."+str(map_id)
             #sys.stderr.write("DatasetsRetriever: get_dataset_path "+str(dataset_map_path)+"\n")
         
+        # the BGZF compressed file (dataset_map_path.gz) is used if there is no plain text one
+        dataset_map_path = get_data_path(dataset_map_path)
+        
         return dataset_map_path
     
     def common_dbs(self, dataset_config, map_config):
@@ -160,7 +188,7 @@ class DatasetsRetriever(object):
                 if self._verbose: sys.stderr.write("\t\t loading synonyms\n")
                 
                 synonyms_path = dataset_config.get_synonyms()
-                dataset_synonyms = self.load_synonyms(synonyms_path)
+                dataset_synonyms = self.load_synonyms(synonyms_path, dataset_map_path)
                 
                 sys.stderr.write("\t\t synonyms: "+synonyms_path+"\n")
                 
@@ -172,7 +200,7 @@ class DatasetsRetriever(object):
                 
                 if self._verbose: sys.stderr.write("\t\t parsing dataset file\n")
                 
-                mappings_parser = MappingsParser()
+                mappings_parser = MappingsParser(self._dataset_cache)
                 map_results = mappings_parser.parse_mapping_file_by_id(temp_query_dict, dataset_map_path, map_config, chrom_dict,
                                                       multiple_param, dataset_synonyms, test_set)
                 
@@ -201,6 +229,8 @@ class DatasetsRetriever(object):
         
         self._unmapped = [query for query in query_ids_dict.keys() if query_ids_dict[query] == 0]
         
+        if self._verbose and self._dataset_cache != None: self._write_cache_stats()
+        
         return
     
     def retrieve_datasets_by_pos(self, map_intervals, dataset_list, map_config, chrom_dict,
@@ -240,7 +270,7 @@ class DatasetsRetriever(object):
             if os.path.exists(dataset_map_path) and os.path.isfile(dataset_map_path):
                 if self._verbose: sys.stderr.write("DatasetsRetriever: loading features from map data: "+dataset_map_path+"\n")
                 
-                mappings_parser = MappingsParser()
+                mappings_parser = MappingsParser(self._dataset_cache)
                 mapping_results_list = mappings_parser.parse_mapping_file_by_pos(map_intervals, dataset_map_path, chrom_dict, map_config, map_sort_by)
                 
                 for mapping_result in mapping_results_list:
@@ -251,6 +281,8 @@ class DatasetsRetriever(object):
                 
                 #features.extend(dataset_features)
         
+        if self._verbose and self._dataset_cache != None: self._write_cache_stats()
+        
         return features
     
     ## This method searches features in each map_interval
@@ -291,10 +323,12 @@ class DatasetsRetriever(object):
             if os.path.exists(dataset_map_path) and os.path.isfile(dataset_map_path):
                 if self._verbose: sys.stderr.write("DatasetsRetriever: loading features from map data: "+dataset_map_path+"\n")
                 
-                mappings_parser = MappingsParser()
+                mappings_parser = MappingsParser(self._dataset_cache)
                 featured_map_intervals = mappings_parser.parse_mapping_file_on_pos(map_intervals, dataset_map_path, chrom_dict, map_config, map_sort_by,
                                                                                    dataset, dataset_name, feature_type)
         
+        if self._verbose and self._dataset_cache != None: self._write_cache_stats()
+        
         return featured_map_intervals
 
 ## END
\ No newline at end of file
@@ -22,9 +22,10 @@ class MapConfig(object):
     _db_list = None
     _map_dir = None
     _main_datasets = None
+    _db_order_pinned = False
     
     def __init__(self, name, map_id, has_cm_pos, has_bp_pos, default_sort_by,
-                 as_physical, search_type, db_list, map_dir, main_datasets):
+                 as_physical, search_type, db_list, map_dir, main_datasets, db_order_pinned = False):
         
         self._name = name
         self._id = map_id
@@ -36,6 +37,7 @@ class MapConfig(object):
         self._db_list = db_list
         self._map_dir = map_dir
         self._main_datasets = main_datasets
+        self._db_order_pinned = db_order_pinned
         
         return
     
@@ -70,6 +72,10 @@ class MapConfig(object):
     def get_main_datasets(self, ):
         return self._main_datasets
     
+    # The DBs must be aligned in the order of db_list (see DBOrderPlanner)
+    def is_db_order_pinned(self):
+        return self._db_order_pinned
+    
     def check_sort_param(self, map_config, sort_param, DEFAULT_SORT_PARAM):
         sort_by = ""
         
@@ -113,6 +119,7 @@ class MapsConfig(object):
     DB_LIST = 7
     MAP_DIR = 8 # usually the same as ID, but this is really the folder name within maps_path
     MAIN_DATASETS = 9
+    DB_ORDER = 10 # optional
     
     # HAS_CM_POS values
     #HAS_CM_POS_FALSE = "cm_false"
@@ -135,6 +142,10 @@ class MapsConfig(object):
     SEARCH_TYPE_GREEDY = "greedy"
     SEARCH_TYPE_HIERARCHICAL = "hierarchical"
     SEARCH_TYPE_EXHAUSTIVE = "exhaustive"
+    
+    # DB_ORDER values
+    DB_ORDER_PINNED = "pinned" # DB_LIST order is kept, even if the DBs order planner is enabled
+    DB_ORDER_PLANNED = "planned" # (default) DB_LIST can be reordered by the DBs order planner
 
     _config_file = ""
     _verbose = False
@@ -175,8 +186,11 @@ class MapsConfig(object):
             
             main_datasets = conf_row[self.MAIN_DATASETS].split(",")
             
+            if len(conf_row) > self.DB_ORDER and conf_row[self.DB_ORDER] == self.DB_ORDER_PINNED: db_order_pinned = True
+            else: db_order_pinned = False
+            
             map_config = MapConfig(map_name, map_id, map_has_cm, map_has_bp, map_default_sort_by,
-                        map_physical, search_type, map_db_list, map_dir, main_datasets)
+                        map_physical, search_type, map_db_list, map_dir, main_datasets, db_order_pinned)
             
             self._config_dict[map_id] = map_config
             self._config_list.append(map_id)
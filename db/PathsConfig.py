@@ -32,6 +32,31 @@ class PathsConfig(object):
     # Aux dirs
     _TMP_FILES_PATH = "tmp_files_path"
     
+    # Optional keys
+    _ALIGNMENT_CACHE_PATH = "alignment_cache_path" # file of the alignment cache (no cache if not set)
+    _ALIGNMENT_CACHE_SIZE = "alignment_cache_size" # max size of the alignment cache, in MB (0: no limit)
+    _QUERY_SUBSETS = "query_subsets" # where subsets of queries are written: "file" (tmp_files_path) or "memory"
+    
+    QUERY_SUBSETS_FILE = "file"
+    QUERY_SUBSETS_MEMORY = "memory"
+    
+    _ALIGNER_WORKERS = "aligner_workers" # max number of GMAP workers with a DB loaded (0: no workers)
+    _ALIGNER_WORKERS_IDLE_TIMEOUT = "aligner_workers_idle_timeout" # seconds before an idle worker is terminated
+    _ALIGNER_WORKERS_READ_TIMEOUT = "aligner_workers_read_timeout" # seconds without output before a busy worker is killed
+    _QUERY_DEDUP = "query_dedup" # queries with the same sequence aligned once: "none", "identical" or "revcomp"
+    _BEST_SCORE_EARLY_EXIT = "best_score_early_exit" # only ties of queries with a perfect hit searched in later DBs: "yes" or "no" (requires exact_index_path)
+    _DB_ORDER = "db_order" # order of DBs in hierarchical searches: "config", "suggest" or "apply" (see DBOrderPlanner)
+    _DB_STATS_PATH = "db_stats_path" # file of the statistics of alignments to each DB (not recorded if not set)
+    _ALIGNER_ROUTING = "aligner_routing" # queries routed among a list of aligners: "none" or "length" (see RoutedListAligner)
+    _ALIGNER_ROUTING_LENGTH = "aligner_routing_length" # queries shorter than this (bp) go first to blastn/hsblastn
+    _MINIMAP2_DBS_PATH = "minimap2_dbs_path" # directory of the minimap2 indexes (DB.mmi)
+    _MINIMAP2_PRESET = "minimap2_preset" # minimap2 preset (-x) used to align (e.g. "splice", "sr", "map-ont")
+    _DB_SKETCHES = "db_sketches" # queries filtered by the k-mer sketches of the DBs: "no", "yes" or "audit" (see DBSketchFilter)
+    _DB_SKETCHES_PATH = "db_sketches_path" # directory of the sketches of the DBs (DB.sketch)
+    _DB_SKETCHES_MIN_SHARED = "db_sketches_min_shared" # min sampled k-mers shared with a DB to align a query to it
+    _EXACT_INDEX_PATH = "exact_index_path" # directory of the exact match indexes of the DBs (not used if not set)
+    _DATASET_CACHE_SIZE = "dataset_cache_size" # max memory of the in-process cache of datasets, in MB (0: no cache)
+    
     _CITATION = "citation"
     _STDALONE_APP = "stdalone_app"
     
@@ -52,6 +77,25 @@ class PathsConfig(object):
     _hsblastn_dbs_path = ""
     _citation = ""
     _stdalone_app = ""
+    _alignment_cache_path = ""
+    _alignment_cache_size = "0"
+    _query_subsets = QUERY_SUBSETS_FILE
+    _aligner_workers = "0"
+    _aligner_workers_idle_timeout = "600"
+    _aligner_workers_read_timeout = "600"
+    _query_dedup = "none"
+    _best_score_early_exit = "no"
+    _db_order = "config"
+    _db_stats_path = ""
+    _aligner_routing = "none"
+    _aligner_routing_length = "200"
+    _minimap2_dbs_path = ""
+    _minimap2_preset = "splice"
+    _db_sketches = "no"
+    _db_sketches_path = ""
+    _db_sketches_min_shared = "1"
+    _exact_index_path = ""
+    _dataset_cache_size = "0"
     
     def __init__(self):
         return
@@ -76,6 +120,25 @@ class PathsConfig(object):
         self._hsblastn_dbs_path = self._config_path_dict[self._HSBLASTN_DBS_PATH]
         self._citation = self._config_path_dict[self._CITATION]
         self._stdalone_app = self._config_path_dict[self._STDALONE_APP]
+        self._alignment_cache_path = self._config_path_dict.get(self._ALIGNMENT_CACHE_PATH, "")
+        self._alignment_cache_size = self._config_path_dict.get(self._ALIGNMENT_CACHE_SIZE, "0")
+        self._query_subsets = self._config_path_dict.get(self._QUERY_SUBSETS, self.QUERY_SUBSETS_FILE)
+        self._aligner_workers = self._config_path_dict.get(self._ALIGNER_WORKERS, "0")
+        self._aligner_workers_idle_timeout = self._config_path_dict.get(self._ALIGNER_WORKERS_IDLE_TIMEOUT, "600")
+        self._aligner_workers_read_timeout = self._config_path_dict.get(self._ALIGNER_WORKERS_READ_TIMEOUT, "600")
+        self._query_dedup = self._config_path_dict.get(self._QUERY_DEDUP, "none")
+        self._best_score_early_exit = self._config_path_dict.get(self._BEST_SCORE_EARLY_EXIT, "no")
+        self._db_order = self._config_path_dict.get(self._DB_ORDER, "config")
+        self._db_stats_path = self._config_path_dict.get(self._DB_STATS_PATH, "")
+        self._aligner_routing = self._config_path_dict.get(self._ALIGNER_ROUTING, "none")
+        self._aligner_routing_length = self._config_path_dict.get(self._ALIGNER_ROUTING_LENGTH, "200")
+        self._minimap2_dbs_path = self._config_path_dict.get(self._MINIMAP2_DBS_PATH, "")
+        self._minimap2_preset = self._config_path_dict.get(self._MINIMAP2_PRESET, "splice")
+        self._db_sketches = self._config_path_dict.get(self._DB_SKETCHES, "no")
+        self._db_sketches_path = self._config_path_dict.get(self._DB_SKETCHES_PATH, "")
+        self._db_sketches_min_shared = self._config_path_dict.get(self._DB_SKETCHES_MIN_SHARED, "1")
+        self._exact_index_path = self._config_path_dict.get(self._EXACT_INDEX_PATH, "")
+        self._dataset_cache_size = self._config_path_dict.get(self._DATASET_CACHE_SIZE, "0")
         
         return
     
@@ -95,7 +158,26 @@ class PathsConfig(object):
                              self._HSBLASTN_APP_PATH:self._hsblastn_app_path,
                              self._HSBLASTN_DBS_PATH:self._hsblastn_dbs_path,
                              self._CITATION:self._citation,
-                             self._STDALONE_APP:self._stdalone_app}
+                             self._STDALONE_APP:self._stdalone_app,
+                             self._ALIGNMENT_CACHE_PATH:self._alignment_cache_path,
+                             self._ALIGNMENT_CACHE_SIZE:self._alignment_cache_size,
+                             self._QUERY_SUBSETS:self._query_subsets,
+                             self._ALIGNER_WORKERS:self._aligner_workers,
+                             self._ALIGNER_WORKERS_IDLE_TIMEOUT:self._aligner_workers_idle_timeout,
+                             self._ALIGNER_WORKERS_READ_TIMEOUT:self._aligner_workers_read_timeout,
+                             self._QUERY_DEDUP:self._query_dedup,
+                             self._BEST_SCORE_EARLY_EXIT:self._best_score_early_exit,
+                             self._DB_ORDER:self._db_order,
+                             self._DB_STATS_PATH:self._db_stats_path,
+                             self._ALIGNER_ROUTING:self._aligner_routing,
+                             self._ALIGNER_ROUTING_LENGTH:self._aligner_routing_length,
+                             self._MINIMAP2_DBS_PATH:self._minimap2_dbs_path,
+                             self._MINIMAP2_PRESET:self._minimap2_preset,
+                             self._DB_SKETCHES:self._db_sketches,
+                             self._DB_SKETCHES_PATH:self._db_sketches_path,
+                             self._DB_SKETCHES_MIN_SHARED:self._db_sketches_min_shared,
+                             self._EXACT_INDEX_PATH:self._exact_index_path,
+                             self._DATASET_CACHE_SIZE:self._dataset_cache_size}
         
         return paths_config_dict
     
@@ -120,6 +202,25 @@ class PathsConfig(object):
         paths_config._hsblastn_dbs_path = config_path_dict[paths_config._HSBLASTN_DBS_PATH]
         paths_config._citation = config_path_dict[paths_config._CITATION]
         paths_config._stdalone_app = config_path_dict[paths_config._STDALONE_APP]
+        paths_config._alignment_cache_path = config_path_dict.get(paths_config._ALIGNMENT_CACHE_PATH, "")
+        paths_config._alignment_cache_size = config_path_dict.get(paths_config._ALIGNMENT_CACHE_SIZE, "0")
+        paths_config._query_subsets = config_path_dict.get(paths_config._QUERY_SUBSETS, paths_config.QUERY_SUBSETS_FILE)
+        paths_config._aligner_workers = config_path_dict.get(paths_config._ALIGNER_WORKERS, "0")
+        paths_config._aligner_workers_idle_timeout = config_path_dict.get(paths_config._ALIGNER_WORKERS_IDLE_TIMEOUT, "600")
+        paths_config._aligner_workers_read_timeout = config_path_dict.get(paths_config._ALIGNER_WORKERS_READ_TIMEOUT, "600")
+        paths_config._query_dedup = config_path_dict.get(paths_config._QUERY_DEDUP, "none")
+        paths_config._best_score_early_exit = config_path_dict.get(paths_config._BEST_SCORE_EARLY_EXIT, "no")
+        paths_config._db_order = config_path_dict.get(paths_config._DB_ORDER, "config")
+        paths_config._db_stats_path = config_path_dict.get(paths_config._DB_STATS_PATH, "")
+        paths_config._aligner_routing = config_path_dict.get(paths_config._ALIGNER_ROUTING, "none")
+        paths_config._aligner_routing_length = config_path_dict.get(paths_config._ALIGNER_ROUTING_LENGTH, "200")
+        paths_config._minimap2_dbs_path = config_path_dict.get(paths_config._MINIMAP2_DBS_PATH, "")
+        paths_config._minimap2_preset = config_path_dict.get(paths_config._MINIMAP2_PRESET, "splice")
+        paths_config._db_sketches = config_path_dict.get(paths_config._DB_SKETCHES, "no")
+        paths_config._db_sketches_path = config_path_dict.get(paths_config._DB_SKETCHES_PATH, "")
+        paths_config._db_sketches_min_shared = config_path_dict.get(paths_config._DB_SKETCHES_MIN_SHARED, "1")
+        paths_config._exact_index_path = config_path_dict.get(paths_config._EXACT_INDEX_PATH, "")
+        paths_config._dataset_cache_size = config_path_dict.get(paths_config._DATASET_CACHE_SIZE, "0")
         
         return paths_config
     
@@ -175,4 +276,68 @@ class PathsConfig(object):
     def get_stdalone_app(self):
         return self._stdalone_app
     
+    def get_alignment_cache_path(self):
+        return self._alignment_cache_path
+    
+    # In bytes
+    def get_alignment_cache_size(self):
+        return long(float(self._alignment_cache_size) * 1024 * 1024)
+    
+    def get_query_subsets(self):
+        return self._query_subsets
+    
+    # Subsets of queries are kept in memory instead of written to tmp_files_path
+    def get_query_subsets_in_memory(self):
+        return self._query_subsets == self.QUERY_SUBSETS_MEMORY
+    
+    def get_aligner_workers(self):
+        return int(self._aligner_workers)
+    
+    # In seconds
+    def get_aligner_workers_idle_timeout(self):
+        return float(self._aligner_workers_idle_timeout)
+    
+    # In seconds
+    def get_aligner_workers_read_timeout(self):
+        return float(self._aligner_workers_read_timeout)
+    
+    def get_query_dedup(self):
+        return self._query_dedup
+    
+    def get_best_score_early_exit(self):
+        return self._best_score_early_exit == "yes"
+    
+    def get_db_order(self):
+        return self._db_order
+    
+    def get_db_stats_path(self):
+        return self._db_stats_path
+    
+    def get_aligner_routing(self):
+        return self._aligner_routing
+    
+    def get_aligner_routing_length(self):
+        return int(self._aligner_routing_length)
+    
+    def get_minimap2_dbs_path(self):
+        return self._minimap2_dbs_path
+    
+    def get_minimap2_preset(self):
+        return self._minimap2_preset
+    
+    def get_db_sketches(self):
+        return self._db_sketches
+    
+    def get_db_sketches_path(self):
+        return self._db_sketches_path
+    
+    def get_db_sketches_min_shared(self):
+        return int(self._db_sketches_min_shared)
+    
+    def get_exact_index_path(self):
+        return self._exact_index_path
+    
+    def get_dataset_cache_size(self):
+        return long(float(self._dataset_cache_size) * 1024 * 1024)
+
 ## END
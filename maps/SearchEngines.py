@@ -11,7 +11,8 @@ from reader.MapReader import MapReader
 from mappers.Mappers import Mappers
 from barleymapcore.db.MapsConfig import MapsConfig
 from barleymapcore.m2p_exception import m2pException
-import barleymapcore.utils.alignment_utils as alignment_utils
+from barleymapcore.alignment.QueryFasta import load_query_fasta
+from barleymapcore.alignment.DBOrderPlanner import DBOrderPlanner
 
 from barleymapcore.alignment.AlignmentEngines import ALIGNMENT_TYPE_GREEDY, ALIGNMENT_TYPE_HIERARCHICAL, ALIGNMENT_TYPE_BEST_SCORE
 
@@ -32,7 +33,7 @@ class SearchEnginesFactory(object):
     
     @staticmethod
     def get_search_engine(search_type, maps_path, best_score_param, databases_config,
-                          aligner_list, threshold_id, threshold_cov, n_threads, verbose = False):
+                          aligner_list, threshold_id, threshold_cov, n_threads, verbose = False, n_jobs = 1):
         
         search_engine = None
         
@@ -40,24 +41,24 @@ class SearchEnginesFactory(object):
             
             if best_score_param:
                 search_engine = SearchEngineGreedy(maps_path, best_score_param, databases_config, aligner_list,
-                                                   threshold_id, threshold_cov, n_threads, ALIGNMENT_TYPE_BEST_SCORE, verbose)
+                                                   threshold_id, threshold_cov, n_threads, ALIGNMENT_TYPE_BEST_SCORE, verbose, n_jobs)
             else:
                 search_engine = SearchEngineGreedy(maps_path, best_score_param, databases_config, aligner_list,
-                                                   threshold_id, threshold_cov, n_threads, ALIGNMENT_TYPE_GREEDY, verbose)
+                                                   threshold_id, threshold_cov, n_threads, ALIGNMENT_TYPE_GREEDY, verbose, n_jobs)
                 
         elif search_type == MapsConfig.SEARCH_TYPE_HIERARCHICAL:
             
             search_engine = SearchEngineGreedy(maps_path, best_score_param, databases_config, aligner_list,
-                                                   threshold_id, threshold_cov, n_threads, ALIGNMENT_TYPE_HIERARCHICAL, verbose)
+                                                   threshold_id, threshold_cov, n_threads, ALIGNMENT_TYPE_HIERARCHICAL, verbose, n_jobs)
             
         elif search_type == MapsConfig.SEARCH_TYPE_EXHAUSTIVE:
             
             if best_score_param:
                 search_engine = SearchEngineExhaustive(maps_path, best_score_param, databases_config, aligner_list,
-                                                   threshold_id, threshold_cov, n_threads, ALIGNMENT_TYPE_BEST_SCORE, verbose)
+                                                   threshold_id, threshold_cov, n_threads, ALIGNMENT_TYPE_BEST_SCORE, verbose, n_jobs)
             else:
                 search_engine = SearchEngineExhaustive(maps_path, best_score_param, databases_config, aligner_list,
-                                                   threshold_id, threshold_cov, n_threads, ALIGNMENT_TYPE_GREEDY, verbose)
+                                                   threshold_id, threshold_cov, n_threads, ALIGNMENT_TYPE_GREEDY, verbose, n_jobs)
         else:
             raise m2pException("Unrecognized search type "+search_type+".")
         
@@ -132,9 +133,10 @@ class SearchEngineDatasets(SearchEngine):
 class SearchEngineAlignments(SearchEngine):
     
     _alignment_type = ""
+    _n_jobs = 1
     
     def __init__(self, maps_path, best_score_param, databases_config,
-                 aligner_list, threshold_id, threshold_cov, n_threads, alignment_type, verbose = False):
+                 aligner_list, threshold_id, threshold_cov, n_threads, alignment_type, verbose = False, n_jobs = 1):
         
         SearchEngine.__init__(self, maps_path, verbose)
         self._databases_config = databases_config
@@ -143,9 +145,20 @@ class SearchEngineAlignments(SearchEngine):
         self._threshold_cov = threshold_cov
         self._n_threads = n_threads
         self._alignment_type = alignment_type
+        self._n_jobs = n_jobs
     
     def create_map(self, query_path, query_sets_ids, map_config, facade, sort_param, multiple_param, tmp_files_dir = None):
         raise m2pException("To be implemented in child classes.")
+    
+    # Order of the DBs for searches in which queries found in a DB
+    # are not aligned to the next ones (see DBOrderPlanner)
+    def _plan_dbs_order(self, query_sets_ids, map_config, facade):
+        
+        db_order_planner = DBOrderPlanner.from_paths_config(facade.get_paths_config(), self._verbose)
+        if db_order_planner == None: return query_sets_ids
+        
+        return db_order_planner.plan(query_sets_ids, self._aligner_list,
+                                     map_config.is_db_order_pinned(), map_config.get_name())
 
 class SearchEngineGreedy(SearchEngineAlignments):
     
@@ -153,8 +166,13 @@ class SearchEngineGreedy(SearchEngineAlignments):
         
         sys.stderr.write("SearchEngineGreedy: creating map: "+map_config.get_name()+"\n")
         
-        alignment_results = facade.perform_alignment(query_path, query_sets_ids, self._databases_config, self._alignment_type, self._aligner_list, \
-                                self._threshold_id, self._threshold_cov, self._n_threads)
+        query_fasta = load_query_fasta(query_path, facade.get_paths_config().get_query_subsets_in_memory())
+        
+        if self._alignment_type == ALIGNMENT_TYPE_HIERARCHICAL:
+            query_sets_ids = self._plan_dbs_order(query_sets_ids, map_config, facade)
+        
+        alignment_results = facade.perform_alignment(query_fasta, query_sets_ids, self._databases_config, self._alignment_type, self._aligner_list, \
+                                self._threshold_id, self._threshold_cov, self._n_threads, n_jobs = self._n_jobs)
         
         sys.stderr.write("SearchEngineGreedy: aligned "+str(len(alignment_results.get_aligned()))+"\n")
         
@@ -183,14 +201,17 @@ class SearchEngineExhaustive(SearchEngineAlignments):
         map_reader = MapReader(self._maps_path, map_config, self._verbose)
         mapper = Mappers.get_alignments_mapper(map_as_physical, map_reader, self._verbose)
         
-        current_path = query_path
+        query_fasta = load_query_fasta(query_path, facade.get_paths_config().get_query_subsets_in_memory())
+        current_query = query_fasta
+        
+        query_sets_ids = self._plan_dbs_order(query_sets_ids, map_config, facade)
         
-        tmp_files_list = []
+        subsets_list = []
         prev_mapping_results = None
         try:
             for db in query_sets_ids:
                 query_set = [db]
-                alignment_results = facade.perform_alignment(current_path, query_set,
+                alignment_results = facade.perform_alignment(current_query, query_set,
                                                              self._databases_config, self._alignment_type, self._aligner_list, \
                                                                 self._threshold_id, self._threshold_cov, self._n_threads)
                 
@@ -219,16 +240,16 @@ class SearchEngineExhaustive(SearchEngineAlignments):
                 if len(remaining_queries)==0:
                     break
                 else:
-                    current_path = alignment_utils.extract_fasta_headers(current_path, remaining_queries, tmp_files_dir)
-                    tmp_files_list.append(current_path)
+                    current_query = current_query.subset(remaining_queries, tmp_files_dir)
+                    subsets_list.append(current_query)
                 
                 prev_mapping_results = mapping_results
             
         except Exception:
             raise
         finally:
-            for tmp_file in tmp_files_list:
-                os.remove(tmp_file)
+            for query_subset in subsets_list:
+                query_subset.remove()
         
         sorted_positions = mapper._sort_positions_list(mapping_results.get_mapped(), sort_param)
         mapping_results.set_mapped(sorted_positions)
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# DatasetCache.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import sys, os, bisect, threading
+from collections import OrderedDict
+
+from barleymapcore.m2p_exception import m2pException
+from barleymapcore.maps.MapsBase import MapTypes
+from barleymapcore.utils.bgzf_utils import open_data_file
+
+from DatasetPosIndex import get_record_positions
+
+# When the max size is exceeded, entries are evicted down to this fraction of it
+EVICTION_TARGET = 0.9
+# Approximate memory (bytes) used by the containers of each record or synonym, besides its strings
+RECORD_OVERHEAD = 80
+
+### Records of a dataset file by marker id: the records (lines)
+### in the order of the file, and marker id --> positions of its records
+class DatasetIdTable(object):
+    
+    _records = None
+    _ids = None
+    _size = 0
+    
+    def __init__(self, records, ids, size):
+        self._records = records
+        self._ids = ids
+        self._size = size
+    
+    def get_size(self):
+        return self._size
+    
+    # Records of the keys, in the order of the dataset file
+    def get_records(self, keys):
+        records_pos = set()
+        for key in keys:
+            records_pos.update(self._ids.get(key, []))
+        
+        return [self._records[record_pos] for record_pos in sorted(records_pos)]
+    
+    # All the records, in the order of the dataset file
+    def get_all_records(self):
+        return self._records
+    
+    @staticmethod
+    def build(data_path):
+        records = []
+        ids = {}
+        size = 0
+        
+        with open_data_file(data_path) as data_file:
+            for line in data_file:
+                if line.startswith(">") or line.startswith("#"): continue
+                marker_id = line.strip().split("\t", 1)[0]
+                ids.setdefault(marker_id, []).append(len(records))
+                records.append(line)
+                size += sys.getsizeof(line) + RECORD_OVERHEAD
+        
+        return DatasetIdTable(records, ids, size)
+
+### Positions of the records of a dataset file for a sort field (cm, bp) of a map:
+### for each chromosome, the records sorted by position, so that those
+### which could overlap an interval are found with a binary search
+class DatasetPosArrays(object):
+    
+    _records = None # lines, in the order of the file
+    _chroms = None # chrom --> (sorted ini positions, end positions, positions of the records, max length of the records)
+    _size = 0
+    
+    def __init__(self, records, chroms, size):
+        self._records = records
+        self._chroms = chroms
+        self._size = size
+    
+    def get_size(self):
+        return self._size
+    
+    def get_record(self, record_pos):
+        return self._records[record_pos]
+    
+    # Positions of the records of the chromosome which could overlap the interval,
+    # in no particular order. These have to be checked against the interval.
+    def find_records(self, chrom, ini_pos, end_pos):
+        
+        if chrom not in self._chroms: return []
+        
+        (ini_positions, end_positions, records_pos, max_length) = self._chroms[chrom]
+        ini_pos = float(ini_pos)
+        end_pos = float(end_pos)
+        
+        first = bisect.bisect_left(ini_positions, ini_pos - max_length)
+        last = bisect.bisect_right(ini_positions, end_pos)
+        
+        return [records_pos[i] for i in xrange(first, last) if end_positions[i] >= ini_pos]
+    
+    @staticmethod
+    def build(data_path, map_config, sort_by):
+        
+        if sort_by == MapTypes.MAP_SORT_PARAM_CM:
+            (pos_field, end_pos_field) = (1, 2)
+        elif sort_by == MapTypes.MAP_SORT_PARAM_BP:
+            (pos_field, end_pos_field) = (3, 4)
+        else:
+            raise m2pException("Unrecognized sort field "+str(sort_by)+".")
+        
+        map_is_physical = map_config.as_physical()
+        map_has_cm_pos = map_config.has_cm_pos()
+        map_has_bp_pos = map_config.has_bp_pos()
+        
+        records = []
+        chroms_records = {} # chrom --> list of (ini position, end position, position of the record)
+        size = 0
+        
+        with open_data_file(data_path) as data_file:
+            for line in data_file:
+                if line.startswith(">") or line.startswith("#"): continue
+                mapping_data = line.strip().split("\t")
+                if len(mapping_data) < 3: continue
+                
+                positions = get_record_positions(mapping_data, map_is_physical, map_has_cm_pos, map_has_bp_pos)
+                ini_pos = min(float(positions[pos_field]), float(positions[end_pos_field]))
+                end_pos = max(float(positions[pos_field]), float(positions[end_pos_field]))
+                
+                chroms_records.setdefault(positions[0], []).append((ini_pos, end_pos, len(records)))
+                records.append(line)
+                size += sys.getsizeof(line) + RECORD_OVERHEAD
+        
+        chroms = {}
+        for chrom, chrom_records in chroms_records.iteritems():
+            chrom_records.sort()
+            chroms[chrom] = ([record[0] for record in chrom_records],
+                             [record[1] for record in chrom_records],
+                             [record[2] for record in chrom_records],
+                             max([record[1] - record[0] for record in chrom_records]))
+        
+        return DatasetPosArrays(records, chroms, size)
+
+### Synonyms of a dataset (marker id --> list of synonyms, as DatasetsRetriever.load_synonyms),
+### which also knows the markers of which each id is a synonym
+class DatasetSynonyms(dict):
+    
+    _markers = None # synonym --> marker ids
+    _size = 0
+    
+    def get_size(self):
+        return self._size
+    
+    # The keys, and the markers of which the keys are synonyms
+    def get_records_keys(self, keys):
+        records_keys = set(keys)
+        
+        for key in keys:
+            records_keys.update(self._markers.get(key, []))
+        
+        return records_keys
+    
+    @staticmethod
+    def build(synonyms_path):
+        dataset_synonyms = DatasetSynonyms()
+        dataset_synonyms._markers = {}
+        
+        for syn_line in open(synonyms_path, 'r'):
+            syn_data = syn_line.strip().split()
+            syn_key = syn_data[0]
+            if syn_key in dataset_synonyms:
+                raise m2pException("Repeated synonyms entry for marker "+syn_key+".")
+            else:
+                dataset_synonyms[syn_key] = syn_data
+                for synonym in syn_data:
+                    dataset_synonyms._markers.setdefault(synonym, []).append(syn_key)
+                dataset_synonyms._size += sys.getsizeof(syn_line) + RECORD_OVERHEAD * len(syn_data)
+        
+        return dataset_synonyms
+
+### In-process cache of the contents of dataset files (DatasetIdTable, DatasetPosArrays
+### and DatasetSynonyms), so that the datasets used often are not read for each request.
+### Entries are checked against the mtime and size of their file, and are built again
+### if the file changed. Least recently used entries are evicted once the cache
+### exceeds its max size (bytes). A single cache is shared by the whole process
+### (see get_process_cache), so that it outlives the DatasetsRetriever of each request.
+class DatasetCache(object):
+    
+    _max_size = 0
+    _verbose = False
+    
+    _entries = None # key --> ((mtime, size) of the file, entry), least recently used first
+    _size = 0
+    _lock = None
+    
+    # Counters of the cache
+    _hits = 0
+    _misses = 0
+    _evictions = 0
+    
+    STAT_HITS = "hits"
+    STAT_MISSES = "misses"
+    STAT_EVICTIONS = "evictions"
+    
+    # The cache of the process
+    _process_cache = None
+    _process_cache_lock = threading.Lock()
+    
+    def __init__(self, max_size, verbose = False):
+        self._max_size = max_size
+        self._verbose = verbose
+        
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+    
+    # The cache of the process, created the first time. A new max size is applied to it.
+    @staticmethod
+    def get_process_cache(max_size, verbose = False):
+        with DatasetCache._process_cache_lock:
+            if DatasetCache._process_cache == None:
+                DatasetCache._process_cache = DatasetCache(max_size, verbose)
+            else:
+                DatasetCache._process_cache.set_max_size(max_size)
+            
+            dataset_cache = DatasetCache._process_cache
+        
+        return dataset_cache
+    
+    # Returns the cache of the process from the paths config, or None if it is not enabled
+    @staticmethod
+    def from_paths_config(paths_config, verbose = False):
+        dataset_cache = None
+        
+        max_size = paths_config.get_dataset_cache_size()
+        if max_size > 0:
+            dataset_cache = DatasetCache.get_process_cache(max_size, verbose)
+        
+        return dataset_cache
+    
+    def set_max_size(self, max_size):
+        with self._lock:
+            self._max_size = max_size
+            self._evict()
+        
+        return
+    
+    def get_id_table(self, data_path):
+        return self._get(("ids", data_path), data_path,
+                         lambda: DatasetIdTable.build(data_path))
+    
+    def get_pos_arrays(self, data_path, map_config, sort_by):
+        # the positions of the records depend on the fields of the map
+        key = ("pos", data_path, sort_by, map_config.as_physical(), map_config.has_cm_pos(), map_config.has_bp_pos())
+        return self._get(key, data_path,
+                         lambda: DatasetPosArrays.build(data_path, map_config, sort_by))
+    
+    def get_synonyms(self, synonyms_path):
+        return self._get(("synonyms", synonyms_path), synonyms_path,
+                         lambda: DatasetSynonyms.build(synonyms_path))
+    
+    # The entry of the key, from the cache if the file has not changed,
+    # otherwise it is built (without holding the lock) and stored
+    def _get(self, key, path, build_entry):
+        path_stat = os.stat(path)
+        file_version = (path_stat.st_mtime, path_stat.st_size)
+        
+        with self._lock:
+            cached = self._entries.pop(key, None)
+            if cached != None:
+                if cached[0] == file_version:
+                    self._entries[key] = cached # the most recently used
+                    self._hits += 1
+                    return cached[1]
+                
+                self._size -= cached[1].get_size()
+            
+            self._misses += 1
+        
+        entry = build_entry()
+        entry_size = entry.get_size()
+        
+        if self._verbose: sys.stderr.write("DatasetCache: loaded "+path+" ("+str(entry_size)+" bytes)\n")
+        
+        with self._lock:
+            if entry_size <= self._max_size:
+                previous = self._entries.pop(key, None)
+                if previous != None: self._size -= previous[1].get_size()
+                
+                self._entries[key] = (file_version, entry)
+                self._size += entry_size
+                self._evict()
+            elif self._verbose:
+                sys.stderr.write("DatasetCache: "+path+" is larger than the max size of the cache. It will not be cached.\n")
+        
+        return entry
+    
+    # Removes least recently used entries if the cache is over its max size. Requires the lock
+    def _evict(self):
+        
+        if self._size <= self._max_size: return
+        
+        target_size = self._max_size * EVICTION_TARGET
+        
+        num_evicted = 0
+        while self._size > target_size and len(self._entries) > 0:
+            (key, (file_version, entry)) = self._entries.popitem(last = False)
+            self._size -= entry.get_size()
+            num_evicted += 1
+        
+        self._evictions += num_evicted
+        
+        if self._verbose: sys.stderr.write("DatasetCache: evicted "+str(num_evicted)+" entries.\n")
+        
+        return
+    
+    def get_stats(self):
+        with self._lock:
+            return {self.STAT_HITS:self._hits, self.STAT_MISSES:self._misses, self.STAT_EVICTIONS:self._evictions}
+    
+    # Bytes (approx.) of the entries in the cache
+    def get_size(self):
+        return self._size
+    
+    def get_num_entries(self):
+        return len(self._entries)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        
+        return
+
+## END
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# DatasetIndex.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import sys, os, mmap, struct, hashlib, threading
+
+from barleymapcore.m2p_exception import m2pException
+from barleymapcore.utils.bgzf_utils import open_data_file, read_lines_with_offsets
+
+INDEX_EXT = ".bidx" # binary index of a dataset file: dataset_file.bidx
+INDEX_MAGIC = "BMIDX1\n"
+ENTRY_FORMAT = "<QQ" # hash of the marker id, offset of its record in the dataset file
+ENTRY_SIZE = struct.calcsize(ENTRY_FORMAT)
+
+def get_key_hash(key):
+    return struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0]
+
+# (size, mtime) of a dataset file, as recorded in the header of its indexes
+def get_data_version(data_path):
+    data_stat = os.stat(data_path)
+    return (long(data_stat.st_size), data_stat.st_mtime)
+
+### Index of the records of a dataset file by marker id (first column),
+### stored as a sorted array of fixed-size entries (hash of the id, offset of the record),
+### like a constant database (offsets are virtual offsets if the dataset file is BGZF).
+### The file is opened and mapped (mmap) on the first lookup,
+### and each id is searched with a binary search over the mapped entries,
+### so the index is never loaded nor deserialised as a whole.
+### Since the ids are not stored, each candidate record is checked
+### against the id in the dataset file, which is read anyway to parse the record.
+### If the index is built with the synonyms file of the dataset, it has also
+### an array of entries for each id of each line of synonyms (including the first one,
+### the id of the records), with the offset of that line, which is copied to the index.
+### Thus, a synonym leads to the id of its records, and the records are looked up as any other id.
+class DatasetIndex(object):
+    
+    _index_path = ""
+    _index_file = None
+    _index_mmap = None
+    _open_lock = None
+    _header = None # dict field --> value
+    _entries_start = 0
+    _num_entries = 0
+    _synonyms_entries_start = 0
+    _num_synonyms_entries = 0
+    _synonyms_start = 0 # lines of synonyms
+    
+    def __init__(self, index_path):
+        self._index_path = index_path
+        self._index_file = None
+        self._index_mmap = None
+        self._open_lock = threading.Lock()
+    
+    @staticmethod
+    def get_index_path(data_path):
+        return data_path+INDEX_EXT
+    
+    def _open(self):
+        
+        with self._open_lock:
+            if self._index_mmap != None: return
+            
+            index_file = open(self._index_path, 'rb')
+            
+            if index_file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                index_file.close()
+                raise m2pException("DatasetIndex: "+self._index_path+" is not a dataset index.")
+            
+            header_line = index_file.readline()
+            self._header = dict([field.split("=") for field in header_line.split()])
+            self._num_entries = int(self._header["entries"])
+            self._entries_start = len(INDEX_MAGIC) + len(header_line)
+            self._num_synonyms_entries = int(self._header.get("synonyms_entries", "0"))
+            self._synonyms_entries_start = self._entries_start + self._num_entries*ENTRY_SIZE
+            self._synonyms_start = self._synonyms_entries_start + self._num_synonyms_entries*ENTRY_SIZE
+            
+            self._index_file = index_file
+            self._index_mmap = mmap.mmap(index_file.fileno(), 0, access = mmap.ACCESS_READ)
+        
+        return
+    
+    def close(self):
+        if self._index_mmap != None:
+            self._index_mmap.close()
+            self._index_file.close()
+            self._index_mmap = None
+        
+        return
+    
+    def get_num_entries(self):
+        self._open()
+        return self._num_entries
+    
+    def get_num_synonyms_entries(self):
+        self._open()
+        return self._num_synonyms_entries
+    
+    def has_synonyms(self):
+        self._open()
+        return "synonyms_size" in self._header
+    
+    # Size of the synonyms file from which the index was built, or -1 if it has no synonyms
+    def get_synonyms_size(self):
+        self._open()
+        return long(self._header.get("synonyms_size", "-1"))
+    
+    # (size, mtime) of the dataset file from which the index was built,
+    # or None if it is not recorded (index built by a previous version)
+    def get_data_version(self):
+        self._open()
+        if "data_size" not in self._header or "data_mtime" not in self._header: return None
+        return (long(self._header["data_size"]), float(self._header["data_mtime"]))
+    
+    # Offsets of the entries with the given hash, in the array of entries from start with num_entries
+    def _find_offsets(self, key_hash, start, num_entries):
+        offsets = []
+        
+        index_mmap = self._index_mmap
+        
+        # First entry with hash >= key_hash
+        low = 0
+        high = num_entries
+        while low < high:
+            mid = (low + high) / 2
+            (mid_hash, mid_offset) = struct.unpack_from(ENTRY_FORMAT, index_mmap, start + mid*ENTRY_SIZE)
+            if mid_hash < key_hash: low = mid + 1
+            else: high = mid
+        
+        while low < num_entries:
+            (entry_hash, entry_offset) = struct.unpack_from(ENTRY_FORMAT, index_mmap, start + low*ENTRY_SIZE)
+            if entry_hash != key_hash: break
+            offsets.append(entry_offset)
+            low += 1
+        
+        return offsets
+    
+    # Offsets of the records whose hash matches some of the keys, in the order of the dataset file.
+    # Records of other ids with the same hash have to be discarded once read.
+    def lookup(self, keys):
+        offsets = set()
+        
+        self._open()
+        
+        for key in keys:
+            offsets.update(self._find_offsets(get_key_hash(key), self._entries_start, self._num_entries))
+        
+        return sorted(offsets)
+    
+    # Lines of synonyms (list of ids, the first one being the id of the records) which include the key
+    def find_synonyms(self, key):
+        synonyms_list = []
+        
+        self._open()
+        
+        index_mmap = self._index_mmap
+        
+        for line_offset in self._find_offsets(get_key_hash(key), self._synonyms_entries_start, self._num_synonyms_entries):
+            line_start = self._synonyms_start + line_offset
+            synonyms = index_mmap[line_start:index_mmap.find("\n", line_start)].split()
+            if key in synonyms:
+                synonyms_list.append(synonyms)
+        
+        return synonyms_list
+    
+    # The synonyms of the records with the given id
+    # (as DatasetsRetriever.load_synonyms), or None if it has no synonyms
+    def get_synonyms(self, key):
+        
+        for synonyms in self.find_synonyms(key):
+            if synonyms[0] == key:
+                return synonyms
+        
+        return None
+    
+    # Builds the index of a dataset file (records with the marker id in the first column)
+    # and, optionally, of its synonyms file (a line of ids per marker, the first one being the id of its records)
+    @staticmethod
+    def build(data_path, index_path, synonyms_path = None, verbose = False):
+        entries = []
+        
+        (data_size, data_mtime) = get_data_version(data_path)
+        
+        with open_data_file(data_path) as data_file:
+            for (line_start, line_end, line) in read_lines_with_offsets(data_file):
+                if not (line.startswith(">") or line.startswith("#")):
+                    marker_id = line.split("\t", 1)[0].strip()
+                    if marker_id != "":
+                        entries.append((get_key_hash(marker_id), line_start))
+        
+        entries.sort()
+        
+        header = "entries="+str(len(entries))+" data_size="+str(data_size)+" data_mtime="+repr(data_mtime)
+        
+        synonyms_entries = []
+        synonyms_lines = []
+        if synonyms_path:
+            synonyms_keys = set()
+            line_offset = 0
+            for syn_line in open(synonyms_path, 'r'):
+                syn_data = syn_line.strip().split()
+                if len(syn_data) == 0: continue
+                syn_key = syn_data[0]
+                if syn_key in synonyms_keys:
+                    raise m2pException("Repeated synonyms entry for marker "+syn_key+".")
+                synonyms_keys.add(syn_key)
+                
+                for synonym in set(syn_data):
+                    synonyms_entries.append((get_key_hash(synonym), line_offset))
+                
+                syn_line = " ".join(syn_data)+"\n"
+                synonyms_lines.append(syn_line)
+                line_offset += len(syn_line)
+            
+            synonyms_entries.sort()
+            
+            header += " synonyms_entries="+str(len(synonyms_entries))+" synonyms_size="+str(os.path.getsize(synonyms_path))
+        
+        with open(index_path, 'wb') as index_file:
+            index_file.write(INDEX_MAGIC)
+            index_file.write(header+"\n")
+            for entry in entries:
+                index_file.write(struct.pack(ENTRY_FORMAT, *entry))
+            for entry in synonyms_entries:
+                index_file.write(struct.pack(ENTRY_FORMAT, *entry))
+            for syn_line in synonyms_lines:
+                index_file.write(syn_line)
+        
+        if verbose: sys.stderr.write("DatasetIndex: "+str(len(entries))+" records"+\
+                                     (" and "+str(len(synonyms_lines))+" lines of synonyms" if synonyms_path else "")+\
+                                     " indexed in "+index_path+"\n")
+        
+        return
+
+### Synonyms of a dataset (marker id --> list of synonyms), read from its index
+### only for the markers which are looked up, instead of loading the synonyms file.
+### The synonyms read are kept, so it is meant to be used for a single request.
+class IndexedSynonyms(object):
+    
+    _dataset_index = None
+    _synonyms = None # marker id --> list of synonyms, or None if it has no synonyms
+    
+    def __init__(self, dataset_index):
+        self._dataset_index = dataset_index
+        self._synonyms = {}
+    
+    def get_dataset_index(self):
+        return self._dataset_index
+    
+    # The keys, and the markers of which the keys are synonyms
+    def get_records_keys(self, keys):
+        records_keys = set(keys)
+        
+        for key in keys:
+            for synonyms in self._dataset_index.find_synonyms(key):
+                self._synonyms[synonyms[0]] = synonyms
+                records_keys.add(synonyms[0])
+        
+        return records_keys
+    
+    # Offsets of the records of the keys, and of the markers
+    # of which the keys are synonyms, in the order of the dataset file
+    def lookup(self, keys):
+        return self._dataset_index.lookup(self.get_records_keys(keys))
+    
+    def get(self, key, default = None):
+        if key in self._synonyms:
+            synonyms = self._synonyms[key]
+        else:
+            synonyms = self._dataset_index.get_synonyms(key)
+            self._synonyms[key] = synonyms
+        
+        return synonyms if synonyms != None else default
+    
+    def __contains__(self, key):
+        return self.get(key) != None
+    
+    def __getitem__(self, key):
+        synonyms = self.get(key)
+        if synonyms == None: raise KeyError(key)
+        return synonyms
+    
+    def __len__(self):
+        return self._dataset_index.get_num_synonyms_entries()
+
+### Indexes of the datasets, kept open once per process and reopened if the files change.
+### An index is not used if its dataset file changed after building it.
+class DatasetIndexes(object):
+    
+    # index path --> (mtime, DatasetIndex)
+    _indexes = {}
+    _indexes_lock = threading.Lock()
+    
+    # The index of a dataset file, or None if it has no index,
+    # or if the dataset file changed after building the index
+    @staticmethod
+    def get_index(data_path):
+        index_path = DatasetIndex.get_index_path(data_path)
+        
+        if not os.path.isfile(index_path): return None
+        
+        mtime = os.path.getmtime(index_path)
+        
+        with DatasetIndexes._indexes_lock:
+            loaded = DatasetIndexes._indexes.get(index_path)
+            if loaded != None and loaded[0] == mtime:
+                index = loaded[1]
+            else:
+                index = DatasetIndex(index_path)
+                # A previous version of the index is not closed, since it could
+                # still be used by other threads (its mmap is closed when collected)
+                DatasetIndexes._indexes[index_path] = (mtime, index)
+        
+        index_data_version = index.get_data_version()
+        if index_data_version == None:
+            sys.stderr.write("DatasetIndexes: "+index_path+" does not record the version of the dataset file. "+\
+                             "It has to be built again. The index will not be used.\n")
+            index = None
+        elif index_data_version != get_data_version(data_path):
+            sys.stderr.write("DatasetIndexes: dataset file "+data_path+" changed after building the index "+\
+                             index_path+". The index will not be used.\n")
+            index = None
+        
+        return index
+    
+    # The synonyms of a dataset from its index, if it was built with
+    # the synonyms file and this has not changed since then. None otherwise.
+    @staticmethod
+    def get_synonyms(data_path, synonyms_path):
+        indexed_synonyms = None
+        
+        index = DatasetIndexes.get_index(data_path)
+        if index != None and index.has_synonyms() and os.path.isfile(synonyms_path):
+            index_path = DatasetIndex.get_index_path(data_path)
+            if index.get_synonyms_size() == os.path.getsize(synonyms_path) and \
+               os.path.getmtime(index_path) >= os.path.getmtime(synonyms_path):
+                indexed_synonyms = IndexedSynonyms(index)
+            else:
+                sys.stderr.write("DatasetIndexes: synonyms file "+synonyms_path+" changed after building the index "+\
+                                 index_path+". The synonyms file will be used instead.\n")
+        
+        return indexed_synonyms
+
+## END
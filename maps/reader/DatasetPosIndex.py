@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# DatasetPosIndex.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import sys, os, mmap, struct, threading
+
+from barleymapcore.m2p_exception import m2pException
+from barleymapcore.maps.MapsBase import MapTypes
+from barleymapcore.utils.bgzf_utils import open_data_file, read_lines_with_offsets
+
+from DatasetIndex import get_key_hash, get_data_version
+
+POS_INDEX_EXT = ".pidx" # positional index of a dataset file: dataset_file.pidx
+POS_INDEX_MAGIC = "BMPOSIDX1\n"
+# hash of sort field and chromosome, bin, chunk of records (start and end offsets in the dataset file)
+POS_ENTRY_FORMAT = "<QqQQ"
+POS_ENTRY_SIZE = struct.calcsize(POS_ENTRY_FORMAT)
+
+DEFAULT_BP_BIN = 100000 # bp
+DEFAULT_CM_BIN = 1.0 # cM
+
+# (chrom, cm_pos, cm_end_pos, bp_pos, bp_end_pos) of a record,
+# from its fields as in MappingResult.init_from_data (-1 if the map has not that position)
+def get_record_positions(mapping_data, map_is_physical, map_has_cm_pos, map_has_bp_pos):
+    cm_pos = cm_end_pos = bp_pos = bp_end_pos = -1
+    
+    if map_is_physical:
+        bp_pos = mapping_data[2]
+        bp_end_pos = mapping_data[3]
+    elif map_has_cm_pos and map_has_bp_pos:
+        cm_pos = cm_end_pos = mapping_data[2]
+        bp_pos = bp_end_pos = mapping_data[3]
+    elif map_has_cm_pos:
+        cm_pos = cm_end_pos = mapping_data[2]
+    elif map_has_bp_pos:
+        bp_pos = bp_end_pos = mapping_data[2]
+    else:
+        raise m2pException("Map configuration is wrong: has not cm nor bp positions.")
+    
+    return (mapping_data[1], cm_pos, cm_end_pos, bp_pos, bp_end_pos)
+
+def _sort_key_hash(sort_by, chrom):
+    return get_key_hash(sort_by+"\t"+chrom)
+
+### Positional index of the records of a dataset file, as tabix:
+### for each sort field (cm, bp) and chromosome, the positions are split
+### in bins of fixed size, and each bin has the chunks of the dataset file
+### (ranges of consecutive records) with the records which overlap the bin
+### (offsets are virtual offsets if the dataset file is BGZF).
+### The entries (hash of sort field and chromosome, bin, chunk) are sorted,
+### and the file is mapped (mmap) and searched with a binary search, as DatasetIndex.
+### Records of the chunks found have to be checked against the interval queried,
+### since chunks include whole bins (and other chromosomes with the same hash).
+class DatasetPosIndex(object):
+    
+    _index_path = ""
+    _index_file = None
+    _index_mmap = None
+    _open_lock = None
+    _header = None # dict field --> value
+    _entries_start = 0
+    _num_entries = 0
+    
+    def __init__(self, index_path):
+        self._index_path = index_path
+        self._index_file = None
+        self._index_mmap = None
+        self._open_lock = threading.Lock()
+    
+    @staticmethod
+    def get_index_path(data_path):
+        return data_path+POS_INDEX_EXT
+    
+    def _open(self):
+        
+        with self._open_lock:
+            if self._index_mmap != None: return
+            
+            index_file = open(self._index_path, 'rb')
+            
+            if index_file.read(len(POS_INDEX_MAGIC)) != POS_INDEX_MAGIC:
+                index_file.close()
+                raise m2pException("DatasetPosIndex: "+self._index_path+" is not a positional index.")
+            
+            header_line = index_file.readline()
+            self._header = dict([field.split("=") for field in header_line.split()])
+            self._num_entries = int(self._header["entries"])
+            self._entries_start = len(POS_INDEX_MAGIC) + len(header_line)
+            
+            self._index_file = index_file
+            self._index_mmap = mmap.mmap(index_file.fileno(), 0, access = mmap.ACCESS_READ)
+        
+        return
+    
+    def close(self):
+        if self._index_mmap != None:
+            self._index_mmap.close()
+            self._index_file.close()
+            self._index_mmap = None
+        
+        return
+    
+    # Whether the index was built with the layout of fields of the map
+    def fits_map(self, map_config):
+        self._open()
+        return self._header["physical"] == str(int(map_config.as_physical())) and \
+               self._header["cm"] == str(int(map_config.has_cm_pos())) and \
+               self._header["bp"] == str(int(map_config.has_bp_pos()))
+    
+    # (size, mtime) of the dataset file from which the index was built,
+    # or None if it is not recorded (index built by a previous version)
+    def get_data_version(self):
+        self._open()
+        if "data_size" not in self._header or "data_mtime" not in self._header: return None
+        return (long(self._header["data_size"]), float(self._header["data_mtime"]))
+    
+    def has_sort_by(self, sort_by):
+        self._open()
+        return sort_by in self._header["sort_by"].split(",")
+    
+    def _get_bin_size(self, sort_by):
+        if sort_by == MapTypes.MAP_SORT_PARAM_CM:
+            bin_size = float(self._header["cm_bin"])
+        elif sort_by == MapTypes.MAP_SORT_PARAM_BP:
+            bin_size = float(self._header["bp_bin"])
+        else:
+            raise m2pException("Unrecognized sort field "+str(sort_by)+".")
+        
+        return bin_size
+    
+    # Bins overlapped by the positions ini_pos to end_pos
+    def get_bins(self, sort_by, ini_pos, end_pos):
+        self._open()
+        bin_size = self._get_bin_size(sort_by)
+        return xrange(int(float(ini_pos) // bin_size), int(float(end_pos) // bin_size) + 1)
+    
+    # Chunks (start, end offsets) of the dataset file with the records
+    # of the bins which overlap the interval, not merged nor sorted
+    def get_chunks(self, sort_by, chrom, ini_pos, end_pos):
+        chunks = []
+        
+        bins = self.get_bins(sort_by, ini_pos, end_pos)
+        if len(bins) == 0: return chunks
+        
+        key_hash = _sort_key_hash(sort_by, chrom)
+        first_bin = bins[0]
+        last_bin = bins[-1]
+        
+        index_mmap = self._index_mmap
+        start = self._entries_start
+        num_entries = self._num_entries
+        
+        # First entry >= (key_hash, first_bin)
+        low = 0
+        high = num_entries
+        while low < high:
+            mid = (low + high) / 2
+            (mid_hash, mid_bin, mid_start, mid_end) = struct.unpack_from(POS_ENTRY_FORMAT, index_mmap, start + mid*POS_ENTRY_SIZE)
+            if (mid_hash, mid_bin) < (key_hash, first_bin): low = mid + 1
+            else: high = mid
+        
+        while low < num_entries:
+            (entry_hash, entry_bin, chunk_start, chunk_end) = struct.unpack_from(POS_ENTRY_FORMAT, index_mmap, start + low*POS_ENTRY_SIZE)
+            if entry_hash != key_hash or entry_bin > last_bin: break
+            chunks.append((chunk_start, chunk_end))
+            low += 1
+        
+        return chunks
+    
+    # Builds the positional index of a dataset file of a map (MapConfig),
+    # for the sort fields which the map has
+    @staticmethod
+    def build(data_path, index_path, map_config, bp_bin = DEFAULT_BP_BIN, cm_bin = DEFAULT_CM_BIN, verbose = False):
+        
+        map_is_physical = map_config.as_physical()
+        map_has_cm_pos = map_config.has_cm_pos() and not map_is_physical
+        map_has_bp_pos = map_config.has_bp_pos() or map_is_physical
+        
+        sort_fields = []
+        if map_has_cm_pos: sort_fields.append((MapTypes.MAP_SORT_PARAM_CM, float(cm_bin), 1, 2))
+        if map_has_bp_pos: sort_fields.append((MapTypes.MAP_SORT_PARAM_BP, float(bp_bin), 3, 4))
+        
+        # (hash, bin) --> list of chunks [start, end], in the order of the file
+        bins_chunks = {}
+        num_records = 0
+        
+        (data_size, data_mtime) = get_data_version(data_path)
+        
+        with open_data_file(data_path) as data_file:
+            for (line_start, line_end, line) in read_lines_with_offsets(data_file):
+                if line.startswith(">") or line.startswith("#"): continue
+                mapping_data = line.strip().split("\t")
+                if len(mapping_data) < 3: continue
+                
+                num_records += 1
+                positions = get_record_positions(mapping_data, map_config.as_physical(),
+                                                 map_config.has_cm_pos(), map_config.has_bp_pos())
+                chrom = positions[0]
+                
+                for (sort_by, bin_size, pos_field, end_pos_field) in sort_fields:
+                    pos = min(float(positions[pos_field]), float(positions[end_pos_field]))
+                    end_pos = max(float(positions[pos_field]), float(positions[end_pos_field]))
+                    key_hash = _sort_key_hash(sort_by, chrom)
+                    
+                    for record_bin in xrange(int(pos // bin_size), int(end_pos // bin_size) + 1):
+                        chunks = bins_chunks.setdefault((key_hash, record_bin), [])
+                        # Consecutive records of the same bin are kept in the same chunk
+                        if len(chunks) > 0 and chunks[-1][1] == line_start:
+                            chunks[-1][1] = line_end
+                        else:
+                            chunks.append([line_start, line_end])
+        
+        entries = [(key_hash, record_bin, chunk[0], chunk[1])
+                   for (key_hash, record_bin), chunks in bins_chunks.iteritems() for chunk in chunks]
+        entries.sort()
+        
+        header = " ".join(["entries="+str(len(entries)),
+                           "sort_by="+",".join([sort_field[0] for sort_field in sort_fields]),
+                           "bp_bin="+str(float(bp_bin)), "cm_bin="+str(float(cm_bin)),
+                           "physical="+str(int(map_config.as_physical())),
+                           "cm="+str(int(map_config.has_cm_pos())),
+                           "bp="+str(int(map_config.has_bp_pos())),
+                           "data_size="+str(data_size), "data_mtime="+repr(data_mtime)])
+        
+        with open(index_path, 'wb') as index_file:
+            index_file.write(POS_INDEX_MAGIC)
+            index_file.write(header+"\n")
+            for entry in entries:
+                index_file.write(struct.pack(POS_ENTRY_FORMAT, *entry))
+        
+        if verbose: sys.stderr.write("DatasetPosIndex: "+str(num_records)+" records in "+str(len(bins_chunks))+" bins, "+\
+                                     str(len(entries))+" chunks indexed in "+index_path+"\n")
+        
+        return
+
+### Positional indexes of the datasets, kept open once per process and reopened if the files change.
+### An index is not used if its dataset file changed after building it.
+class DatasetPosIndexes(object):
+    
+    # index path --> (mtime, DatasetPosIndex)
+    _indexes = {}
+    _indexes_lock = threading.Lock()
+    
+    # The positional index of a dataset file, or None if it has no index,
+    # if it was built for a map with other fields than map_config,
+    # or if the dataset file changed after building the index
+    @staticmethod
+    def get_index(data_path, map_config):
+        index_path = DatasetPosIndex.get_index_path(data_path)
+        
+        if not os.path.isfile(index_path): return None
+        
+        mtime = os.path.getmtime(index_path)
+        
+        with DatasetPosIndexes._indexes_lock:
+            loaded = DatasetPosIndexes._indexes.get(index_path)
+            if loaded != None and loaded[0] == mtime:
+                index = loaded[1]
+            else:
+                index = DatasetPosIndex(index_path)
+                # A previous version of the index is not closed, since it could
+                # still be used by other threads (its mmap is closed when collected)
+                DatasetPosIndexes._indexes[index_path] = (mtime, index)
+        
+        index_data_version = index.get_data_version()
+        if index_data_version == None:
+            sys.stderr.write("DatasetPosIndexes: "+index_path+" does not record the version of the dataset file. "+\
+                             "It has to be built again. The index will not be used.\n")
+            index = None
+        elif index_data_version != get_data_version(data_path):
+            sys.stderr.write("DatasetPosIndexes: dataset file "+data_path+" changed after building the index "+\
+                             index_path+". The index will not be used.\n")
+            index = None
+        elif not index.fits_map(map_config):
+            sys.stderr.write("DatasetPosIndexes: "+index_path+" was built for a map with other fields than "+\
+                             map_config.get_name()+". The index will not be used.\n")
+            index = None
+        
+        return index
+
+## END
@@ -11,14 +11,25 @@ import cPickle
 from barleymapcore.maps.MappingResults import MappingResult
 from barleymapcore.maps.MapInterval import MapInterval
 from barleymapcore.maps.enrichment.FeatureMapping import FeaturesFactory
+from barleymapcore.utils.bgzf_utils import open_data_file, get_data_path
 
 from MapFiles import MapFile
+from DatasetIndex import DatasetIndexes, IndexedSynonyms
+from DatasetPosIndex import DatasetPosIndexes
+from DatasetCache import DatasetSynonyms
 
 ### Class to obtain mapping results from pre-calculated datasets
 ### "mapping results" are those which have already map positions
-### like those resulting from running bmap_align to a map
+### like those resulting from running bmap_align to a map.
+### Data files can be plain text or BGZF compressed (see bgzf_utils).
+### If a DatasetCache is given, datasets are searched by id and by position in memory
 class MappingsParser(object):
     
+    _dataset_cache = None
+    
+    def __init__(self, dataset_cache = None):
+        self._dataset_cache = dataset_cache
+    
     def parse_mapping_file(self, data_path, map_config, chrom_dict):
         mapping_results_list = []
         
@@ -27,7 +38,7 @@ class MappingsParser(object):
         map_has_bp_pos = map_config.has_bp_pos()
         map_is_physical = map_config.as_physical()
         
-        for hit in open(data_path, 'r'):
+        for hit in open_data_file(data_path):
             if hit.startswith(">") or hit.startswith("#"): continue
             hit_data = hit.strip().split("\t")
             
@@ -36,7 +47,10 @@ class MappingsParser(object):
         
         return mapping_results_list
     
-    def _parse_mapping_file_by_id(self, query_ids_dict, data_path, map_config, chrom_dict,
+    # Parses the records (lines of a dataset file, in the order of the file)
+    # of the queries in test_set. Used both to scan the whole dataset file
+    # and to parse the records found with an index.
+    def _parse_hits_by_id(self, hits, query_ids_dict, map_config, chrom_dict,
                                         multiple_param, dataset_synonyms = {}, test_set = None):
         mapping_results_list = []
         
@@ -45,7 +59,7 @@ class MappingsParser(object):
         map_has_bp_pos = map_config.has_bp_pos()
         map_is_physical = map_config.as_physical()
         
-        for hit in open(data_path, 'r'):
+        for hit in hits:
             #sys.stderr.write(" ONE**************************\n")
             #sys.stderr.write(str(hit)+"\n")
             if hit.startswith(">") or hit.startswith("#"): continue
@@ -120,17 +134,64 @@ class MappingsParser(object):
         
         return mapping_results_list
     
-    def _parse_index_file_by_id(self, query_ids_dict, index_path, data_path, map_config, chrom_dict,
+    def _parse_mapping_file_by_id(self, query_ids_dict, data_path, map_config, chrom_dict,
+                                        multiple_param, dataset_synonyms = {}, test_set = None):
+        
+        with open_data_file(data_path) as data_f:
+            mapping_results_list = self._parse_hits_by_id(data_f, query_ids_dict, map_config, chrom_dict,
+                                                          multiple_param, dataset_synonyms, test_set)
+        
+        return mapping_results_list
+    
+    # Lines of the data file at the given offsets
+    def _read_hits(self, data_path, offsets):
+        with open_data_file(data_path) as data_f:
+            for offset in offsets:
+                data_f.seek(offset)
+                yield data_f.readline()
+    
+    # Records from the binary index (DatasetIndex): only the entries
+    # of the queries are read from the index, which is memory mapped.
+    # If the synonyms are in the index (IndexedSynonyms), the records
+    # of the markers of which the queries are synonyms are also read.
+    def _parse_dataset_index_by_id(self, query_ids_dict, dataset_index, data_path, map_config, chrom_dict,
                                                                     multiple_param, dataset_synonyms, test_set):
-        mapping_results_list = []
         
-        ## TODO: DO SOMETHING WITH THE SYNONYMS!!!
-        ##
+        if isinstance(dataset_synonyms, IndexedSynonyms):
+            offsets = dataset_synonyms.lookup(test_set)
+        else:
+            offsets = dataset_index.lookup(test_set)
+        
+        mapping_results_list = self._parse_hits_by_id(self._read_hits(data_path, offsets), query_ids_dict, map_config, chrom_dict,
+                                                      multiple_param, dataset_synonyms, test_set)
         
-        map_name = map_config.get_name()
-        map_has_cm_pos = map_config.has_cm_pos()
-        map_has_bp_pos = map_config.has_bp_pos()
-        map_is_physical = map_config.as_physical()
+        return mapping_results_list
+    
+    # Records from the table of ids of the dataset (DatasetIdTable) in the cache of datasets.
+    # The records of the markers of which the queries are synonyms are found with the synonyms
+    # if these are from the cache (DatasetSynonyms) or from the index (IndexedSynonyms),
+    # otherwise all the records are checked (without reading the dataset file)
+    def _parse_id_table_by_id(self, query_ids_dict, data_path, map_config, chrom_dict,
+                                                                    multiple_param, dataset_synonyms, test_set):
+        
+        id_table = self._dataset_cache.get_id_table(data_path)
+        
+        if len(dataset_synonyms) == 0:
+            hits = id_table.get_records(test_set)
+        elif isinstance(dataset_synonyms, (DatasetSynonyms, IndexedSynonyms)):
+            hits = id_table.get_records(dataset_synonyms.get_records_keys(test_set))
+        else:
+            hits = id_table.get_all_records()
+        
+        mapping_results_list = self._parse_hits_by_id(hits, query_ids_dict, map_config, chrom_dict,
+                                                      multiple_param, dataset_synonyms, test_set)
+        
+        return mapping_results_list
+    
+    # Records from an index of the old format (a pickled dict of marker id --> offset).
+    # These can be replaced by binary indexes (see utils/build_dataset_index.py).
+    def _parse_index_file_by_id(self, query_ids_dict, index_path, data_path, map_config, chrom_dict,
+                                                                    multiple_param, dataset_synonyms, test_set):
         
         sys.stderr.write("MappingsParser: loading index "+str(index_path)+"...\n")
         
@@ -139,28 +200,10 @@ class MappingsParser(object):
         
         sys.stderr.write("MappingsParser: loaded index with "+str(len(index))+" entries.\n")
         
-        sys.stderr.write("MappingsParser: obtaining index of queries...\n")
-        queries_bytes = []
-        for query in test_set:
-            if query in index:
-                query_bytes = index[query]
-                
-                query_ids_dict[query] = 1 # found
-                
-                queries_bytes.append(query_bytes)
-        
-        with open(data_path, 'r') as data_f:
-            for query_bytes in queries_bytes:
-                data_f.seek(query_bytes)
-                mapping_line = data_f.readline()
-                mapping_data = mapping_line.strip().split("\t")
-                mapping_result = MappingResult.init_from_data(mapping_data, map_name, chrom_dict, map_is_physical, map_has_cm_pos, map_has_bp_pos)
-                
-                if mapping_result.has_multiple_pos():
-                    if multiple_param == False:
-                        continue
-                
-                mapping_results_list.append(mapping_result)
+        offsets = sorted([index[query] for query in test_set if query in index])
+        
+        mapping_results_list = self._parse_hits_by_id(self._read_hits(data_path, offsets), query_ids_dict, map_config, chrom_dict,
+                                                      multiple_param, dataset_synonyms, test_set)
         
         return mapping_results_list
     
@@ -168,9 +211,23 @@ class MappingsParser(object):
                                         multiple_param, dataset_synonyms = {}, test_set = None):
         mapping_results_list = []
         
-        # check if there is an index
+        # check if the dataset is in memory (cache of datasets), or if there is an index:
+        # binary index or the old pickled one.
+        # The synonyms of a dataset can be resolved only with a binary index
+        # which includes them (IndexedSynonyms, see DatasetIndexes.get_synonyms),
+        # otherwise the whole file is scanned
+        dataset_index = DatasetIndexes.get_index(data_path)
         index_path = data_path+".idx"
-        if os.path.exists(index_path) and os.path.isfile(index_path):
+        if test_set and self._dataset_cache != None:
+            mapping_results_list = self._parse_id_table_by_id(query_ids_dict, data_path, map_config, chrom_dict,
+                                                                    multiple_param, dataset_synonyms, test_set)
+        elif not test_set or (len(dataset_synonyms) > 0 and not isinstance(dataset_synonyms, IndexedSynonyms)):
+            mapping_results_list = self._parse_mapping_file_by_id(query_ids_dict, data_path, map_config, chrom_dict,
+                                                                    multiple_param, dataset_synonyms, test_set)
+        elif dataset_index != None:
+            mapping_results_list = self._parse_dataset_index_by_id(query_ids_dict, dataset_index, data_path, map_config, chrom_dict,
+                                                                    multiple_param, dataset_synonyms, test_set)
+        elif os.path.exists(index_path) and os.path.isfile(index_path):
             mapping_results_list = self._parse_index_file_by_id(query_ids_dict, index_path, data_path, map_config, chrom_dict,
                                                                     multiple_param, dataset_synonyms, test_set)
         else:
@@ -179,9 +236,141 @@ class MappingsParser(object):
         
         return mapping_results_list
     
+    # Lines of the data file in the given chunks (start, end offsets),
+    # which are merged and read in the order of the file
+    def _read_chunks(self, data_path, chunks):
+        merged_chunks = []
+        for (chunk_start, chunk_end) in sorted(chunks):
+            if len(merged_chunks) > 0 and chunk_start <= merged_chunks[-1][1]:
+                merged_chunks[-1][1] = max(merged_chunks[-1][1], chunk_end)
+            else:
+                merged_chunks.append([chunk_start, chunk_end])
+        
+        with open_data_file(data_path) as data_f:
+            for (chunk_start, chunk_end) in merged_chunks:
+                data_f.seek(chunk_start)
+                while data_f.tell() < chunk_end:
+                    hit = data_f.readline()
+                    if not hit: break
+                    yield hit
+    
+    # Records of the positional index (DatasetPosIndex) which overlap the intervals (MapInterval).
+    # Yields (mapping_result, positions in map_intervals of the intervals overlapped),
+    # in the order of the dataset file
+    def _parse_pos_index_on_intervals(self, pos_index, intervals, data_path, chrom_dict, map_config, map_sort_by):
+        
+        map_name = map_config.get_name()
+        map_is_physical = map_config.as_physical()
+        map_has_cm_pos = map_config.has_cm_pos()
+        map_has_bp_pos = map_config.has_bp_pos()
+        
+        # Chunks of the bins of each interval, and
+        # (chrom, bin) --> positions of the intervals on that bin
+        chunks = []
+        bins_intervals = {}
+        for interval_pos, interval in enumerate(intervals):
+            chrom = interval.get_chrom()
+            ini_pos = interval.get_ini_pos()
+            end_pos = interval.get_end_pos()
+            chunks.extend(pos_index.get_chunks(map_sort_by, chrom, ini_pos, end_pos))
+            for interval_bin in pos_index.get_bins(map_sort_by, ini_pos, end_pos):
+                bins_intervals.setdefault((chrom, interval_bin), []).append(interval_pos)
+        
+        chroms = set([interval.get_chrom() for interval in intervals])
+        
+        for hit in self._read_chunks(data_path, chunks):
+            if hit.startswith(">") or hit.startswith("#"): continue
+            hit_data = hit.strip().split("\t")
+            
+            if hit_data[1] not in chroms: continue
+            
+            mapping_result = MappingResult.init_from_data(hit_data, map_name, chrom_dict, map_is_physical, map_has_cm_pos, map_has_bp_pos)
+            
+            chrom_name = mapping_result.get_chrom_name()
+            map_pos = mapping_result.get_sort_pos(map_sort_by)
+            map_end_pos = mapping_result.get_sort_end_pos(map_sort_by)
+            
+            candidates = set()
+            for hit_bin in pos_index.get_bins(map_sort_by, min(float(map_pos), float(map_end_pos)),
+                                                           max(float(map_pos), float(map_end_pos))):
+                candidates.update(bins_intervals.get((chrom_name, hit_bin), []))
+            
+            dataset_interval = MapInterval(chrom_name, map_pos, map_end_pos)
+            
+            overlapped = [interval_pos for interval_pos in sorted(candidates)
+                          if MapInterval.intervals_overlap(dataset_interval, intervals[interval_pos])]
+            
+            if len(overlapped) > 0:
+                yield (mapping_result, overlapped)
+    
+    # Records of the positional arrays (DatasetPosArrays) in the cache of datasets
+    # which overlap the intervals (MapInterval), as _parse_pos_index_on_intervals
+    def _parse_pos_arrays_on_intervals(self, pos_arrays, intervals, chrom_dict, map_config, map_sort_by):
+        
+        map_name = map_config.get_name()
+        map_is_physical = map_config.as_physical()
+        map_has_cm_pos = map_config.has_cm_pos()
+        map_has_bp_pos = map_config.has_bp_pos()
+        
+        # position of the record --> positions in intervals of the intervals which could overlap it
+        records_intervals = {}
+        for interval_pos, interval in enumerate(intervals):
+            for record_pos in pos_arrays.find_records(interval.get_chrom(), interval.get_ini_pos(), interval.get_end_pos()):
+                records_intervals.setdefault(record_pos, []).append(interval_pos)
+        
+        for record_pos in sorted(records_intervals):
+            hit_data = pos_arrays.get_record(record_pos).strip().split("\t")
+            
+            mapping_result = MappingResult.init_from_data(hit_data, map_name, chrom_dict, map_is_physical, map_has_cm_pos, map_has_bp_pos)
+            
+            chrom_name = mapping_result.get_chrom_name()
+            map_pos = mapping_result.get_sort_pos(map_sort_by)
+            map_end_pos = mapping_result.get_sort_end_pos(map_sort_by)
+            
+            dataset_interval = MapInterval(chrom_name, map_pos, map_end_pos)
+            
+            overlapped = [interval_pos for interval_pos in records_intervals[record_pos]
+                          if MapInterval.intervals_overlap(dataset_interval, intervals[interval_pos])]
+            
+            if len(overlapped) > 0:
+                yield (mapping_result, overlapped)
+    
+    # Returns the positional index of the data file, if it can be used to sort by map_sort_by, or None
+    def _get_pos_index(self, data_path, map_config, map_sort_by):
+        pos_index = DatasetPosIndexes.get_index(data_path, map_config)
+        
+        if pos_index != None and not pos_index.has_sort_by(map_sort_by):
+            pos_index = None
+        
+        return pos_index
+    
+    # Records which overlap the intervals, from the cache of datasets if there is one,
+    # or reading only the regions of the intervals if the dataset has a positional index.
+    # None if the whole dataset file has to be scanned
+    def _parse_on_intervals(self, intervals, data_path, chrom_dict, map_config, map_sort_by):
+        parsed_records = None
+        
+        if self._dataset_cache != None:
+            pos_arrays = self._dataset_cache.get_pos_arrays(data_path, map_config, map_sort_by)
+            parsed_records = self._parse_pos_arrays_on_intervals(pos_arrays, intervals, chrom_dict, map_config, map_sort_by)
+        else:
+            pos_index = self._get_pos_index(data_path, map_config, map_sort_by)
+            if pos_index != None:
+                parsed_records = self._parse_pos_index_on_intervals(pos_index, intervals, data_path,
+                                                                    chrom_dict, map_config, map_sort_by)
+        
+        return parsed_records
+    
     def parse_mapping_file_by_pos(self, map_intervals, data_path, chrom_dict, map_config, map_sort_by):
         mapping_results_list = []
         
+        parsed_records = self._parse_on_intervals(map_intervals, data_path, chrom_dict, map_config, map_sort_by)
+        if parsed_records != None:
+            for (mapping_result, overlapped) in parsed_records:
+                mapping_results_list.append(mapping_result)
+            
+            return mapping_results_list
+        
         map_name = map_config.get_name()
         map_is_physical = map_config.as_physical()
         map_has_cm_pos = map_config.has_cm_pos()
@@ -191,19 +380,20 @@ class MappingsParser(object):
         current_interval = map_intervals[current_interval_pos]
         
         # Find all the hits for this map
-        for hit in open(data_path, 'r'):
+        for hit in open_data_file(data_path):
             if hit.startswith(">") or hit.startswith("#"): continue
             hit_data = hit.strip().split("\t")
             
             #sys.stderr.write(hit+"\n")
             #sys.stderr.write("\t"+str(current_interval)+"\n")
             
+            # chromosome of the record, checked before creating the MappingResult
+            if hit_data[1] != current_interval.get_chrom(): continue
+            
             mapping_result = MappingResult.init_from_data(hit_data, map_name, chrom_dict, map_is_physical, map_has_cm_pos, map_has_bp_pos)
             
             chrom_name = mapping_result.get_chrom_name()
             
-            if chrom_name != current_interval.get_chrom(): continue
-            
             map_end_pos = mapping_result.get_sort_end_pos(map_sort_by)
             
             if float(map_end_pos) < float(current_interval.get_ini_pos()): continue
@@ -241,6 +431,17 @@ class MappingsParser(object):
     def parse_mapping_file_on_pos(self, map_intervals, data_path, chrom_dict, map_config, map_sort_by,
                                   dataset, dataset_name, feature_type):
         
+        intervals = [featured_map_interval.get_map_interval() for featured_map_interval in map_intervals]
+        parsed_records = self._parse_on_intervals(intervals, data_path, chrom_dict, map_config, map_sort_by)
+        if parsed_records != None:
+            for (mapping_result, overlapped) in parsed_records:
+                marker_id = mapping_result.get_marker_id()
+                for interval_pos in overlapped:
+                    feature = FeaturesFactory.get_feature(marker_id, dataset, dataset_name, feature_type, mapping_result)
+                    map_intervals[interval_pos].get_features().append(feature)
+            
+            return map_intervals
+        
         map_name = map_config.get_name()
         map_is_physical = map_config.as_physical()
         map_has_cm_pos = map_config.has_cm_pos()
@@ -258,19 +459,20 @@ class MappingsParser(object):
         #    sys.stderr.write("\t\t"+str(feature)+"\n")
         
         # Find all the hits for this map
-        for hit in open(data_path, 'r'):
+        for hit in open_data_file(data_path):
             if hit.startswith(">") or hit.startswith("#"): continue
             hit_data = hit.strip().split("\t")
             
             #sys.stderr.write(hit+"\n")
             #sys.stderr.write("\t"+str(current_interval)+"\n")
             
+            # chromosome of the record, checked before creating the MappingResult
+            if hit_data[1] != current_interval.get_chrom(): continue
+            
             mapping_result = MappingResult.init_from_data(hit_data, map_name, chrom_dict, map_is_physical, map_has_cm_pos, map_has_bp_pos)
             
             chrom_name = mapping_result.get_chrom_name()
             
-            if chrom_name != current_interval.get_chrom(): continue
-            
             map_end_pos = mapping_result.get_sort_end_pos(map_sort_by)
             
             if float(map_end_pos) < float(current_interval.get_ini_pos()): continue
@@ -338,11 +540,11 @@ class MappingsParser(object):
             db_records_read = 0
             
             # File with map-DB positions
-            map_path = maps_path+map_dir+"/"+map_dir+"."+db
+            map_path = get_data_path(maps_path+map_dir+"/"+map_dir+"."+db)
             if verbose: sys.stderr.write("\tMappingsParser: map file --> "+map_path+"\n")
             
             # Map data for this database
-            for map_line in open(map_path, 'r'):
+            for map_line in open_data_file(map_path):
                 db_records_read += 1
                 map_data = map_line.strip().split("\t")
                 
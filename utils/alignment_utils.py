@@ -27,6 +27,27 @@ def load_fasta_lengths(fasta_path):
     
     return len_dict
 
+# Returns a list of (header, sequence) tuples,
+# in the same order than in the fasta file
+def load_fasta_sequences(fasta_path):
+    fasta_seqs = []
+    
+    fasta_id = None
+    seq_lines = []
+    for fasta_line in open(fasta_path, 'r'):
+        if fasta_line.startswith(">"):
+            if fasta_id != None:
+                fasta_seqs.append((fasta_id, "".join(seq_lines)))
+            fasta_id = fasta_line[1:].strip()
+            seq_lines = []
+        else:
+            seq_lines.append(fasta_line.strip())
+    
+    if fasta_id != None:
+        fasta_seqs.append((fasta_id, "".join(seq_lines)))
+    
+    return fasta_seqs
+
 def get_fasta_headers(fasta_path):
     fasta_headers = []
     
@@ -61,7 +82,6 @@ def extract_fasta_headers(fasta_path, headers_list, tmp_files_dir):
         input_file = os.fdopen(file_desc, 'w')
         
         seq_found = False
-        fasta_headers = get_fasta_headers(fasta_path)
         for line in open(fasta_path):
             if line.startswith(">"):
                 seqid = line[1:].strip().split(" ")[0] # To ensure that only identifier (and no fasta comments) are compared:
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# array_utils.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import tempfile, heapq
+from array import array
+
+# NumPy is optional: without it, the arrays are sorted externally
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SORT_BLOCK_SIZE = 1 << 20 # items sorted at once in memory, by the external sort
+READ_BLOCK_SIZE = 1 << 16 # items read at once from each run, by the external sort
+
+# Sorts, in place, an array of keys, and an array of values in parallel if given
+# (of the same typecode than the keys). The sort is stable: values with the same key
+# keep their order. The items are never converted to a list of Python objects:
+# the arrays are sorted with NumPy or, if it is not available, with an external
+# merge sort of blocks of SORT_BLOCK_SIZE items, written to temporary files in tmp_dir.
+def sort_arrays(keys, values = None, tmp_dir = None):
+    
+    if values != None and (len(values) != len(keys) or values.typecode != keys.typecode):
+        raise ValueError("sort_arrays: keys and values must be arrays of the same length and typecode.")
+    
+    if len(keys) == 0: return
+    
+    if numpy != None:
+        __numpy_sort(keys, values)
+    else:
+        __external_sort(keys, values, tmp_dir)
+    
+    return
+
+def __numpy_sort(keys, values):
+    keys_view = numpy.frombuffer(keys, dtype = numpy.dtype(keys.typecode))
+    order = numpy.argsort(keys_view, kind = "mergesort")
+    keys_view[:] = keys_view[order]
+    
+    if values != None:
+        values_view = numpy.frombuffer(values, dtype = numpy.dtype(values.typecode))
+        values_view[:] = values_view[order]
+    
+    return
+
+# Yields the items of a run, as tuples of width (key, [value,] run_num, item_num)
+def __read_run(run_file, typecode, width, run_num):
+    run_file.seek(0)
+    
+    item_num = 0
+    while True:
+        block = array(typecode)
+        try:
+            block.fromfile(run_file, READ_BLOCK_SIZE * width)
+        except EOFError:
+            pass # the items which were available have been read
+        
+        if len(block) == 0: break
+        
+        for i in xrange(0, len(block), width):
+            yield tuple(block[i:i+width]) + (run_num, item_num)
+            item_num += 1
+    
+    return
+
+def __external_sort(keys, values, tmp_dir):
+    num_items = len(keys)
+    width = 1 if values == None else 2
+    
+    runs = []
+    try:
+        for start in xrange(0, num_items, SORT_BLOCK_SIZE):
+            end = min(start + SORT_BLOCK_SIZE, num_items)
+            order = sorted(xrange(start, end), key = keys.__getitem__)
+            
+            run = array(keys.typecode)
+            if values == None:
+                run.extend(keys[i] for i in order)
+            else:
+                for i in order:
+                    run.append(keys[i])
+                    run.append(values[i])
+            order = None
+            
+            if start == 0 and end == num_items: # a single block: sorted in memory
+                if values == None:
+                    keys[:] = run
+                else:
+                    keys[:] = run[0::2]
+                    values[:] = run[1::2]
+                return
+            
+            run_file = tempfile.TemporaryFile(suffix = "_m2p_sort", dir = tmp_dir)
+            runs.append(run_file)
+            run.tofile(run_file)
+            run_file.flush()
+        
+        # The runs are merged back into the arrays (run_num and item_num keep the sort stable)
+        merged = heapq.merge(*[__read_run(run_file, keys.typecode, width, run_num)
+                               for run_num, run_file in enumerate(runs)])
+        for i, item in enumerate(merged):
+            keys[i] = item[0]
+            if values != None: values[i] = item[1]
+    
+    finally:
+        for run_file in runs: run_file.close()
+    
+    return
+
+# Removes, in place, the repeated keys of a sorted array of keys
+def unique_sorted(keys):
+    
+    if len(keys) == 0: return
+    
+    if numpy != None:
+        keys_view = numpy.frombuffer(keys, dtype = numpy.dtype(keys.typecode))
+        unique_keys = numpy.unique(keys_view)
+        num_unique = len(unique_keys)
+        keys_view[:num_unique] = unique_keys
+        keys_view = None
+        unique_keys = None
+    else:
+        num_unique = 1
+        for i in xrange(1, len(keys)):
+            if keys[i] != keys[num_unique-1]:
+                keys[num_unique] = keys[i]
+                num_unique += 1
+    
+    del keys[num_unique:]
+    
+    return
+
+## END
\ No newline at end of file
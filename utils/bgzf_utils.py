@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# bgzf_utils.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import os, struct, zlib
+
+from barleymapcore.m2p_exception import m2pException
+
+## BGZF (blocked gzip, as bgzip from htslib) files: a series of gzip members (blocks)
+## of up to 64 KB, each one with its compressed size in the "BC" extra field.
+## Positions in the file are virtual offsets: the offset of the block in the
+## compressed file << 16 | the offset within the uncompressed block,
+## so that indexes (DatasetIndex, DatasetPosIndex) can point to any line,
+## and only the blocks which are read have to be decompressed.
+
+BGZF_EXT = ".gz" # compressed version of a data file: data_file.gz
+BGZF_BLOCK_INPUT = 65280 # max uncompressed bytes of each block
+BGZF_EOF = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+_GZIP_MAGIC = "\x1f\x8b\x08\x04"
+_HEADER_LEN = 12 # gzip header up to XLEN
+
+def is_bgzf(path):
+    with open(path, 'rb') as data_file:
+        header = data_file.read(_HEADER_LEN + 4)
+    
+    return len(header) == _HEADER_LEN + 4 and header.startswith(_GZIP_MAGIC) and header[_HEADER_LEN:_HEADER_LEN+2] == "BC"
+
+# The path of a data file, or of its compressed version (data_file.gz)
+# if the data file does not exist and the compressed one does
+def get_data_path(path):
+    data_path = path
+    
+    if not os.path.isfile(path) and os.path.isfile(path+BGZF_EXT):
+        data_path = path+BGZF_EXT
+    
+    return data_path
+
+# Opens a data file to read it by lines, either plain text or BGZF
+def open_data_file(path):
+    if is_bgzf(path):
+        data_file = BGZFReader(path)
+    else:
+        data_file = open(path, 'r')
+    
+    return data_file
+
+# Yields (start offset, end offset, line) of each line of a data file (open_data_file).
+# Offsets are virtual offsets for BGZF files, and can be used to seek the data file.
+def read_lines_with_offsets(data_file):
+    if isinstance(data_file, BGZFReader):
+        while True:
+            line_start = data_file.tell()
+            line = data_file.readline()
+            if not line: break
+            yield (line_start, data_file.tell(), line)
+    else:
+        offset = data_file.tell()
+        for line in data_file:
+            yield (offset, offset + len(line), line)
+            offset += len(line)
+
+### Reader of BGZF files, by lines, which decompresses only the blocks read.
+### As a file object: readline, iteration, seek and tell (virtual offsets) and close.
+class BGZFReader(object):
+    
+    _path = ""
+    _file = None
+    _block = "" # uncompressed data of the current block
+    _block_offset = 0
+    _next_block_offset = 0
+    _within_offset = 0
+    
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, 'rb')
+        self._load_block(0)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def close(self):
+        self._file.close()
+    
+    def _load_block(self, block_offset):
+        self._file.seek(block_offset)
+        header = self._file.read(_HEADER_LEN)
+        
+        if len(header) < _HEADER_LEN: # end of file
+            self._block = ""
+            self._block_offset = self._next_block_offset = block_offset
+            self._within_offset = 0
+            return
+        
+        if not header.startswith(_GZIP_MAGIC):
+            raise m2pException("BGZFReader: "+self._path+" is not a BGZF file (bad block at "+str(block_offset)+").")
+        
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = self._file.read(xlen)
+        
+        block_size = -1
+        pos = 0
+        while pos + 4 <= xlen:
+            (subfield_id, subfield_len) = struct.unpack("<2sH", extra[pos:pos+4])
+            if subfield_id == "BC":
+                block_size = struct.unpack("<H", extra[pos+4:pos+6])[0] + 1
+                break
+            pos += 4 + subfield_len
+        
+        if block_size == -1:
+            raise m2pException("BGZFReader: "+self._path+" is not a BGZF file (no block size at "+str(block_offset)+").")
+        
+        data = self._file.read(block_size - _HEADER_LEN - xlen)
+        self._block = zlib.decompress(data[:-8], -15)
+        self._block_offset = block_offset
+        self._next_block_offset = block_offset + block_size
+        self._within_offset = 0
+        
+        return
+    
+    # Loads the next block with data. Returns False at the end of the file
+    def _next_block(self):
+        while True:
+            if self._next_block_offset == self._block_offset and self._block == "": return False
+            self._load_block(self._next_block_offset)
+            if self._block != "": return True
+    
+    def tell(self):
+        if self._within_offset >= len(self._block):
+            virtual_offset = self._next_block_offset << 16
+        else:
+            virtual_offset = (self._block_offset << 16) | self._within_offset
+        
+        return virtual_offset
+    
+    def seek(self, virtual_offset):
+        block_offset = virtual_offset >> 16
+        
+        if block_offset != self._block_offset or self._block == "":
+            self._load_block(block_offset)
+        
+        self._within_offset = virtual_offset & 0xffff
+        
+        return
+    
+    def readline(self):
+        parts = []
+        
+        while True:
+            if self._within_offset >= len(self._block):
+                if not self._next_block(): break
+            
+            block = self._block
+            newline = block.find("\n", self._within_offset)
+            if newline >= 0:
+                parts.append(block[self._within_offset:newline+1])
+                self._within_offset = newline + 1
+                break
+            
+            parts.append(block[self._within_offset:])
+            self._within_offset = len(block)
+        
+        return "".join(parts)
+    
+    # Lines from the current position. Whole blocks are split in lines,
+    # so that tell() is not updated line by line (use readline to know the offset of each line)
+    def __iter__(self):
+        pending = ""
+        
+        while True:
+            if self._within_offset >= len(self._block):
+                if not self._next_block(): break
+            
+            lines = self._block[self._within_offset:].split("\n")
+            self._within_offset = len(self._block)
+            
+            lines[0] = pending + lines[0]
+            pending = lines.pop()
+            for line in lines:
+                yield line+"\n"
+        
+        if pending != "":
+            yield pending
+
+### Writer of BGZF files (as bgzip), for the files to be read with BGZFReader
+class BGZFWriter(object):
+    
+    _file = None
+    _buffer = None
+    _buffer_len = 0
+    _level = 6
+    
+    def __init__(self, path, level = 6):
+        self._file = open(path, 'wb')
+        self._buffer = []
+        self._buffer_len = 0
+        self._level = level
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        
+        block_size = _HEADER_LEN + 6 + len(compressed) + 8
+        self._file.write(_GZIP_MAGIC+"\x00\x00\x00\x00\x00\xff"+struct.pack("<H2sHH", 6, "BC", 2, block_size - 1))
+        self._file.write(compressed)
+        self._file.write(struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data)))
+        
+        return
+    
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_len += len(data)
+        
+        if self._buffer_len >= BGZF_BLOCK_INPUT:
+            data = "".join(self._buffer)
+            pos = 0
+            while len(data) - pos >= BGZF_BLOCK_INPUT:
+                self._write_block(data[pos:pos+BGZF_BLOCK_INPUT])
+                pos += BGZF_BLOCK_INPUT
+            self._buffer = [data[pos:]]
+            self._buffer_len = len(data) - pos
+        
+        return
+    
+    def close(self):
+        if self._buffer_len > 0:
+            self._write_block("".join(self._buffer))
+            self._buffer = []
+            self._buffer_len = 0
+        
+        self._file.write(BGZF_EOF)
+        self._file.close()
+        
+        return
+
+## END
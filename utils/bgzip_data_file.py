@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# bgzip_data_file.py is part of Barleymap.
+# Copyright (C) 2017 Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+###########################
+## Script to compress a dataset file (datasets_path) or a map file (maps_path)
+## as BGZF (as bgzip from htslib), so that it can be read by lines from any
+## position (see bgzf_utils). The compressed file (data_file.gz) is used
+## when the plain text file does not exist, so this can be removed afterwards.
+## Indexes (build_dataset_index.py, build_dataset_pos_index.py) have to be
+## built on the compressed file.
+##
+## Usage: python bgzip_data_file.py data_file [level]
+###########################
+
+import sys, os
+
+from barleymapcore.utils.bgzf_utils import BGZFWriter, BGZF_EXT
+
+if __name__ == "__main__":
+    
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: python bgzip_data_file.py data_file [level]\n")
+        sys.exit(-1)
+    
+    data_path = sys.argv[1]
+    level = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    
+    bgzf_path = data_path+BGZF_EXT
+    
+    with open(data_path, 'rb') as data_file:
+        with BGZFWriter(bgzf_path, level) as bgzf_file:
+            while True:
+                data = data_file.read(1048576)
+                if not data: break
+                bgzf_file.write(data)
+    
+    sys.stderr.write(data_path+" ("+str(os.path.getsize(data_path))+" bytes) compressed to "+\
+                     bgzf_path+" ("+str(os.path.getsize(bgzf_path))+" bytes)\n")
+
+## END
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# build_dataset_index.py is part of Barleymap.
+# Copyright (C) 2017 Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+###########################
+## Script to build the binary index (DatasetIndex) of a dataset file,
+## to retrieve its markers by id without scanning the whole file.
+## The index is written next to the dataset file (dataset_file.bidx),
+## and it is used instead of an old pickled index (dataset_file.idx) if both exist.
+## If the dataset has a synonyms file, it should be included in the index,
+## so that synonyms are resolved with the index instead of scanning the dataset file.
+## The index has to be built again whenever the dataset file or the synonyms file change.
+##
+## Usage: python build_dataset_index.py dataset_file [synonyms_file]
+###########################
+
+import sys
+
+from barleymapcore.maps.reader.DatasetIndex import DatasetIndex
+
+if __name__ == "__main__":
+    
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: python build_dataset_index.py dataset_file [synonyms_file]\n")
+        sys.exit(-1)
+    
+    data_path = sys.argv[1]
+    synonyms_path = sys.argv[2] if len(sys.argv) > 2 else None
+    
+    index_path = DatasetIndex.get_index_path(data_path)
+    DatasetIndex.build(data_path, index_path, synonyms_path, verbose = True)
+
+## END
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# build_dataset_pos_index.py is part of Barleymap.
+# Copyright (C) 2017 Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+###########################
+## Script to build the positional index (DatasetPosIndex) of a dataset file of a map,
+## to retrieve the markers within intervals of the map without scanning the whole file.
+## The map (map_id in maps.conf) defines the fields of the dataset file.
+## The index is written next to the dataset file (dataset_file.pidx), and it has
+## to be built again whenever the dataset file changes.
+##
+## Usage: python build_dataset_pos_index.py maps.conf map_id dataset_file [bp_bin] [cm_bin]
+###########################
+
+import sys
+
+from barleymapcore.db.MapsConfig import MapsConfig
+from barleymapcore.maps.reader.DatasetPosIndex import DatasetPosIndex, DEFAULT_BP_BIN, DEFAULT_CM_BIN
+
+if __name__ == "__main__":
+    
+    if len(sys.argv) < 4:
+        sys.stderr.write("Usage: python build_dataset_pos_index.py maps.conf map_id dataset_file [bp_bin] [cm_bin]\n")
+        sys.exit(-1)
+    
+    maps_conf_file = sys.argv[1]
+    map_id = sys.argv[2]
+    data_path = sys.argv[3]
+    bp_bin = int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_BP_BIN
+    cm_bin = float(sys.argv[5]) if len(sys.argv) > 5 else DEFAULT_CM_BIN
+    
+    map_config = MapsConfig(maps_conf_file, verbose = False).get_map_config(map_id)
+    
+    index_path = DatasetPosIndex.get_index_path(data_path)
+    DatasetPosIndex.build(data_path, index_path, map_config, bp_bin, cm_bin, verbose = True)
+
+## END
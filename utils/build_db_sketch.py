@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# build_db_sketch.py is part of Barleymap.
+# Copyright (C) 2017 Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+###########################
+## Script to build the k-mer sketch of a DB from its reference fasta,
+## to be used by DBSketchFilter (db_sketches in paths config).
+## The sketch has to be named as the DB (DB.sketch) and placed in db_sketches_path.
+##
+## Usage: python build_db_sketch.py reference.fa DB.sketch [k] [scaled]
+###########################
+
+import sys
+
+from barleymapcore.alignment.DBSketches import DBSketch, DEFAULT_K, DEFAULT_SCALED
+
+if __name__ == "__main__":
+    
+    if len(sys.argv) < 3:
+        sys.stderr.write("Usage: python build_db_sketch.py reference.fa DB.sketch [k] [scaled]\n")
+        sys.exit(-1)
+    
+    fasta_path = sys.argv[1]
+    sketch_path = sys.argv[2]
+    k = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_K
+    scaled = int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_SCALED
+    
+    sketch = DBSketch.build(fasta_path, k, scaled, verbose = True)
+    sketch.write(sketch_path)
+    
+    sys.stderr.write("Sketch of "+str(sketch.get_num_hashes())+" k-mers (k="+str(k)+", scaled="+str(scaled)+") written to "+sketch_path+"\n")
+
+## END
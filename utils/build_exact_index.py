@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# build_exact_index.py is part of Barleymap.
+# Copyright (C) 2017 Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+###########################
+## Script to build the exact match index of a DB from its reference fasta,
+## to be used by ExactMatchAligner (exact_index_path in paths config).
+## Two files are written to the output directory: DB.exidx (seeds) and DB.exseq (sequences).
+##
+## Usage: python build_exact_index.py reference.fa output_dir DB [seed_len] [step]
+###########################
+
+import sys, os
+
+from barleymapcore.alignment.ExactMatchIndex import ExactMatchIndex, INDEX_EXT, SEQ_EXT, DEFAULT_SEED_LEN, DEFAULT_STEP
+
+if __name__ == "__main__":
+    
+    if len(sys.argv) < 4:
+        sys.stderr.write("Usage: python build_exact_index.py reference.fa output_dir DB [seed_len] [step]\n")
+        sys.exit(-1)
+    
+    fasta_path = sys.argv[1]
+    output_dir = sys.argv[2]
+    db_name = sys.argv[3]
+    seed_len = int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_SEED_LEN
+    step = int(sys.argv[5]) if len(sys.argv) > 5 else DEFAULT_STEP
+    
+    index_path = os.path.join(output_dir, db_name + INDEX_EXT)
+    seq_path = os.path.join(output_dir, db_name + SEQ_EXT)
+    
+    ExactMatchIndex.build(fasta_path, index_path, seq_path, seed_len, step, verbose = True)
+    
+    sys.stderr.write("Exact match index (seed_len="+str(seed_len)+", step="+str(step)+") written to "+\
+                     index_path+" and "+seq_path+"\n")
+
+## END
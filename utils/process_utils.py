@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# process_utils.py is part of Barleymap.
+# Copyright (C)  2017  Carlos P Cantalapiedra.
+# (terms of use can be found within the distributed LICENSE file).
+
+import sys, os, signal, tempfile, threading
+from subprocess import Popen, PIPE
+
+# Whether the stderr of an aligner reports errors (see StreamedProcess.check)
+def has_error_output(err_output):
+    return "error" in err_output or "Error" in err_output or "ERROR" in err_output
+
+### Raised when a process is started on behalf of a cancelled request
+class ProcessCancelledException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+    
+    def __str__(self):
+        return self.msg
+
+### The processes (StreamedProcess) started on behalf of a single request
+### (see AlignmentRequest), which are all killed if the request is cancelled.
+### The group is bound to the thread which runs the request, and the functions
+### which run parts of the request in other threads (e.g. a ThreadPool)
+### are wrapped with ProcessGroup.propagate so that they use the same group.
+class ProcessGroup(object):
+    
+    _thread_data = threading.local()
+    
+    _lock = None
+    _processes = None
+    _cancelled = False
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes = set()
+        self._cancelled = False
+    
+    # The group of the current thread, or None
+    @staticmethod
+    def get_current():
+        return getattr(ProcessGroup._thread_data, "group", None)
+    
+    @staticmethod
+    def set_current(group):
+        ProcessGroup._thread_data.group = group
+    
+    # Wraps function so that, in any thread, it runs with the group of the calling thread
+    @staticmethod
+    def propagate(function):
+        group = ProcessGroup.get_current()
+        if group == None: return function
+        
+        def group_function(*args, **kwargs):
+            prev_group = ProcessGroup.get_current()
+            ProcessGroup.set_current(group)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                ProcessGroup.set_current(prev_group)
+        
+        return group_function
+    
+    def is_cancelled(self):
+        return self._cancelled
+    
+    # Returns False if the group has been cancelled, so the process must not be run
+    def add(self, process):
+        with self._lock:
+            if self._cancelled: return False
+            self._processes.add(process)
+        
+        return True
+    
+    def remove(self, process):
+        with self._lock:
+            self._processes.discard(process)
+        
+        return
+    
+    # Kills the running processes of the group, and any process added later
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            processes = list(self._processes)
+        
+        for process in processes:
+            process.kill()
+        
+        return
+
+### Runs an external command (an aligner) whose stdout
+### is read line by line as it is produced, instead of
+### buffering the whole output with communicate().
+### stderr is spooled to a temporary file, so that the
+### process does not block on a full stderr pipe, and
+### it is checked once the process has finished.
+### If the current thread has a ProcessGroup, the process is added to it,
+### and runs in its own session, so that the shell and the command
+### are killed together if the group is cancelled.
+class StreamedProcess(object):
+    
+    _cmd = ""
+    _process = None
+    _process_group = None
+    _err_file = None
+    _num_lines = 0
+    _eof = False
+    _retvalue = None
+    _err_output = ""
+    
+    def __init__(self, cmd):
+        self._cmd = cmd
+        self._num_lines = 0
+        self._process_group = ProcessGroup.get_current()
+        
+        if self._process_group != None and self._process_group.is_cancelled():
+            raise ProcessCancelledException("StreamedProcess: request cancelled. "+cmd+" not run.")
+        
+        self._err_file = tempfile.TemporaryFile()
+        
+        if self._process_group != None:
+            self._process = Popen(cmd, shell=True, stdout=PIPE, stderr=self._err_file, preexec_fn=os.setsid)
+            
+            if not self._process_group.add(self):
+                self.close()
+                raise ProcessCancelledException("StreamedProcess: request cancelled. "+cmd+" killed.")
+        else:
+            self._process = Popen(cmd, shell=True, stdout=PIPE, stderr=self._err_file)
+    
+    def get_cmd(self):
+        return self._cmd
+    
+    def get_num_lines(self):
+        return self._num_lines
+    
+    def get_retvalue(self):
+        return self._retvalue
+    
+    def get_err_output(self):
+        return self._err_output
+    
+    # Yields the lines of stdout without the trailing new line
+    def lines(self):
+        stdout = self._process.stdout
+        
+        for line in iter(stdout.readline, ""):
+            self._num_lines += 1
+            yield line.rstrip("\n")
+        
+        self._eof = True
+        
+        return
+    
+    # Kills the process (and the processes of its session, if it has its own)
+    def kill(self):
+        
+        if self._process.poll() != None: return
+        
+        try:
+            if self._process_group != None:
+                os.killpg(self._process.pid, signal.SIGKILL)
+            else:
+                self._process.kill()
+        except OSError:
+            pass # already finished
+        
+        return
+    
+    # Waits for the process to finish (killing it if the output
+    # was not completely read) and loads its stderr
+    def close(self):
+        
+        if self._retvalue != None: return self._retvalue
+        
+        # If the output was not completely read (e.g. an exception
+        # while parsing it) the process is not waited for, but killed
+        if not self._eof:
+            self.kill()
+        self._process.stdout.close()
+        
+        self._retvalue = self._process.wait()
+        
+        if self._process_group != None: self._process_group.remove(self)
+        
+        self._err_file.seek(0)
+        self._err_output = self._err_file.read()
+        self._err_file.close()
+        
+        return self._retvalue
+    
+    # Checks the exit code and stderr of the finished process.
+    # Raises an Exception if the command failed (ProcessCancelledException
+    # if it was killed by its ProcessGroup), and returns
+    # False if it ended well but reported errors in stderr.
+    def check(self, app_name, verbose = False):
+        retvalue = self.close()
+        err_output = self._err_output
+        
+        if verbose and err_output: sys.stderr.write(err_output+"\n")
+        
+        if self._process_group != None and self._process_group.is_cancelled():
+            raise ProcessCancelledException(app_name+": request cancelled. "+self._cmd+" killed.")
+        
+        if retvalue != 0:
+            raise Exception(app_name+": return != 0. "+self._cmd+"\nError: "+str(err_output)+"\n")
+        
+        if has_error_output(err_output):
+            sys.stderr.write(app_name+": error in "+app_name+" output. We will report 0 results for this alignment.\n")
+            sys.stderr.write(str(err_output)+"\n")
+            return False
+        
+        if verbose: sys.stderr.write(app_name+": return value "+str(retvalue)+"\n")
+        
+        return True
+
+## END